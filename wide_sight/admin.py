@@ -1,13 +1,14 @@
 from django.contrib.gis import admin
 from django.utils.html import format_html
+from django.urls import reverse
 
-from .models import sequences, panoramas, image_object_types, image_objects, userkeys, appkeys
+from .models import sequences, panoramas, image_object_types, image_objects, userkeys, appkeys, jobs, stored_files
 
 @admin.register(panoramas)
 class panoramaAdmin( admin.OSMGeoAdmin):
 
     def eqimage_tag(self, obj):
-        return format_html('<img src="{}" />'.format(obj.eqimage_thumbnail.url))
+        return format_html('<img src="{}" loading="lazy" />', reverse('panoramas-rendition', args=[obj.pk, 'thumbnail', 'jpeg']))
 
     list_display = ['eqimage_tag',]
     list_per_page = 15
@@ -18,3 +19,5 @@ admin.site.register(image_object_types)
 admin.site.register(image_objects, admin.OSMGeoAdmin)
 admin.site.register(appkeys)
 admin.site.register(userkeys)
+admin.site.register(jobs)
+admin.site.register(stored_files)
@@ -0,0 +1,150 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+
+from .models import image_objects, bump_change_counter
+from .monoplot import monoplot_image_objects
+from .serializers import image_objects_bulk_serializer
+
+OPERATIONS = ('create', 'update', 'delete')
+RELATED_FIELDS = ('panorama', 'creator_key', 'sample_type', 'match')
+BULK_MAX_OPERATIONS = getattr(settings, 'WS_BULK_MAX_OPERATIONS', 5000)
+BULK_BATCH_SIZE = 500
+
+
+class bulkError(Exception):
+
+    def __init__(self, errors):
+        super(bulkError, self).__init__(errors)
+        self.errors = errors
+
+
+def _to_pk(model, value):
+    try:
+        return model._meta.pk.to_python(value)
+    except (ValidationError, TypeError, ValueError, AttributeError):
+        return None
+
+def normalize_operations(data):
+    """
+    [(op, item)] from {"create": [...], "update": [...], "delete": [...]} or from a list
+    (JSON array or NDJSON lines) of objects with an "op" key. Deletes may be bare ids
+    """
+    if isinstance(data, dict):
+        unknown = set(data) - set(OPERATIONS)
+        if unknown:
+            raise bulkError([{'errors': 'unknown operations: %s' % ', '.join(sorted(unknown))}])
+        operations = [(op, item) for op in OPERATIONS for item in data.get(op) or []]
+    elif isinstance(data, list):
+        operations = [(item.get('op') if isinstance(item, dict) else None, item) for item in data]
+    else:
+        raise bulkError([{'errors': 'expected an object of operation lists or a list of operations'}])
+    if len(operations) > BULK_MAX_OPERATIONS:
+        raise bulkError([{'errors': 'too many operations (max %d)' % BULK_MAX_OPERATIONS}])
+    return [(op, {'id': item} if op == 'delete' and not isinstance(item, dict) else item) for op, item in operations]
+
+def preload_related(items):
+    """
+    {model: {pk: instance}} of every object referenced by the items, one query per model
+    """
+    related = {}
+    for name in RELATED_FIELDS:
+        model = image_objects._meta.get_field(name).related_model
+        keys = set()
+        for item in items:
+            values = item.get(name)
+            for value in values if isinstance(values, list) else [values]:
+                key = _to_pk(model, value) if value is not None else None
+                if key is not None:
+                    keys.add(key)
+        related.setdefault(model, {}).update(model.objects.in_bulk(list(keys)) if keys else {})
+    return related
+
+def _set_matches(matches):
+    # match is symmetrical: every link is stored in both directions
+    through = image_objects.match.through
+    sources = list(matches)
+    through.objects.filter(Q(from_image_objects__in=sources) | Q(to_image_objects__in=sources)).delete()
+    pairs = set()
+    for source, targets in matches.items():
+        for target in targets:
+            pairs.update(((source, target), (target, source)))
+    through.objects.bulk_create(
+        [through(from_image_objects_id=source, to_image_objects_id=target) for source, target in sorted(pairs)],
+        batch_size=BULK_BATCH_SIZE,
+    )
+
+def bulk_image_objects(data, context=None):
+    """
+    Validates every create/update/delete operation, then applies all of them in a single
+    transaction with bulk queries. Raises bulkError with the errors of the invalid
+    operations (by index), nothing is written in that case.
+    Returns {'created': [ids], 'updated': [ids], 'deleted': [ids]}
+    """
+    operations = normalize_operations(data)
+    errors = []
+    for index, (op, item) in enumerate(operations):
+        if op not in OPERATIONS:
+            errors.append({'index': index, 'op': op, 'errors': 'op must be one of %s' % ', '.join(OPERATIONS)})
+        elif not isinstance(item, dict):
+            errors.append({'index': index, 'op': op, 'errors': 'operation must be an object'})
+        elif op != 'create' and _to_pk(image_objects, item.get('id')) is None:
+            errors.append({'index': index, 'op': op, 'errors': {'id': ['a valid image object id is required']}})
+    if errors:
+        raise bulkError(errors)
+
+    context = dict(context or {}, related_objects=preload_related([item for op, item in operations if op != 'delete']))
+    instances = image_objects.objects.in_bulk([_to_pk(image_objects, item['id']) for op, item in operations if op == 'update'])
+    created, updated, deleted = [], [], []
+    updated_fields = set(['geom'])
+    matches = {}
+    for index, (op, item) in enumerate(operations):
+        pk = _to_pk(image_objects, item.get('id'))
+        if op == 'delete':
+            deleted.append(pk)
+            continue
+        if op == 'create':
+            serializer = image_objects_bulk_serializer(data=item, context=context)
+        elif pk in instances:
+            serializer = image_objects_bulk_serializer(instances[pk], data=item, partial=True, context=context)
+        else:
+            errors.append({'index': index, 'op': op, 'errors': {'id': ['image object not found']}})
+            continue
+        if not serializer.is_valid():
+            errors.append({'index': index, 'op': op, 'errors': serializer.errors})
+            continue
+        values = dict(serializer.validated_data)
+        match = values.pop('match', None)
+        if op == 'create':
+            obj = image_objects(**values)
+            created.append(obj)
+        else:
+            obj = serializer.instance
+            for name, value in values.items():
+                setattr(obj, name, value)
+            updated_fields.update(values)
+            if obj not in updated:
+                updated.append(obj)
+        if match is not None:
+            matches[obj.pk] = [target.pk for target in match]
+    if errors:
+        raise bulkError(errors)
+
+    to_project = [obj.pk for obj in created + updated if obj.set_geom()]
+    with transaction.atomic():
+        image_objects.objects.bulk_create(created, batch_size=BULK_BATCH_SIZE)
+        if updated:
+            image_objects.objects.bulk_update(updated, sorted(updated_fields), batch_size=BULK_BATCH_SIZE)
+        if matches:
+            _set_matches(matches)
+        if deleted:
+            image_objects.objects.filter(pk__in=deleted).delete()
+        if to_project:
+            monoplot_image_objects(image_objects.objects.filter(pk__in=to_project))
+    bump_change_counter('image_objects')
+    return {
+        'created': [obj.pk for obj in created],
+        'updated': [obj.pk for obj in updated],
+        'deleted': deleted,
+    }
@@ -0,0 +1,65 @@
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+from .models import get_changes
+
+RESPONSE_CACHE_TIMEOUT = getattr(settings, 'WS_RESPONSE_CACHE_TIMEOUT', 300)
+
+def response_validators(request, model_names, variant=''):
+    """
+    ETag from the change counters of model_names and the requested url, Last-Modified
+    from their last change time
+    """
+    changes = get_changes(*model_names)
+    versions = ','.join('%s:%s' % (name, changes[name][0]) for name in model_names)
+    key = '|'.join((versions, request.get_host(), request.get_full_path(), variant))
+    etag = '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+    return etag, max(changes[name][1] for name in model_names)
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def conditional_cache(*model_names):
+    """
+    decorator for viewset list/retrieve methods: answers 304 Not Modified to matching
+    If-None-Match/If-Modified-Since and caches rendered 200 responses by url until one
+    of model_names changes. HTML renderings (browsable API) carry the user name and a
+    csrf token: they are neither validated nor cached
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            renderer = getattr(request, 'accepted_renderer', None)
+            if request.method not in ('GET', 'HEAD') or (renderer and renderer.media_type.startswith('text/html')):
+                return method(self, request, *args, **kwargs)
+            etag, last_modified = response_validators(request._request, model_names, renderer.format if renderer else '')
+            not_modified = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+            if not_modified is not None:
+                return set_validators(not_modified, etag, last_modified)
+
+            key = 'ws_response_%s' % etag.strip('"')
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                return set_validators(HttpResponse(content, content_type=content_type), etag, last_modified)
+
+            response = method(self, request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            if isinstance(response, Response):
+                response = self.finalize_response(request, response, *args, **kwargs)
+                response.render()
+                cache.set(key, (response.content, response['Content-Type']), RESPONSE_CACHE_TIMEOUT)
+            return set_validators(response, etag, last_modified)
+        return wrapper
+    return decorator
@@ -0,0 +1,114 @@
+import math
+
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Avg, Count
+from django.db.models.expressions import RawSQL
+
+from .models import panoramas, image_objects, get_change_counter
+
+# Coverage overview: points are counted in web mercator grid cells, CLUSTER_CELLS per side
+# of every map tile of the requested zoom, each cell reported with its count and the
+# centroid of its points. PostGIS groups the cells in SQL, on SpatiaLite the lon/lat of
+# the rows in the bounding box are binned with NumPy. Cells are cached by map tile
+# until the layer changes.
+
+CLUSTER_CELLS = getattr(settings, 'WS_CLUSTER_CELLS', 8)
+CLUSTER_MAX_TILES = getattr(settings, 'WS_CLUSTER_MAX_TILES', 256)
+CLUSTER_MAX_ZOOM = 22
+MERCATOR_MAX_LAT = 85.0511287798
+
+LAYERS = {
+    'panoramas': panoramas,
+    'image_objects': image_objects,
+}
+
+def mercator_cells(lon, lat, n):
+    """
+    grid cell columns and rows of lon/lat arrays on a n x n web mercator grid
+    """
+    lat = np.radians(np.clip(lat, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+    x = (np.asarray(lon) + 180.0) / 360.0
+    y = (1 - np.arcsinh(np.tan(lat)) / np.pi) / 2
+    return np.clip(np.floor(x * n), 0, n - 1).astype(np.int64), np.clip(np.floor(y * n), 0, n - 1).astype(np.int64)
+
+def cell_bounds(cx, cy, n):
+    """
+    lon/lat bounds (xmin, ymin, xmax, ymax) of a grid cell
+    """
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * row / n))))
+    return (cx * 360.0 / n - 180.0, lat(cy + 1), (cx + 1) * 360.0 / n - 180.0, lat(cy))
+
+def _numpy_cells(queryset, n):
+    rows = np.array(list(queryset.values_list('lon', 'lat')), dtype=np.float64).reshape(-1, 2)
+    if not len(rows):
+        return []
+    cx, cy = mercator_cells(rows[:, 0], rows[:, 1], n)
+    cells, index, counts = np.unique(cx * n + cy, return_inverse=True, return_counts=True)
+    lon = np.bincount(index, weights=rows[:, 0]) / counts
+    lat = np.bincount(index, weights=rows[:, 1]) / counts
+    return [(int(cell // n), int(cell % n), int(count), float(x), float(y)) for cell, count, x, y in zip(cells, counts, lon, lat)]
+
+def _postgis_cells(queryset, n):
+    table = queryset.model._meta.db_table
+    cx = RawSQL('floor(("%s"."lon" + 180) / 360 * %%s)' % table, (n,))
+    cy = RawSQL('floor((1 - ln(tan(radians(greatest(least("%s"."lat", %%s), %%s))) + 1 / cos(radians(greatest(least("%s"."lat", %%s), %%s)))) / pi()) / 2 * %%s)' % (table, table),
+                (MERCATOR_MAX_LAT, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT, -MERCATOR_MAX_LAT, n))
+    rows = queryset.annotate(cx=cx, cy=cy).values('cx', 'cy').annotate(count=Count('pk'), centroid_lon=Avg('lon'), centroid_lat=Avg('lat')).order_by()
+    return [(min(int(row['cx']), n - 1), min(int(row['cy']), n - 1), row['count'], row['centroid_lon'], row['centroid_lat']) for row in rows]
+
+def _tiles_cells(model, z, tiles):
+    """
+    {(tile x, tile y): cells} of a block of map tiles read with a single query
+    """
+    n = 2 ** z * CLUSTER_CELLS
+    tile_n = 2 ** z
+    xs = [x for x, y in tiles]
+    ys = [y for x, y in tiles]
+    xmin, _, _, ymax = cell_bounds(min(xs) * CLUSTER_CELLS, min(ys) * CLUSTER_CELLS, n)
+    _, ymin, xmax, _ = cell_bounds((max(xs) + 1) * CLUSTER_CELLS - 1, (max(ys) + 1) * CLUSTER_CELLS - 1, n)
+    bbox = Polygon.from_bbox((xmin, ymin, xmax, ymax))
+    bbox.srid = 4326
+    queryset = model.objects.filter(geom__intersects=bbox, lon__isnull=False, lat__isnull=False)
+    if getattr(connection.ops, 'postgis', False):
+        cells = _postgis_cells(queryset, n)
+    else:
+        cells = _numpy_cells(queryset, n)
+    result = {tile: [] for tile in tiles}
+    for cell in cells:
+        tile = (cell[0] // CLUSTER_CELLS, cell[1] // CLUSTER_CELLS)
+        if tile in result and tile[0] < tile_n and tile[1] < tile_n:
+            result[tile].append(cell)
+    return result
+
+def cluster_cells(layer, bbox, z):
+    """
+    (column, row, count, centroid lon, centroid lat) of the non empty grid cells of
+    layer at zoom z intersecting bbox (min lon, min lat, max lon, max lat).
+    Raises ValueError on bad parameters
+    """
+    model = LAYERS[layer]
+    if not 0 <= z <= CLUSTER_MAX_ZOOM:
+        raise ValueError('zoom must be in [0, %d]' % CLUSTER_MAX_ZOOM)
+    xmin, ymin, xmax, ymax = bbox
+    if xmin > xmax or ymin > ymax:
+        raise ValueError('bbox must be min lon, min lat, max lon, max lat')
+    n = 2 ** z * CLUSTER_CELLS
+    (cx0, cx1), (cy1, cy0) = mercator_cells(np.array([xmin, xmax]), np.array([ymin, ymax]), n)
+    tiles = [(x, y) for x in range(cx0 // CLUSTER_CELLS, cx1 // CLUSTER_CELLS + 1) for y in range(cy0 // CLUSTER_CELLS, cy1 // CLUSTER_CELLS + 1)]
+    if len(tiles) > CLUSTER_MAX_TILES:
+        raise ValueError('bbox too large for zoom %d' % z)
+
+    version = get_change_counter(model._meta.model_name)
+    keys = {tile: 'ws_clusters_%s_%d_%d_%d' % (layer, z, tile[0], tile[1]) for tile in tiles}
+    cached = cache.get_many(list(keys.values()), version=version)
+    missing = [tile for tile in tiles if keys[tile] not in cached]
+    if missing:
+        computed = _tiles_cells(model, z, missing)
+        cache.set_many({keys[tile]: cells for tile, cells in computed.items()}, version=version)
+        cached.update({keys[tile]: cells for tile, cells in computed.items()})
+    return [cell for tile in tiles for cell in cached[keys[tile]] if cx0 <= cell[0] <= cx1 and cy0 <= cell[1] <= cy1]
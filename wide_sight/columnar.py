@@ -0,0 +1,396 @@
+import json
+import struct
+import tempfile
+
+import numpy as np
+from django.contrib.gis.db.models.functions import AsWKB
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .geojson import iter_records, COMPUTED_FIELDS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columnar exports of the GeoFeatureModelSerializer fields of a queryset, read in chunks
+# with iter_records and the geometry encoded as WKB by the database:
+# GeoParquet (one row group per chunk, needs pyarrow) and FlatGeobuf (written here,
+# features sorted along a Hilbert curve behind a packed R-tree index).
+
+FILTER_LOOKUPS = {
+    'sequences': {'sequence': 'pk', 'creator_key': 'creator_key'},
+    'panoramas': {'sequence': 'sequence', 'creator_key': 'sequence__creator_key'},
+    'image_objects': {'sequence': 'panorama__sequence', 'creator_key': 'creator_key'},
+}
+
+def filter_export_queryset(queryset, sequence=None, creator_key=None, bbox=None):
+    """
+    bbox is (min lon, min lat, max lon, max lat)
+    """
+    lookups = FILTER_LOOKUPS[queryset.model._meta.model_name]
+    if sequence:
+        queryset = queryset.filter(**{lookups['sequence'] + '__in': sequence if isinstance(sequence, (list, tuple)) else [sequence]})
+    if creator_key:
+        queryset = queryset.filter(**{lookups['creator_key']: creator_key})
+    if bbox:
+        polygon = Polygon.from_bbox(bbox)
+        polygon.srid = 4326
+        queryset = queryset.filter(geom__intersects=polygon)
+    return queryset
+
+def _column_kind(field):
+    if field.many_to_many:
+        return 'json'
+    if field.is_relation:
+        return _column_kind(field.target_field)
+    internal_type = field.get_internal_type()
+    if internal_type in ('IntegerField', 'SmallIntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField', 'AutoField'):
+        return 'int'
+    if internal_type in ('BigIntegerField', 'BigAutoField'):
+        return 'long'
+    if internal_type in ('FloatField', 'DecimalField'):
+        return 'double'
+    if internal_type in ('BooleanField', 'NullBooleanField'):
+        return 'bool'
+    if internal_type in ('DateTimeField', 'DateField'):
+        return 'datetime' if internal_type == 'DateTimeField' else 'date'
+    return 'string'
+
+def export_columns(serializer_class):
+    """
+    [(name, kind)] of the exported properties, id first
+    """
+    meta = serializer_class.Meta
+    model = meta.model
+    write_only = [name for name, options in getattr(meta, 'extra_kwargs', {}).items() if options.get('write_only')]
+    columns = [('id', _column_kind(model._meta.pk))]
+    for name in meta.fields:
+        if name in ('id', meta.geo_field) or name in write_only:
+            continue
+        try:
+            columns.append((name, _column_kind(model._meta.get_field(name))))
+        except FieldDoesNotExist:
+            columns.append((name, 'json' if name in COMPUTED_FIELDS else 'string'))
+    return columns
+
+GEOMETRY_TYPES = {'POINT': 'Point', 'MULTIPOINT': 'MultiPoint'}
+
+def geometry_type_name(serializer_class):
+    meta = serializer_class.Meta
+    return GEOMETRY_TYPES[meta.model._meta.get_field(meta.geo_field).geom_type]
+
+def _wkb_points(wkb):
+    """
+    (x, y) of a WKB Point or MultiPoint, empty points have nan coordinates
+    """
+    wkb = bytes(wkb)
+    order = '<' if wkb[0] == 1 else '>'
+    geometry_type = (struct.unpack_from(order + 'I', wkb, 1)[0] & 0x0fffffff) % 1000
+    if geometry_type == 1:
+        return [struct.unpack_from(order + 'dd', wkb, 5)]
+    points = []
+    offset = 9
+    for i in range(struct.unpack_from(order + 'I', wkb, 5)[0]):
+        point_order = '<' if wkb[offset] == 1 else '>'
+        points.append(struct.unpack_from(point_order + 'dd', wkb, offset + 5))
+        offset += 21
+    return points
+
+
+# GeoParquet
+
+PARQUET_TYPES = {
+    'int': 'int32',
+    'long': 'int64',
+    'double': 'float64',
+    'bool': 'bool_',
+    'string': 'string',
+    'json': 'string',
+}
+
+def _parquet_type(kind):
+    if kind == 'datetime':
+        return pyarrow.timestamp('us', tz='UTC')
+    if kind == 'date':
+        return pyarrow.date32()
+    return getattr(pyarrow, PARQUET_TYPES[kind])()
+
+def write_geoparquet(output, serializer_class, queryset, request=None, chunk_size=10000):
+    """
+    writes a GeoParquet 1.0 file (WKB geometry column) with a row group every chunk_size rows
+    """
+    if pyarrow is None:
+        raise ImproperlyConfigured('GeoParquet export requires pyarrow')
+    meta = serializer_class.Meta
+    columns = export_columns(serializer_class)
+    geo = {
+        'version': '1.0.0',
+        'primary_column': meta.geo_field,
+        'columns': {meta.geo_field: {'encoding': 'WKB', 'geometry_types': [geometry_type_name(serializer_class)]}},
+    }
+    schema = pyarrow.schema(
+        [pyarrow.field(name, _parquet_type(kind)) for name, kind in columns] + [pyarrow.field(meta.geo_field, pyarrow.binary())],
+        metadata={'geo': json.dumps(geo)},
+    )
+    encoder = DjangoJSONEncoder()
+    writer = pyarrow.parquet.ParquetWriter(output, schema)
+    try:
+        for records in iter_records(serializer_class, queryset, request, chunk_size, geometry_function=AsWKB):
+            data = {name: [] for name, kind in columns + [(meta.geo_field, 'binary')]}
+            for feature_id, geometry, properties in records:
+                properties['id'] = feature_id
+                for name, kind in columns:
+                    value = properties[name]
+                    if value is not None and kind == 'json':
+                        value = encoder.encode(value)
+                    elif value is not None and kind == 'string':
+                        value = str(value)
+                    data[name].append(value)
+                data[meta.geo_field].append(bytes(geometry) if geometry else None)
+            writer.write_table(pyarrow.Table.from_pydict(data, schema=schema))
+    finally:
+        writer.close()
+
+
+# FlatGeobuf
+
+FGB_MAGIC = b'fgb\x03fgb\x00'
+FGB_NODE_SIZE = 16
+FGB_GEOMETRY_TYPES = {'Point': 1, 'MultiPoint': 4}
+FGB_COLUMN_TYPES = {'bool': 2, 'int': 5, 'long': 7, 'double': 10, 'string': 11, 'json': 12, 'datetime': 13, 'date': 13}
+FGB_NODE = np.dtype([('min_x', '<f8'), ('min_y', '<f8'), ('max_x', '<f8'), ('max_y', '<f8'), ('offset', '<u8')])
+
+_SCALARS = {'bool': '<B', 'ubyte': '<B', 'ushort': '<H', 'int': '<i', 'uint': '<I', 'ulong': '<Q', 'double': '<d'}
+
+
+class flatBuilder(object):
+    """
+    Minimal forward FlatBuffers writer: every vtable precedes its table, strings, vectors
+    and sub tables follow the table referencing them so that all uoffsets point forward.
+    Table fields are (slot, kind, value) with kind a scalar type, 'string', 'table',
+    'vector:<scalar type>' or 'vector:table'; None values are left out
+    """
+
+    def __init__(self):
+        self.buf = bytearray(4)
+
+    def pad(self, alignment, extra=0):
+        self.buf.extend(bytes(-(len(self.buf) + extra) % alignment))
+
+    def finish(self, fields):
+        struct.pack_into('<I', self.buf, 0, self.table(fields))
+        return bytes(self.buf)
+
+    def inline_size(self, kind):
+        return struct.calcsize(_SCALARS[kind]) if kind in _SCALARS else 4
+
+    def table(self, fields):
+        fields = [field for field in fields if field[2] is not None]
+        layout, size = {}, 4
+        for slot, kind, value in sorted(fields, key=lambda field: -self.inline_size(field[1])):
+            width = self.inline_size(kind)
+            size += -size % width
+            layout[slot] = size
+            size += width
+        slots = max([slot for slot, kind, value in fields] + [-1]) + 1
+        self.pad(2)
+        vtable = len(self.buf)
+        self.buf += struct.pack('<HH', 4 + 2 * slots, size)
+        self.buf += b''.join(struct.pack('<H', layout.get(slot, 0)) for slot in range(slots))
+        self.pad(max([4] + [self.inline_size(kind) for slot, kind, value in fields]))
+        start = len(self.buf)
+        self.buf += bytes(size)
+        struct.pack_into('<i', self.buf, start, start - vtable)
+        for slot, kind, value in fields:
+            position = start + layout[slot]
+            if kind in _SCALARS:
+                struct.pack_into(_SCALARS[kind], self.buf, position, value)
+            else:
+                struct.pack_into('<I', self.buf, position, self.child(kind, value) - position)
+        return start
+
+    def child(self, kind, value):
+        if kind == 'table':
+            return self.table(value)
+        if kind == 'string':
+            data = value.encode('utf-8')
+            self.pad(4)
+            start = len(self.buf)
+            self.buf += struct.pack('<I', len(data)) + data + b'\0'
+            return start
+        element = kind.split(':')[1]
+        if element == 'table':
+            self.pad(4)
+            start = len(self.buf)
+            self.buf += struct.pack('<I', len(value)) + bytes(4 * len(value))
+            for index, fields in enumerate(value):
+                item = start + 4 + 4 * index
+                struct.pack_into('<I', self.buf, item, self.table(fields) - item)
+            return start
+        data = np.asarray(value, dtype=_SCALARS[element]).tobytes()
+        self.pad(max(4, struct.calcsize(_SCALARS[element])), extra=4)
+        start = len(self.buf)
+        self.buf += struct.pack('<I', len(value)) + data
+        return start
+
+
+def _fgb_properties(columns, properties, encoder):
+    data = bytearray()
+    for index, (name, kind) in enumerate(columns):
+        value = properties[name]
+        if value is None:
+            continue
+        data += struct.pack('<H', index)
+        if kind in ('bool', 'int', 'long', 'double'):
+            data += struct.pack({'bool': '<B', 'int': '<i', 'long': '<q', 'double': '<d'}[kind], value)
+            continue
+        if kind == 'json':
+            text = encoder.encode(value)
+        elif kind in ('datetime', 'date'):
+            text = value.isoformat()
+        else:
+            text = str(value)
+        text = text.encode('utf-8')
+        data += struct.pack('<I', len(text)) + text
+    return data
+
+def hilbert(x, y):
+    """
+    position along the Hilbert curve of 16 bit integer coordinates (arrays)
+    """
+    x, y = np.asarray(x, dtype=np.uint64), np.asarray(y, dtype=np.uint64)
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> 2)) ^ (b & (b >> 2))
+    B = (a & (b >> 2)) ^ (b & ((a ^ b) >> 2))
+    C = C ^ ((a & (c >> 2)) ^ (b & (d >> 2)))
+    D = D ^ ((b & (c >> 2)) ^ ((a ^ b) & (d >> 2)))
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> 4)) ^ (b & (b >> 4))
+    B = (a & (b >> 4)) ^ (b & ((a ^ b) >> 4))
+    C = C ^ ((a & (c >> 4)) ^ (b & (d >> 4)))
+    D = D ^ ((b & (c >> 4)) ^ ((a ^ b) & (d >> 4)))
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+    def spread(i):
+        i = (i | (i << 8)) & 0x00FF00FF
+        i = (i | (i << 4)) & 0x0F0F0F0F
+        i = (i | (i << 2)) & 0x33333333
+        return (i | (i << 1)) & 0x55555555
+    return (spread(i1) << 1) | spread(i0)
+
+def packed_rtree(bounds, offsets, node_size=FGB_NODE_SIZE):
+    """
+    FlatGeobuf packed Hilbert R-tree: root first, leaves (bounds, feature offsets) last
+    """
+    level_sizes = [len(bounds)]
+    while True:
+        level_sizes.append(-(-level_sizes[-1] // node_size))
+        if level_sizes[-1] == 1:
+            break
+    nodes = np.zeros(sum(level_sizes), dtype=FGB_NODE)
+    level_starts = []
+    end = len(nodes)
+    for size in level_sizes:
+        level_starts.append(end - size)
+        end -= size
+    leaves = nodes[level_starts[0]:]
+    for index, name in enumerate(('min_x', 'min_y', 'max_x', 'max_y')):
+        leaves[name] = bounds[:, index]
+    leaves['offset'] = offsets
+    for level in range(len(level_sizes) - 1):
+        start, size = level_starts[level], level_sizes[level]
+        children = nodes[start:start + size]
+        firsts = np.arange(0, size, node_size)
+        parents = nodes[level_starts[level + 1]:level_starts[level + 1] + level_sizes[level + 1]]
+        parents['min_x'] = np.minimum.reduceat(children['min_x'], firsts)
+        parents['min_y'] = np.minimum.reduceat(children['min_y'], firsts)
+        parents['max_x'] = np.maximum.reduceat(children['max_x'], firsts)
+        parents['max_y'] = np.maximum.reduceat(children['max_y'], firsts)
+        parents['offset'] = start + firsts
+    return nodes.tobytes()
+
+def write_flatgeobuf(output, serializer_class, queryset, request=None, chunk_size=2000):
+    """
+    writes a FlatGeobuf file with spatial index. Features are encoded chunk by chunk to a
+    temporary file, then copied in Hilbert order after the header and the index
+    """
+    meta = serializer_class.Meta
+    columns = export_columns(serializer_class)
+    geometry_type = geometry_type_name(serializer_class)
+    encoder = DjangoJSONEncoder()
+    with tempfile.TemporaryFile() as features:
+        positions, bounds = [], []
+        for records in iter_records(serializer_class, queryset, request, chunk_size, geometry_function=AsWKB):
+            for feature_id, geometry, properties in records:
+                properties['id'] = feature_id
+                points = np.array(_wkb_points(geometry) if geometry else [], dtype=float).reshape(-1, 2)
+                points = points[~np.isnan(points).any(axis=1)]
+                fields = [(1, 'vector:ubyte', _fgb_properties(columns, properties, encoder))]
+                if len(points):
+                    fields.append((0, 'table', [(1, 'vector:double', points.ravel())]))
+                    bounds.append(np.concatenate([points.min(axis=0), points.max(axis=0)]))
+                else:
+                    bounds.append((np.inf, np.inf, -np.inf, -np.inf))
+                buffer = flatBuilder().finish(fields)
+                positions.append(features.tell())
+                features.write(struct.pack('<I', len(buffer)) + buffer)
+        positions.append(features.tell())
+
+        count = len(bounds)
+        bounds = np.array(bounds, dtype=float).reshape(-1, 4)
+        positions = np.array(positions, dtype=np.int64)
+        sizes = np.diff(positions)
+        located = np.isfinite(bounds[:, 0])
+        envelope = None
+        if located.any():
+            envelope = [bounds[located, 0].min(), bounds[located, 1].min(), bounds[located, 2].max(), bounds[located, 3].max()]
+            width = max(envelope[2] - envelope[0], 1e-12)
+            height = max(envelope[3] - envelope[1], 1e-12)
+            finite = np.where(located[:, None], bounds, envelope)
+            center_x = (finite[:, 0] + finite[:, 2]) / 2
+            center_y = (finite[:, 1] + finite[:, 3]) / 2
+            keys = hilbert(np.floor(65535 * (center_x - envelope[0]) / width), np.floor(65535 * (center_y - envelope[1]) / height))
+            # features without geometry go last
+            order = np.lexsort((keys, ~located))
+        else:
+            order = np.arange(count)
+        offsets = np.concatenate([[0], np.cumsum(sizes[order])[:-1]]) if count else np.zeros(0)
+
+        header = flatBuilder().finish([
+            (0, 'string', meta.model._meta.model_name),
+            (1, 'vector:double', envelope),
+            (2, 'ubyte', FGB_GEOMETRY_TYPES[geometry_type]),
+            (7, 'vector:table', [[(0, 'string', name), (1, 'ubyte', FGB_COLUMN_TYPES[kind])] for name, kind in columns]),
+            (8, 'ulong', count),
+            (9, 'ushort', FGB_NODE_SIZE if count else 0),
+            (10, 'table', [(0, 'string', 'EPSG'), (1, 'int', 4326)]),
+        ])
+        output.write(FGB_MAGIC)
+        output.write(struct.pack('<I', len(header)) + header)
+        if count:
+            output.write(packed_rtree(bounds[order], offsets))
+        for index in order:
+            features.seek(positions[index])
+            output.write(features.read(sizes[index]))
+
+COLUMNAR_FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet', write_geoparquet),
+    'fgb': ('application/flatgeobuf', 'fgb', write_flatgeobuf),
+}
@@ -1,9 +1,13 @@
+import os
 import exifread
 import sys
 import math
+import struct
+import shutil
 import piexif
+from collections import namedtuple
 from datetime import datetime
-from PIL import Image
+from fractions import Fraction
 
 # based on https://gist.github.com/erans/983821
 
@@ -30,14 +34,16 @@ def _convert_to_degress(value):
 
 def _convert_to_double(value):
     """
-    Helper function to convert the GPS coordinates stored in the EXIF to degress in float format
+    Helper function to convert the first value of an EXIF tag to float
 
     :param value:
-    :type value: exifread.utils.Ratio
+    :type value: exifread.classes.IfdTag or _header_tag, with RATIONAL (num/den) or integer values
     :rtype: float
     """
-    print ("EXIT VALUE",value, file=sys.stderr)
-    return float(value.values[0].num) / float(value.values[0].den)
+    first = value.values[0]
+    if hasattr(first, 'num'):
+        return float(first.num) / float(first.den)
+    return float(first)
 
 def _convert_to_date(value):
     return datetime.strptime(str(value), '%Y:%m:%d  %H:%M:%S')
@@ -65,11 +71,6 @@ def get_exif_values(exif_data):
     original_date_time = _get_if_exist(exif_data, 'EXIF DateTimeOriginal')
     digitized_date_time = _get_if_exist(exif_data, 'EXIF DateTimeDigitized')
 
-    print ("sensor_pixel_width",sensor_pixel_width, file=sys.stderr)
-    print ("focal_plane_x_res",focal_plane_x_res, file=sys.stderr)
-    print ("focal_plane_res_unit",focal_plane_res_unit, file=sys.stderr)
-    print ("focal_length",sensor_pixel_width, file=sys.stderr)
-
     if gps_latitude and gps_latitude_ref and gps_longitude and gps_longitude_ref:
         lat = _convert_to_degress(gps_latitude)
         if gps_latitude_ref.values[0] != 'N':
@@ -114,15 +115,228 @@ def get_exif_values(exif_data):
 
     if sensor_pixel_width and focal_plane_x_res and focal_length:
         sensor_dim = _convert_to_double(sensor_pixel_width) / _convert_to_double(focal_plane_x_res)
-        fov =  2 * atan( (sensor_dim/2) / _convert_to_double(focal_length))
+        fov =  2 * math.atan( (sensor_dim/2) / _convert_to_double(focal_length))
     else:
         fov = None
 
-    return lat, lon, altitude, track or img_direction, gps_pitch, gps_roll, fov, camera_maker, camera_model, shot_time
+    if camera_maker:
+        camera_maker = camera_maker.printable.strip()
+
+    if camera_model:
+        camera_model = camera_model.printable.strip()
+
+    return lat, lon, altitude, track or img_direction, pitch, roll, fov, camera_maker, camera_model, shot_time
+
+def read_exif_file(img_path):
+    """
+    Returns get_exif_values() of the image at img_path. Plain values only so it can run in a process pool
+    """
+    with open(img_path, 'rb') as img_file:
+        exiftags = read_exif_header(img_file)
+    return get_exif_values(exiftags)
+
+# header-only EXIF access: only the APP1 segment of the JPEG is read (or patched),
+# image data after the SOS marker is never touched
+
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+GPS_IMG_DIRECTION = 0x11
+
+HEADER_TAGS = {
+    'Image': {
+        0x010F: 'Make',
+        0x0110: 'Model',
+    },
+    'EXIF': {
+        0x9003: 'DateTimeOriginal',
+        0x9004: 'DateTimeDigitized',
+        0x920A: 'FocalLength',
+        0xA002: 'PixelXDimension',
+        0xA20E: 'FocalPlaneXResolution',
+        0xA210: 'FocalPlaneResolutionUnit',
+    },
+    'GPS': {
+        0x01: 'GPSLatitudeRef',
+        0x02: 'GPSLatitude',
+        0x03: 'GPSLongitudeRef',
+        0x04: 'GPSLongitude',
+        0x06: 'GPSAltitude',
+        0x0F: 'GPSTrack',
+        GPS_IMG_DIRECTION: 'GPSImgDirection',
+    },
+}
+
+# TIFF field type: (struct format, size)
+_TIFF_TYPES = {
+    1: ('B', 1),
+    2: ('s', 1),
+    3: ('H', 2),
+    4: ('I', 4),
+    5: ('II', 8),
+    7: ('B', 1),
+    8: ('h', 2),
+    9: ('i', 4),
+    10: ('ii', 8),
+}
+
+_ratio = namedtuple('ratio', 'num den')
+
+class _header_tag(object):
+    """
+    minimal stand-in of exifread.classes.IfdTag (values and printable) as expected by get_exif_values
+    """
+    def __init__(self, values, printable):
+        self.values = values
+        self.printable = printable
+
+    def __str__(self):
+        return self.printable
+
+def _decode_value(tiff, offset, field_type, count, endian):
+    fmt, size = _TIFF_TYPES[field_type]
+    raw = tiff[offset:offset+size*count]
+    if field_type == 2:
+        printable = raw.split(b'\x00')[0].decode('ascii', 'replace')
+        return _header_tag(printable, printable)
+    if field_type in (5, 10):
+        flat = struct.unpack(endian + fmt[0]*(2*count), raw)
+        values = [_ratio(flat[i], flat[i+1]) for i in range(0, len(flat), 2)]
+        printable = ', '.join('%d/%d' % value for value in values)
+    else:
+        values = list(struct.unpack(endian + fmt*count, raw))
+        printable = ', '.join(str(value) for value in values)
+    return _header_tag(values, printable)
+
+def _find_exif_segment(img_file):
+    """
+    walks the JPEG marker segments up to the first Exif APP1 segment.
+    Returns (file offset of the segment payload, payload) or (None, None)
+    """
+    img_file.seek(0)
+    if img_file.read(2) != b'\xff\xd8':
+        return None, None
+    while True:
+        marker = img_file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None, None
+        while marker[1] == 0xFF:
+            marker = marker[1:] + img_file.read(1)
+        if marker[1] in (0xD9, 0xDA):
+            return None, None
+        if 0xD0 <= marker[1] <= 0xD7 or marker[1] == 0x01:
+            continue
+        length = struct.unpack('>H', img_file.read(2))[0]
+        if marker[1] == 0xE1:
+            offset = img_file.tell()
+            payload = img_file.read(length - 2)
+            if payload.startswith(b'Exif\x00\x00'):
+                return offset, payload
+        else:
+            img_file.seek(length - 2, 1)
+
+def _parse_ifd(tiff, offset, endian, group, tags, positions):
+    wanted = HEADER_TAGS[group]
+    pointers = {}
+    entries = struct.unpack(endian + 'H', tiff[offset:offset+2])[0]
+    for i in range(entries):
+        entry = offset + 2 + i*12
+        tag, field_type, count = struct.unpack(endian + 'HHI', tiff[entry:entry+8])
+        if tag in (EXIF_IFD_POINTER, GPS_IFD_POINTER):
+            pointers[tag] = struct.unpack(endian + 'I', tiff[entry+8:entry+12])[0]
+        elif tag in wanted and field_type in _TIFF_TYPES:
+            size = _TIFF_TYPES[field_type][1] * count
+            value_offset = entry + 8 if size <= 4 else struct.unpack(endian + 'I', tiff[entry+8:entry+12])[0]
+            tags[group + ' ' + wanted[tag]] = _decode_value(tiff, value_offset, field_type, count, endian)
+            positions[(group, tag)] = (value_offset, field_type, count)
+    return pointers
+
+def _parse_exif_header(img_file):
+    """
+    Returns a dict with the Exif APP1 segment location, the byte order and, for every
+    HEADER_TAGS tag found, the decoded value (tags) and its offset in the TIFF block (positions)
+    """
+    segment_offset, payload = _find_exif_segment(img_file)
+    if payload is None:
+        return None
+    tiff = payload[6:]
+    endian = '<' if tiff[:2] == b'II' else '>'
+    header = {'offset': segment_offset, 'payload': payload, 'endian': endian, 'tags': {}, 'positions': {}}
+    try:
+        ifd0 = struct.unpack(endian + 'I', tiff[4:8])[0]
+        pointers = _parse_ifd(tiff, ifd0, endian, 'Image', header['tags'], header['positions'])
+        if EXIF_IFD_POINTER in pointers:
+            _parse_ifd(tiff, pointers[EXIF_IFD_POINTER], endian, 'EXIF', header['tags'], header['positions'])
+        if GPS_IFD_POINTER in pointers:
+            _parse_ifd(tiff, pointers[GPS_IFD_POINTER], endian, 'GPS', header['tags'], header['positions'])
+    except struct.error:
+        # truncated header: the tags decoded so far are kept
+        pass
+    return header
+
+def read_exif_header(img_file):
+    """
+    exifread.process_file(details=False) replacement limited to HEADER_TAGS: only the
+    JPEG segments preceding the Exif APP1 are read. Non JPEG files are handed to exifread
+    """
+    img_file.seek(0)
+    if img_file.read(2) != b'\xff\xd8':
+        img_file.seek(0)
+        return exifread.process_file(img_file, details=False)
+    header = _parse_exif_header(img_file)
+    return header['tags'] if header else {}
+
+def _to_rational(value):
+    fraction = Fraction(value).limit_denominator(10000)
+    return fraction.numerator, fraction.denominator
+
+def patch_gps_rational(img_path, tag, value):
+    """
+    Sets a single valued GPS RATIONAL tag of a JPEG file. When the tag already exists
+    its 8 bytes are overwritten in place, otherwise only the APP1 segment is rebuilt
+    """
+    with open(img_path, 'r+b') as img_file:
+        header = _parse_exif_header(img_file)
+        if header and header['positions'].get(('GPS', tag), (None, None, None))[1:] == (5, 1):
+            value_offset = header['positions'][('GPS', tag)][0]
+            img_file.seek(header['offset'] + 6 + value_offset)
+            img_file.write(struct.pack(header['endian'] + 'II', *_to_rational(value)))
+            return
+
+    def update(exif_dict):
+        exif_dict['GPS'][tag] = _to_rational(value)
+    rewrite_exif_segment(img_path, update)
+
+def rewrite_exif_segment(img_path, update):
+    """
+    Rebuilds the Exif APP1 segment with piexif after update(exif_dict). Pixel data is
+    streamed unchanged to the rewritten file (or left in place when the segment size is unchanged)
+    """
+    with open(img_path, 'rb') as img_file:
+        segment_offset, payload = _find_exif_segment(img_file)
+    if payload is None:
+        exif_dict = {'0th': {}, 'Exif': {}, 'GPS': {}, '1st': {}, 'thumbnail': None}
+        start = end = 2
+    else:
+        exif_dict = piexif.load(payload)
+        start = segment_offset - 4
+        end = segment_offset + len(payload)
+    update(exif_dict)
+    new_payload = piexif.dump(exif_dict)
+    segment = b'\xff\xe1' + struct.pack('>H', len(new_payload) + 2) + new_payload
+
+    if end - start == len(segment):
+        with open(img_path, 'r+b') as img_file:
+            img_file.seek(start)
+            img_file.write(segment)
+        return
+
+    tmp_path = img_path + '.exif_tmp'
+    with open(img_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        dst.write(src.read(start))
+        dst.write(segment)
+        src.seek(end)
+        shutil.copyfileobj(src, dst, 1024*1024)
+    os.replace(tmp_path, img_path)
 
 def set_heading_tag(img_file,heading):
-    img = Image.open(img_file)
-    exif_dict = piexif.load(img.info['exif'])
-    exif_dict['GPS'][piexif.GPSIFD.GPSImgDirection] = heading.as_integer_ratio()
-    exif_bytes = piexif.dump(exif_dict)
-    img.save(img_file, "jpeg", exif=exif_bytes) #assuming file format is JPEG
+    patch_gps_rational(img_file, GPS_IMG_DIRECTION, heading % 360)
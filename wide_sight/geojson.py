@@ -0,0 +1,160 @@
+import csv
+from itertools import islice
+
+from django.contrib.gis.db.models.functions import AsGeoJSON, AsWKT
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.db.models import F
+
+from .renditions import rendition_urls
+from .media import with_apikey
+
+# streaming alternative to GeoFeatureModelSerializer: features are built from .values()
+# rows with the geometry already encoded as GeoJSON by the database, no model instance
+# and no serializer field is created per row
+
+RELATED_FIELDS = {
+    'creator_name': {
+        'panoramas': 'sequence__creator_key__user__username',
+        'image_objects': 'creator_key__user__username',
+        'sequences': 'creator_key__user__username',
+    }
+}
+
+# serializer method fields computed from the row id
+COMPUTED_FIELDS = {
+    'renditions': {
+        'panoramas': rendition_urls,
+    }
+}
+
+def _computed_fields(model, names):
+    return {name: COMPUTED_FIELDS[name][model._meta.model_name] for name in names
+            if name in COMPUTED_FIELDS and model._meta.model_name in COMPUTED_FIELDS[name]}
+
+def _related_fields(model, names):
+    related = {}
+    for name in names:
+        if name in RELATED_FIELDS and model._meta.model_name in RELATED_FIELDS[name]:
+            related[name] = RELATED_FIELDS[name][model._meta.model_name]
+    return related
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+def iter_records(serializer_class, queryset, request=None, chunk_size=2000, geometry_function=AsGeoJSON):
+    """
+    yields lists of (id, encoded geometry or None, properties dict) with the same fields
+    of serializer_class (a GeoFeatureModelSerializer) for every row of queryset
+    """
+    meta = serializer_class.Meta
+    model = meta.model
+    geo_field = meta.geo_field
+    write_only = [name for name, options in getattr(meta, 'extra_kwargs', {}).items() if options.get('write_only')]
+    names = [name for name in meta.fields if name != geo_field and name not in write_only]
+    related = _related_fields(model, names)
+    computed = _computed_fields(model, names)
+    model_fields = [model._meta.get_field(name) for name in names if name not in related and name not in computed]
+    m2m_fields = [field for field in model_fields if field.many_to_many]
+    file_fields = [field for field in model_fields if isinstance(field, models.FileField)]
+    columns = [name for name in names if name not in [field.name for field in m2m_fields] and name not in computed]
+
+    queryset = queryset.prefetch_related(None).annotate(ws_geometry=geometry_function(geo_field), **{name: F(path) for name, path in related.items()})
+    rows = queryset.values(*columns + ['ws_geometry']).iterator(chunk_size=chunk_size)
+    for batch in _batches(rows, chunk_size):
+        m2m_values = {}
+        for field in m2m_fields:
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            links = field.remote_field.through.objects.filter(**{source + '__in': [row['id'] for row in batch]})
+            values = {}
+            for source_id, target_id in links.values_list(source, target):
+                values.setdefault(source_id, []).append(target_id)
+            m2m_values[field.name] = values
+
+        records = []
+        for row in batch:
+            geometry = row.pop('ws_geometry') or None
+            for field in file_fields:
+                if row[field.name]:
+                    url = field.storage.url(row[field.name])
+                    row[field.name] = with_apikey(request.build_absolute_uri(url), request) if request else url
+                else:
+                    row[field.name] = None
+            for name, values in m2m_values.items():
+                row[name] = values.get(row['id'], [])
+            for name, function in computed.items():
+                row[name] = function(row['id'], request)
+            records.append((row.pop('id'), geometry, row))
+        yield records
+
+def _feature(encoder, feature_id, geometry, properties):
+    return '{"type": "Feature", "id": %s, "geometry": %s, "properties": %s}' % (
+        encoder.encode(feature_id), geometry or 'null', encoder.encode(properties))
+
+def iter_features(serializer_class, queryset, request=None, chunk_size=2000):
+    """
+    yields comma separated GeoJSON feature strings, a chunk at a time
+    """
+    encoder = DjangoJSONEncoder()
+    for records in iter_records(serializer_class, queryset, request, chunk_size):
+        yield ', '.join(_feature(encoder, *record) for record in records)
+
+def iter_feature_collection(serializer_class, queryset, request=None, chunk_size=2000):
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for chunk in iter_features(serializer_class, queryset, request, chunk_size):
+        yield separator + chunk
+        separator = ', '
+    yield ']}'
+
+
+class _echo(object):
+    def write(self, value):
+        return value
+
+def iter_feature_lines(serializer_class, queryset, request=None, chunk_size=2000, separator=''):
+    """
+    one GeoJSON feature per line: NDJSON, or GeoJSONSeq (RFC 8142) with separator RS
+    """
+    encoder = DjangoJSONEncoder()
+    for records in iter_records(serializer_class, queryset, request, chunk_size):
+        yield ''.join('%s%s\n' % (separator, _feature(encoder, *record)) for record in records)
+
+def iter_feature_seq(serializer_class, queryset, request=None, chunk_size=2000):
+    return iter_feature_lines(serializer_class, queryset, request, chunk_size, separator='\x1e')
+
+def iter_csv(serializer_class, queryset, request=None, chunk_size=2000):
+    """
+    CSV rows with the serializer fields and the geometry as WKT in the last column
+    """
+    meta = serializer_class.Meta
+    write_only = [name for name, options in getattr(meta, 'extra_kwargs', {}).items() if options.get('write_only')]
+    header = [name for name in meta.fields if name != meta.geo_field and name not in write_only] + [meta.geo_field]
+    writer = csv.writer(_echo())
+    yield writer.writerow(header)
+    for records in iter_records(serializer_class, queryset, request, chunk_size, geometry_function=AsWKT):
+        lines = []
+        for feature_id, geometry, properties in records:
+            properties['id'] = feature_id
+            properties[meta.geo_field] = geometry
+            lines.append(writer.writerow([
+                ' '.join(str(value) for value in properties[name]) if isinstance(properties[name], list) else properties[name]
+                for name in header
+            ]))
+        yield ''.join(lines)
+
+EXPORT_FORMATS = {
+    'geojsonseq': ('application/geo+json-seq', 'geojsons', iter_feature_seq),
+    'ndjson': ('application/x-ndjson', 'ndjson', iter_feature_lines),
+    'csv': ('text/csv', 'csv', iter_csv),
+}
+
+def iter_export(export_format, serializer_class, queryset, request=None, chunk_size=2000):
+    """
+    streams queryset in export_format (a key of EXPORT_FORMATS) with constant memory
+    """
+    return EXPORT_FORMATS[export_format][2](serializer_class, queryset, request, chunk_size)
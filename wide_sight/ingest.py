@@ -0,0 +1,128 @@
+import os
+import uuid
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+
+import numpy as np
+from django.contrib.gis.geos import Point
+
+from .exif_gps import read_exif_file, read_exif_header, get_exif_values
+from .storage import local_path
+from .utils import utm_from_lonlat_arrays
+from .models import panoramas, update_sequence, bump_change_counter
+from .navigation import rebuild_sequence_navigation
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+# EXIF parsing processes of a bulk load, only started by background jobs
+INGEST_WORKERS = getattr(settings, 'WS_INGEST_WORKERS', min(4, os.cpu_count() or 1))
+
+def iter_archive(archive):
+    """
+    yields (filename, file object) for every jpeg image of a zip or tar uploaded archive
+    """
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    with zf.open(info) as member:
+                        yield os.path.basename(info.filename), member
+    else:
+        archive.seek(0)
+        with tarfile.open(fileobj=archive, mode='r:*') as tf:
+            for info in tf:
+                if info.isfile() and info.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.basename(info.name), tf.extractfile(info)
+
+def store_upload(seq, filename, fileobj):
+    """
+    writes an uploaded image to the panorama storage and returns an unsaved panorama pointing to it
+    """
+    pano = panoramas(id=uuid.uuid4(), sequence=seq)
+    pano.eqimage.name = pano.eqimage.storage.save(upload_name(pano, filename), File(fileobj, name=filename))
+    return pano
+
+def upload_name(pano, filename):
+    """
+    the panoramas.upload_img name, without creating its directory: storages make the directories they write to
+    """
+    return '/'.join(('panos', str(pano.sequence_id), str(pano.id) + os.path.splitext(filename)[1]))
+
+def store_uploads(seq, uploads):
+    """
+    stores every (filename, file object) upload, removing the already written files on failure
+    """
+    new_panos = []
+    try:
+        for filename, fileobj in uploads:
+            new_panos.append(store_upload(seq, filename, fileobj))
+    except Exception:
+        remove_stored(new_panos)
+        raise
+    return new_panos
+
+def remove_stored(new_panos):
+    for pano in new_panos:
+        pano.eqimage.storage.delete(pano.eqimage.name)
+
+def set_locations(new_panos):
+    """
+    geometry and UTM fields of located panoramas, projected in a single vectorized pass
+    """
+    located = [pano for pano in new_panos if pano.lon is not None and pano.lat is not None]
+    if not located:
+        return
+    lons = np.array([pano.lon for pano in located])
+    lats = np.array([pano.lat for pano in located])
+    for pano, x, y, zone, letter, srid in zip(located, *utm_from_lonlat_arrays(lons, lats)):
+        pano.geom = Point(pano.lon, pano.lat)
+        pano.utm_x, pano.utm_y = float(x), float(y)
+        pano.utm_code = '%d%s' % (zone, letter)
+        pano.utm_srid = int(srid)
+
+def load_panoramas(seq, new_panos, workers=INGEST_WORKERS, batch_size=500):
+    """
+    EXIF tags of already stored panoramas are parsed, in a pool of `workers` processes
+    when more than one, rows are written with bulk_create and the sequence geometry
+    and navigation links are rebuilt once.
+    """
+    try:
+        img_paths = [local_path(pano.eqimage) for pano in new_panos]
+        if workers > 1 and all(img_paths):
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                exif_values = list(pool.map(read_exif_file, img_paths, chunksize=max(1, len(img_paths)//(workers*4))))
+        else:
+            # single worker or remote storage: headers are read through the storage in this process
+            exif_values = []
+            for pano in new_panos:
+                with pano.eqimage.open('rb') as img_file:
+                    exif_values.append(get_exif_values(read_exif_header(img_file)))
+
+        for pano, values in zip(new_panos, exif_values):
+            pano.lat, pano.lon, pano.elevation, pano.heading, pano.pitch, pano.roll, pano.fov, pano.camera_prod, pano.camera_model, shooting_time = values
+            if shooting_time:
+                pano.shooting_time = shooting_time
+        set_locations(new_panos)
+
+        with transaction.atomic():
+            panoramas.objects.bulk_create(new_panos, batch_size=batch_size)
+            update_sequence(seq)
+            rebuild_sequence_navigation(seq)
+        bump_change_counter('panoramas')
+    except Exception:
+        remove_stored(new_panos)
+        raise
+
+    return new_panos
+
+def ingest_panoramas(seq, uploads, workers=1, batch_size=500):
+    """
+    Bulk load of (filename, file object) uploads into sequence seq. It runs inside the
+    request, so EXIF tags are read in this process unless workers says otherwise
+    """
+    return load_panoramas(seq, store_uploads(seq, uploads), workers=workers, batch_size=batch_size)
@@ -0,0 +1,106 @@
+import io
+import os
+import time
+import shutil
+import resource
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import exifread
+import piexif
+from PIL import Image
+from django.core.management.base import BaseCommand
+
+from wide_sight.exif_gps import read_exif_header, set_heading_tag
+
+
+class counting_reader(io.FileIO):
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super(counting_reader, self).read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        count = super(counting_reader, self).readinto(buffer)
+        self.bytes_read += count or 0
+        return count
+
+
+def exifread_full(img_path):
+    with counting_reader(img_path) as f:
+        exifread.process_file(f)
+        return f.bytes_read
+
+def exifread_details_off(img_path):
+    with counting_reader(img_path) as f:
+        exifread.process_file(f, details=False)
+        return f.bytes_read
+
+def header_only(img_path):
+    with counting_reader(img_path) as f:
+        read_exif_header(f)
+        return f.bytes_read
+
+def pil_heading_rewrite(img_path):
+    # previous set_heading_tag implementation: full decode and re-encode
+    img = Image.open(img_path)
+    exif_dict = piexif.load(img.info['exif'])
+    exif_dict['GPS'][piexif.GPSIFD.GPSImgDirection] = (12345, 100)
+    img.save(img_path, "jpeg", exif=piexif.dump(exif_dict))
+    return os.path.getsize(img_path)
+
+def patch_heading(img_path):
+    set_heading_tag(img_path, 123.45)
+    return None
+
+def measure(case, img_path):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    bytes_read = case(img_path)
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return bytes_read, elapsed, rss_after - rss_before
+
+
+class Command(BaseCommand):
+    help = 'Compare bytes read, time and peak RSS growth of EXIF reading/writing strategies on a large panorama'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--image', help='jpeg panorama with GPS EXIF tags (default: synthetic 8192x4096 image)')
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp()
+        try:
+            img_path = options['image'] or self.synthetic_image(workdir)
+            self.stdout.write('%s (%d bytes)' % (img_path, os.path.getsize(img_path)))
+            self.stdout.write('%-24s %14s %10s %14s' % ('case', 'bytes read', 'ms', 'RSS delta KB'))
+            for case in (exifread_full, exifread_details_off, header_only, pil_heading_rewrite, patch_heading):
+                case_path = os.path.join(workdir, 'case.jpg')
+                shutil.copy(img_path, case_path)
+                # each case runs in a fresh worker process so peak RSS is not shared
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    bytes_read, elapsed, rss_delta = pool.submit(measure, case, case_path).result()
+                self.stdout.write('%-24s %14s %10.1f %14d' % (case.__name__, bytes_read if bytes_read is not None else '-', elapsed*1000, rss_delta))
+        finally:
+            shutil.rmtree(workdir)
+
+    def synthetic_image(self, workdir):
+        img_path = os.path.join(workdir, 'synthetic.jpg')
+        exif_dict = {
+            '0th': {piexif.ImageIFD.Make: b'bench', piexif.ImageIFD.Model: b'bench'},
+            'Exif': {piexif.ExifIFD.DateTimeOriginal: b'2018:01:01 00:00:00'},
+            'GPS': {
+                piexif.GPSIFD.GPSLatitudeRef: b'N',
+                piexif.GPSIFD.GPSLatitude: ((45, 1), (24, 1), (0, 1)),
+                piexif.GPSIFD.GPSLongitudeRef: b'E',
+                piexif.GPSIFD.GPSLongitude: ((11, 1), (52, 1), (0, 1)),
+                piexif.GPSIFD.GPSImgDirection: (0, 1),
+            },
+            '1st': {},
+            'thumbnail': None,
+        }
+        noise = Image.frombytes('L', (8192, 4096), os.urandom(8192*4096)).convert('RGB')
+        noise.save(img_path, 'jpeg', quality=90, exif=piexif.dump(exif_dict))
+        return img_path
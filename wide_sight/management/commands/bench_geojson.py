@@ -0,0 +1,58 @@
+import time
+import datetime
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from wide_sight.models import sequences, panoramas, userkeys
+from wide_sight.serializers import panoramas_geo_serializer
+from wide_sight.geojson import iter_feature_collection
+
+
+def drf_serializer(queryset):
+    return len(JSONRenderer().render(panoramas_geo_serializer(queryset, many=True).data))
+
+def values_stream(queryset):
+    return sum(len(chunk) for chunk in iter_feature_collection(panoramas_geo_serializer, queryset))
+
+
+class Command(BaseCommand):
+    help = 'Compare rows/second and peak memory of panoramas_geo_serializer and the streaming GeoJSON writer (runs in a rolled back transaction)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated row counts')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        with transaction.atomic():
+            self.run(sizes)
+            transaction.set_rollback(True)
+
+    def run(self, sizes):
+        user = User.objects.create(username='bench_geojson')
+        seq = sequences.objects.create(title='bench', creator_key=userkeys.objects.create(user=user))
+        start_time = datetime.datetime(2018, 1, 1)
+
+        self.stdout.write('%10s %-16s %12s %14s %12s' % ('rows', 'serializer', 'rows/s', 'peak memory KB', 'bytes'))
+        created = 0
+        for size in sizes:
+            new_panos = []
+            for i in range(created, size):
+                pano = panoramas(sequence=seq, eqimage='panos/bench/%d.jpg' % i, lon=11.87 + i * 0.00001, lat=45.40, shooting_time=start_time + datetime.timedelta(seconds=i))
+                pano.update_location()
+                new_panos.append(pano)
+            panoramas.objects.bulk_create(new_panos, batch_size=1000)
+            created = max(created, size)
+
+            queryset = panoramas.objects.filter(sequence=seq)
+            for case in (drf_serializer, values_stream):
+                tracemalloc.start()
+                start = time.perf_counter()
+                length = case(queryset)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.stdout.write('%10d %-16s %12.0f %14d %12d' % (size, case.__name__, size / elapsed, peak // 1024, length))
@@ -0,0 +1,53 @@
+import time
+import datetime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from wide_sight.models import sequences, panoramas, userkeys, update_sequence, deferred_sequence_update
+
+
+class Command(BaseCommand):
+    help = 'Measure per-insert cost of sequence geometry maintenance as a sequence grows (runs in a rolled back transaction)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=5000, help='final number of panoramas in the sequence')
+        parser.add_argument('--step', type=int, default=500, help='number of inserts measured for each report line')
+        parser.add_argument('--mode', choices=('incremental', 'rebuild', 'deferred'), default='incremental')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options['size'], options['step'], options['mode'])
+            transaction.set_rollback(True)
+
+    def run(self, size, step, mode):
+        user = User.objects.create(username='bench_sequence_geometry')
+        userkey = userkeys.objects.create(user=user)
+        seq = sequences.objects.create(title='bench', creator_key=userkey)
+        start_time = datetime.datetime(2018, 1, 1)
+
+        self.stdout.write('%10s %16s' % ('panoramas', 'ms per insert'))
+        total_start = time.perf_counter()
+        for first in range(0, size, step):
+            batch_start = time.perf_counter()
+            if mode == 'deferred':
+                with deferred_sequence_update():
+                    self.insert(seq, first, step, start_time)
+            else:
+                self.insert(seq, first, step, start_time, rebuild=(mode == 'rebuild'))
+            elapsed = time.perf_counter() - batch_start
+            self.stdout.write('%10d %16.3f' % (first + step, elapsed * 1000 / step))
+        self.stdout.write('total %.2fs' % (time.perf_counter() - total_start))
+
+    def insert(self, seq, first, count, start_time, rebuild=False):
+        for i in range(first, first + count):
+            pano = panoramas(
+                sequence=seq,
+                lon=11.87 + i * 0.00001,
+                lat=45.40 + i * 0.00001,
+                shooting_time=start_time + datetime.timedelta(seconds=i),
+            )
+            pano.save()
+            if rebuild:
+                update_sequence(seq)
@@ -0,0 +1,36 @@
+import time
+
+import numpy as np
+import utm
+from django.core.management.base import BaseCommand
+
+from wide_sight.utils import get_utm_srid_from_lonlat, utm_from_lonlat_arrays
+
+
+class Command(BaseCommand):
+    help = 'Compare the scalar per-row UTM projection with utm_from_lonlat_arrays'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated point counts')
+
+    def handle(self, *args, **options):
+        random = np.random.RandomState(0)
+        self.stdout.write('%10s %14s %14s %16s' % ('points', 'scalar pts/s', 'arrays pts/s', 'max diff m'))
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            lons = random.uniform(-180, 180, size)
+            lats = random.uniform(-80, 84, size)
+
+            start = time.perf_counter()
+            scalar = []
+            for lon, lat in zip(lons.tolist(), lats.tolist()):
+                get_utm_srid_from_lonlat(lon, lat)
+                scalar.append(utm.from_latlon(lat, lon)[:2])
+            scalar_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            easting, northing, zone, letter, srid = utm_from_lonlat_arrays(lons, lats)
+            arrays_elapsed = time.perf_counter() - start
+
+            scalar = np.array(scalar)
+            max_diff = max(np.abs(scalar[:, 0] - easting).max(), np.abs(scalar[:, 1] - northing).max())
+            self.stdout.write('%10d %14.0f %14.0f %16.2e' % (size, size / scalar_elapsed, size / arrays_elapsed, max_diff))
@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wide_sight.models import panoramas
+from wide_sight.renditions import RENDITIONS, render_renditions, renditions_dir, build_renditions
+from wide_sight.storage import local_path
+
+
+class Command(BaseCommand):
+    help = 'Generate the missing image renditions of the panoramas (WS_RENDITIONS) in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sequence', action='append', default=[], help='sequence id (repeatable)')
+        parser.add_argument('--rendition', action='append', default=[], help='rendition name (repeatable, default all)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes')
+        parser.add_argument('--force', action='store_true', help='rewrite existing renditions')
+
+    def handle(self, *args, **options):
+        names = options['rendition'] or list(RENDITIONS)
+        unknown = set(names) - set(RENDITIONS)
+        if unknown:
+            raise CommandError('unknown renditions: %s' % ', '.join(sorted(unknown)))
+        queryset = panoramas.objects.all()
+        if options['sequence']:
+            queryset = queryset.filter(sequence__in=options['sequence'])
+
+        local, remote = [], []
+        for pano in queryset.only('id', 'eqimage').iterator():
+            path = local_path(pano.eqimage)
+            if path:
+                local.append((path, renditions_dir(pano.pk)))
+            else:
+                remote.append(pano)
+
+        written = 0
+        if local:
+            with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+                results = pool.map(render_renditions, *zip(*local), [names] * len(local), [options['force']] * len(local),
+                                   chunksize=max(1, len(local) // (options['workers'] * 4)))
+                for files in results:
+                    written += len(files)
+        # remote storage: images are read through the storage in this process
+        for pano in remote:
+            written += len(build_renditions(pano, names, options['force']))
+        self.stdout.write('%d renditions written for %d panoramas' % (written, len(local) + len(remote)))
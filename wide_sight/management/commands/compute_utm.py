@@ -0,0 +1,48 @@
+from itertools import islice
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from wide_sight.models import panoramas, image_objects, bump_change_counter
+from wide_sight.utils import utm_from_lonlat_arrays
+
+MODELS = {
+    'panoramas': panoramas,
+    'image_objects': image_objects,
+}
+
+
+class Command(BaseCommand):
+    help = 'Compute utm_x, utm_y, utm_code and utm_srid from lon/lat of whole tables, in vectorized chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', choices=sorted(MODELS), help='tables to process (default all)')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--missing', action='store_true', help='only rows without utm_srid')
+
+    def handle(self, *args, **options):
+        for name in options['models'] or sorted(MODELS):
+            count = self.backfill(MODELS[name], options['chunk_size'], options['missing'])
+            bump_change_counter(name)
+            self.stdout.write('%s: %d rows projected' % (name, count))
+
+    def backfill(self, model, chunk_size, missing):
+        queryset = model.objects.filter(lon__isnull=False, lat__isnull=False).order_by('pk')
+        if missing:
+            queryset = queryset.filter(utm_srid__isnull=True)
+        rows = queryset.values_list('pk', 'lon', 'lat').iterator(chunk_size=chunk_size)
+        count = 0
+        chunk = list(islice(rows, chunk_size))
+        while chunk:
+            pks, lons, lats = zip(*chunk)
+            easting, northing, zone, letter, srid = utm_from_lonlat_arrays(np.array(lons), np.array(lats))
+            objects = [
+                model(pk=pk, utm_x=float(x), utm_y=float(y), utm_code='%d%s' % (z, l), utm_srid=int(s))
+                for pk, x, y, z, l, s in zip(pks, easting, northing, zone, letter, srid)
+            ]
+            with transaction.atomic():
+                model.objects.bulk_update(objects, ['utm_x', 'utm_y', 'utm_code', 'utm_srid'], batch_size=chunk_size)
+            count += len(objects)
+            chunk = list(islice(rows, chunk_size))
+        return count
@@ -0,0 +1,73 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.core.serializers import sort_dependencies
+from django.db import connections, transaction
+
+from wide_sight.models import bump_change_counter
+
+# permissions and content types are created by migrate on every database with their own ids
+SKIPPED_MODELS = ('auth.Permission', 'contenttypes.ContentType', 'sessions.Session', 'admin.LogEntry')
+
+
+class Command(BaseCommand):
+    help = 'Copy all rows between two configured databases (e.g. spatialite -> default PostGIS) in bulk batches. The target must be migrated and empty'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='source database alias')
+        parser.add_argument('target', help='target database alias')
+        parser.add_argument('--app', action='append', default=[], help='app label (repeatable, default auth, authtoken, rest_framework_api_key, wide_sight)')
+        parser.add_argument('--batch-size', type=int, default=2000, help='rows per insert')
+
+    def handle(self, *args, **options):
+        source, target = options['source'], options['target']
+        for alias in (source, target):
+            if alias not in connections.databases:
+                raise CommandError('unknown database %s' % alias)
+        labels = options['app'] or ['auth', 'authtoken', 'rest_framework_api_key', 'wide_sight']
+        app_list = [(apps.get_app_config(label), None) for label in labels]
+        models = [model for model in sort_dependencies(app_list) if model._meta.label not in SKIPPED_MODELS]
+
+        tables = set(connections[target].introspection.table_names())
+        missing = [model._meta.db_table for model in models if model._meta.db_table not in tables]
+        if missing:
+            raise CommandError('tables missing on %s, run migrate --database %s first: %s' % (target, target, ', '.join(missing)))
+        filled = [model._meta.label for model in models if model._base_manager.using(target).exists()]
+        if filled:
+            raise CommandError('target database is not empty: %s' % ', '.join(filled))
+
+        copied = []
+        with transaction.atomic(using=target):
+            for model in models:
+                count = self.copy_model(model, source, target, options['batch_size'])
+                copied.append(model)
+                for field in model._meta.local_many_to_many:
+                    through = field.remote_field.through
+                    if through._meta.auto_created and field.related_model._meta.label not in SKIPPED_MODELS:
+                        count += self.copy_model(through, source, target, options['batch_size'])
+                        copied.append(through)
+                self.stdout.write('%s: %d rows' % (model._meta.label, count))
+
+            # explicit primary keys leave the PostgreSQL serial sequences behind
+            reset_sql = connections[target].ops.sequence_reset_sql(no_style(), copied)
+            if reset_sql:
+                with connections[target].cursor() as cursor:
+                    for sql in reset_sql:
+                        cursor.execute(sql)
+        bump_change_counter('sequences', 'panoramas', 'image_objects')
+
+    def copy_model(self, model, source, target, batch_size):
+        """
+        rows are read in primary key order, batch_size at a time, and inserted with
+        bulk_create: no save() or signal runs on the copied rows
+        """
+        queryset = model._base_manager.using(source).order_by('pk')
+        count = 0
+        last = None
+        while True:
+            batch = list((queryset if last is None else queryset.filter(pk__gt=last))[:batch_size])
+            if not batch:
+                return count
+            model._base_manager.using(target).bulk_create(batch, batch_size=batch_size)
+            count += len(batch)
+            last = batch[-1].pk
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from wide_sight.models import sequences, panoramas, image_objects
+from wide_sight.serializers import sequences_serializer, panoramas_geo_serializer, image_objects_geo_serializer
+from wide_sight.columnar import COLUMNAR_FORMATS, filter_export_queryset
+
+EXPORTS = {
+    'sequences': (sequences, sequences_serializer),
+    'panoramas': (panoramas, panoramas_geo_serializer),
+    'image_objects': (image_objects, image_objects_geo_serializer),
+}
+
+
+class Command(BaseCommand):
+    help = 'Export a table as GeoParquet or FlatGeobuf, read in chunks (parquet row groups), optionally filtered'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(EXPORTS))
+        parser.add_argument('output', help='output file')
+        parser.add_argument('--format', dest='export_format', choices=sorted(COLUMNAR_FORMATS), help='default from the output extension')
+        parser.add_argument('--sequence', action='append', default=[], help='sequence id (repeatable)')
+        parser.add_argument('--creator-key', help='userkey id of the creator')
+        parser.add_argument('--bbox', help='min_lon,min_lat,max_lon,max_lat')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='rows per chunk (parquet row group)')
+
+    def handle(self, *args, **options):
+        export_format = options['export_format'] or options['output'].rsplit('.', 1)[-1].lower()
+        if export_format not in COLUMNAR_FORMATS:
+            raise CommandError('unknown format %s: use --format %s' % (export_format, ' or '.join(sorted(COLUMNAR_FORMATS))))
+        try:
+            bbox = [float(value) for value in options['bbox'].split(',')] if options['bbox'] else None
+        except ValueError:
+            raise CommandError('bad bbox %s' % options['bbox'])
+        if bbox and len(bbox) != 4:
+            raise CommandError('bbox needs 4 values')
+
+        model, serializer_class = EXPORTS[options['model']]
+        queryset = filter_export_queryset(model.objects.all(), options['sequence'], options['creator_key'], bbox)
+        writer = COLUMNAR_FORMATS[export_format][2]
+        with open(options['output'], 'wb') as output:
+            writer(output, serializer_class, queryset, chunk_size=options['chunk_size'])
+        self.stdout.write('%s written' % options['output'])
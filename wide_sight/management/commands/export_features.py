@@ -0,0 +1,41 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wide_sight.models import sequences, panoramas, image_objects
+from wide_sight.serializers import sequences_serializer, panoramas_geo_serializer, image_objects_geo_serializer
+from wide_sight.geojson import iter_export, EXPORT_FORMATS
+
+EXPORTS = {
+    'sequences': (sequences, sequences_serializer, 'pk'),
+    'panoramas': (panoramas, panoramas_geo_serializer, 'sequence'),
+    'image_objects': (image_objects, image_objects_geo_serializer, 'panorama__sequence'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Stream a whole table as GeoJSONSeq, NDJSON or CSV with a server side cursor (constant memory)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(EXPORTS))
+        parser.add_argument('--format', dest='export_format', default='geojsonseq', choices=sorted(EXPORT_FORMATS))
+        parser.add_argument('--output', help='output file (default stdout)')
+        parser.add_argument('--sequence', action='append', default=[], help='sequence id (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        model, serializer_class, sequence_lookup = EXPORTS[options['model']]
+        queryset = model.objects.all()
+        if options['sequence']:
+            queryset = queryset.filter(**{sequence_lookup + '__in': options['sequence']})
+        content = iter_export(options['export_format'], serializer_class, queryset, chunk_size=options['chunk_size'])
+        try:
+            output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        except OSError as e:
+            raise CommandError(e)
+        try:
+            for chunk in content:
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
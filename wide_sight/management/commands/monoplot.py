@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from wide_sight.models import image_objects
+from wide_sight.monoplot import monoplot_image_objects
+
+
+class Command(BaseCommand):
+    help = 'Project map spot image objects on the ground plane or on the DEM (WS_DEM_PATH), by panorama or sequence'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sequence', action='append', default=[], help='sequence id (repeatable)')
+        parser.add_argument('--panorama', action='append', default=[], help='panorama id (repeatable)')
+        parser.add_argument('--no-dem', action='store_true', help='intersect the ground plane even if a DEM is configured')
+
+    def handle(self, *args, **options):
+        queryset = image_objects.objects.all()
+        if options['sequence']:
+            queryset = queryset.filter(panorama__sequence__in=options['sequence'])
+        if options['panorama']:
+            queryset = queryset.filter(panorama__in=options['panorama'])
+        projected = monoplot_image_objects(queryset, use_dem=not options['no_dem'])
+        self.stdout.write('%d image objects projected' % len(projected))
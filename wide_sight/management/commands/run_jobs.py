@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from wide_sight.tasks import run_pending
+
+
+class Command(BaseCommand):
+    help = 'Process queued background jobs (use with WS_TASK_BACKEND = wide_sight.tasks.queueBackend)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+        parser.add_argument('--interval', type=float, default=2, help='seconds between queue polls')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending()
+            if count:
+                self.stdout.write('%d jobs processed' % count)
+            if options['once']:
+                return
+            time.sleep(options['interval'])
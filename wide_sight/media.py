@@ -0,0 +1,121 @@
+import os
+import re
+import mimetypes
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponse, Http404
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework.utils.urls import replace_query_param
+
+# Media files served after the API permission checks. With WS_MEDIA_ACCEL the front
+# server sends the file ('x-accel-redirect' for nginx, internal location
+# WS_MEDIA_ACCEL_PREFIX mapped on MEDIA_ROOT, or 'x-sendfile' for apache/lighttpd) and
+# handles ranges itself; otherwise single byte ranges are answered here and file bodies
+# go through wsgi.file_wrapper (sendfile on servers that support it).
+
+MEDIA_ACCEL = getattr(settings, 'WS_MEDIA_ACCEL', None)
+MEDIA_ACCEL_PREFIX = getattr(settings, 'WS_MEDIA_ACCEL_PREFIX', '/protected-media/')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def with_apikey(url, request):
+    """
+    url carrying the apikey of the request, if any: media links handed to apikey
+    clients must pass the same permission check of the API
+    """
+    api_key = request.GET.get('apikey') if request is not None else None
+    if url and api_key:
+        return replace_query_param(url, 'apikey', api_key)
+    return url
+
+
+class rangeFile(object):
+    """
+    file like limited to length bytes from start, keeps fileno for sendfile
+    """
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.file.read(self.remaining if size is None or size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive of a single byte range, None when the header is missing or
+    not a single range (full content), False when it can't be satisfied
+    """
+    match = RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+def media_response(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except (ValueError, SuspiciousFileOperation):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    stat = os.stat(full_path)
+    etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+        return not_modified
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+    if MEDIA_ACCEL:
+        response = HttpResponse(content_type=content_type)
+        if MEDIA_ACCEL == 'x-sendfile':
+            response['X-Sendfile'] = full_path
+        else:
+            response['X-Accel-Redirect'] = MEDIA_ACCEL_PREFIX + os.path.relpath(full_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+    else:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if byte_range and if_range and if_range != etag and parse_http_date_safe(if_range) != int(stat.st_mtime):
+            byte_range = None
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % stat.st_size
+            return response
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+            response['Content-Length'] = stat.st_size
+        elif byte_range:
+            start, end = byte_range
+            response = FileResponse(rangeFile(open(full_path, 'rb'), start, end - start + 1), status=206, content_type=content_type)
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+        else:
+            response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    return response
@@ -3,16 +3,18 @@ import os
 import exifread
 import sys
 import datetime
+import time
+import threading
 import utm
+from contextlib import contextmanager
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import GEOSGeometry, LineString, MultiPoint
-from imagekit.models import ImageSpecField
-from imagekit.processors import ResizeToFill
 from django.conf import settings
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.contrib.gis.geos import Point
 from rest_framework_api_key.models import APIKey
@@ -20,8 +22,11 @@ from rest_framework_api_key.helpers import generate_key
 from dirtyfields import DirtyFieldsMixin
 from django.utils.translation import ugettext_lazy as _ 
 
-from .exif_gps import get_exif_values, set_heading_tag
+from .exif_gps import get_exif_values, set_heading_tag, read_exif_header
 from .utils import get_utm_srid_from_lonlat
+from .tiles import remove_tiles
+from .renditions import remove_renditions
+from .storage import panorama_storage, rewrite_file, remove_sequence_dir
 
 
 sample_type_choice = (
@@ -55,7 +60,7 @@ class sequences(models.Model):
 
 @receiver(pre_delete, sender=sequences)
 def delete_sequence(sender, instance, **kwargs):
-    os.rmdir(os.path.join(settings.MEDIA_ROOT,'panos',str(instance.id)))
+    remove_sequence_dir(instance)
 
 class panoramas(DirtyFieldsMixin, models.Model):
 
@@ -69,11 +74,7 @@ class panoramas(DirtyFieldsMixin, models.Model):
         return os.path.join(rel_path, f_name)
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, help_text=_("unique alphanumeric identifier"))
-    eqimage = models.ImageField(upload_to=upload_img, help_text=_("equirectangular image path"))
-    eqimage_thumbnail = ImageSpecField(source='eqimage',
-                                      processors=[ResizeToFill(480, 240)],
-                                      format='JPEG',
-                                      options={'quality': 60})
+    eqimage = models.ImageField(upload_to=upload_img, storage=panorama_storage, help_text=_("equirectangular image path"))
     geom = models.PointField(srid=4326, blank=True, null=True, geography=True, help_text=_("geometry location of the panorama"))
     sequence = models.ForeignKey('sequences', on_delete=models.CASCADE, help_text=_("sequence id to which panorama belongs"))
     lon = models.FloatField(blank=True, null=True, help_text=_("decimal longitude of the panorama"))
@@ -100,41 +101,193 @@ class panoramas(DirtyFieldsMixin, models.Model):
         verbose_name = "Panorama"
         app_label = 'wide_sight'
         ordering = ['shooting_time']
+        # sequence geometry rebuilds and navigation walk panoramas in shooting order
+        indexes = [models.Index(fields=['sequence', 'shooting_time'], name='panoramas_seq_time_idx')]
+
+    def read_exif(self):
+        exiftags = read_exif_header(self.eqimage)
+        self.lat, self.lon, self.elevation, self.heading, self.pitch, self.roll, self.fov, self.camera_prod, self.camera_model, self.shooting_time  = get_exif_values(exiftags)
+
+    def heading_in_file(self):
+        """
+        True when the EXIF header of the image already holds the current heading
+        (e.g. right after read_exif)
+        """
+        file_heading = get_exif_values(read_exif_header(self.eqimage))[3]
+        return file_heading is not None and abs(file_heading - self.heading) < 1e-4
+
+    def update_location(self):
+        self.geom = Point(self.lon,self.lat)
+        self.utm_srid = get_utm_srid_from_lonlat(self.lon,self.lat)
+        self.utm_x, self.utm_y, utm_zone_number, utm_letter = utm.from_latlon(self.lat,self.lon)
+        self.utm_code = str(utm_zone_number)+utm_letter
 
     def save(self, *args, **kwargs):
         for key, value in kwargs.items():
             print ("%s == %s" %(key, value))
         print ("dirty_fields",self.get_dirty_fields(), file=sys.stderr)
-        if self.heading and'heading' in self.get_dirty_fields():
-            pass #following method throws exception
-            #set_heading_tag(os.path.join(settings.MEDIA_ROOT,self.eqimage.path),self.heading)
-        if 'eqimage' in self.get_dirty_fields():
-            exiftags = exifread.process_file(self.eqimage)
-            print ("EXIFTAGS",exiftags, file=sys.stderr)
-            self.lat, self.lon, self.elevation, self.heading, self.pitch, self.roll, self.fov, self.camera_prod, self.camera_model, self.shooting_time  = get_exif_values(exiftags)
+        new_image = bool(self.eqimage) and 'eqimage' in self.get_dirty_fields()
+        replaced_image = None
+        if new_image and not self._state.adding:
+            old_image = self.get_dirty_fields()['eqimage']
+            replaced_image = getattr(old_image, 'name', old_image)
+        if self.heading is not None and 'heading' in self.get_dirty_fields() and not self._state.adding and not new_image \
+                and not self.heading_in_file():
+            # a failed rewrite aborts the save: the stored heading never disagrees with the file
+            old_name = self.eqimage.name
+            self.eqimage.name = rewrite_file(self.eqimage, lambda path: set_heading_tag(path, self.heading))
+            replaced_image = old_name
+        if new_image and not getattr(_upload_batch, 'deferred', False):
+            self.read_exif()
         if (self.lon and 'lon' in self.get_dirty_fields()) or (self.lat and 'lat' in self.get_dirty_fields()):
-            self.geom = Point(self.lon,self.lat)
-            self.utm_srid = get_utm_srid_from_lonlat(self.lon,self.lat)
-            self.utm_x, self.utm_y, utm_zone_number, utm_letter = utm.from_latlon(self.lat,self.lon)
-            self.utm_code = str(utm_zone_number)+utm_letter
+            self.update_location()
 
+        adding = self._state.adding
+        dirty_fields = self.get_dirty_fields(check_relationship=True)
         super(panoramas,self).save(*args, **kwargs)
-        update_sequence(self.sequence)
+        if replaced_image and replaced_image != self.eqimage.name:
+            self.eqimage.storage.delete(replaced_image)
+            # tiles and renditions are stored by panorama id, not by image
+            remove_tiles(self)
+            remove_renditions(self)
+        if adding:
+            sequence_add_point(self)
+        elif 'sequence' in dirty_fields:
+            update_sequence(dirty_fields['sequence'])
+            update_sequence(self.sequence)
+        elif 'geom' in dirty_fields or 'shooting_time' in dirty_fields:
+            sequence_move_point(self, dirty_fields.get('geom', self.geom), 'shooting_time' in dirty_fields)
+        if adding or set(dirty_fields) & {'geom', 'shooting_time', 'sequence'}:
+            from .navigation import update_navigation
+            update_navigation(self, adding, dirty_fields)
         #if (self.lon and 'lon' in self.get_dirty_fields()) or (self.lat and 'lat' in self.get_dirty_fields()):
 
 
-def update_sequence(seq, exclude=None):
-    imgs_in_sequence = panoramas.objects.filter(sequence=seq).order_by('shooting_time')
-    seq_points = []
-    for img in imgs_in_sequence:
-        if exclude and img.pk == exclude.pk:
-            pass
-        else:
-            seq_points.append(img.geom)
+_sequence_batch = threading.local()
+_upload_batch = threading.local()
+
+@contextmanager
+def deferred_upload_processing():
+    """
+    Panoramas saved within this block keep their uploaded image untouched:
+    EXIF reading is left to a background job (see tasks.process_panorama).
+    """
+    previous = getattr(_upload_batch, 'deferred', False)
+    _upload_batch.deferred = True
+    try:
+        yield
+    finally:
+        _upload_batch.deferred = previous
+
+@contextmanager
+def deferred_sequence_update():
+    """
+    Within this block panorama saves and deletes only record the touched
+    sequences; geometry and navigation links of each of them are rebuilt once
+    on exit. Use it for bulk ingestion.
+    """
+    if getattr(_sequence_batch, 'pending', None) is not None:
+        yield _sequence_batch.pending
+        return
+    _sequence_batch.pending = set()
+    try:
+        yield _sequence_batch.pending
+    finally:
+        pending = _sequence_batch.pending
+        _sequence_batch.pending = None
+        from .navigation import rebuild_sequence_navigation
+        for seq in sequences.objects.filter(pk__in=pending):
+            update_sequence(seq)
+            rebuild_sequence_navigation(seq)
+
+def _defer_sequence(seq_id):
+    pending = getattr(_sequence_batch, 'pending', None)
+    if pending is None:
+        return False
+    pending.add(seq_id)
+    return True
+
+def _store_sequence_geom(seq, seq_points):
+    if seq_points:
+        seq.geom = MultiPoint([Point(p) for p in seq_points], srid=4326)
+    else:
+        seq.geom = None
+    sequences.objects.filter(pk=seq.pk).update(geom=seq.geom)
+    bump_change_counter('sequences')
+
+def _sequence_coords(seq):
+    geom = sequences.objects.filter(pk=seq.pk).values_list('geom', flat=True).first()
+    return [tuple(p) for p in geom.coords] if geom else []
 
-    cloud = MultiPoint(seq_points)
-    seq.geom = GEOSGeometry(cloud, srid=4326)
-    seq.save()
+def update_sequence(seq, exclude=None):
+    """
+    full rebuild of the sequence geometry from its panoramas ordered by shooting time
+    """
+    if not isinstance(seq, sequences):
+        seq = sequences.objects.get(pk=seq)
+    if _defer_sequence(seq.pk):
+        return
+    imgs_in_sequence = panoramas.objects.filter(sequence=seq, geom__isnull=False).order_by('shooting_time')
+    if exclude:
+        imgs_in_sequence = imgs_in_sequence.exclude(pk=exclude.pk)
+    seq_points = [geom.coords for geom in imgs_in_sequence.values_list('geom', flat=True)]
+    _store_sequence_geom(seq, seq_points)
+
+def _sequence_index(pano):
+    # position of the panorama point inside the shooting_time ordered sequence geometry
+    return panoramas.objects.filter(
+        sequence_id=pano.sequence_id,
+        geom__isnull=False,
+        shooting_time__lte=pano.shooting_time
+    ).exclude(pk=pano.pk).count()
+
+def sequence_add_point(pano):
+    """
+    insert a single panorama point in the sequence geometry without rereading the whole sequence
+    """
+    if pano.geom is None or _defer_sequence(pano.sequence_id):
+        return
+    if pano.shooting_time is None:
+        return update_sequence(pano.sequence)
+    seq_points = _sequence_coords(pano.sequence)
+    seq_points.insert(_sequence_index(pano), tuple(pano.geom.coords))
+    _store_sequence_geom(pano.sequence, seq_points)
+
+def sequence_remove_point(pano):
+    """
+    remove a single panorama point from the sequence geometry
+    """
+    if pano.geom is None or _defer_sequence(pano.sequence_id):
+        return
+    seq_points = _sequence_coords(pano.sequence)
+    try:
+        seq_points.remove(tuple(pano.geom.coords))
+    except ValueError:
+        return update_sequence(pano.sequence, exclude=pano)
+    _store_sequence_geom(pano.sequence, seq_points)
+
+def sequence_move_point(pano, old_geom, reorder=False):
+    """
+    replace the previous position of a panorama in the sequence geometry.
+    A shooting time change moves the point to its new position in the sequence order
+    """
+    if _defer_sequence(pano.sequence_id):
+        return
+    if pano.shooting_time is None and (reorder or old_geom is None):
+        return update_sequence(pano.sequence)
+    seq_points = _sequence_coords(pano.sequence)
+    if old_geom is not None:
+        try:
+            index = seq_points.index(tuple(old_geom.coords))
+        except ValueError:
+            return update_sequence(pano.sequence)
+        del seq_points[index]
+        if pano.geom is not None and not reorder:
+            seq_points.insert(index, tuple(pano.geom.coords))
+            return _store_sequence_geom(pano.sequence, seq_points)
+    if pano.geom is not None:
+        seq_points.insert(_sequence_index(pano), tuple(pano.geom.coords))
+    _store_sequence_geom(pano.sequence, seq_points)
 
 #@receiver(post_save, sender=panoramas)
 def sync_geom(sender, instance,  **kwargs):
@@ -158,10 +311,32 @@ def sync_geom(sender, instance,  **kwargs):
 def delete_panorama(sender, instance, **kwargs):
     print ("REMOVING",instance.eqimage.name, file=sys.stderr)
     try:
-        os.remove(os.path.join(settings.MEDIA_ROOT,instance.eqimage.name))
-        update_sequence(instance.sequence, exclude=instance)
+        instance.eqimage.storage.delete(instance.eqimage.name)
     except Exception as e:
         print ("error: ", e, file=sys.stderr)
+    remove_tiles(instance)
+    remove_renditions(instance)
+    sequence_remove_point(instance)
+    from .navigation import remove_navigation
+    remove_navigation(instance)
+
+link_type_choice = (
+    ('prev','previous in sequence'),
+    ('next','next in sequence'),
+    ('near','near panorama'),
+)
+
+class panorama_links(models.Model):
+    from_panorama = models.ForeignKey('panoramas', on_delete=models.CASCADE, related_name='links', help_text=_("Panorama id from which the link starts"))
+    to_panorama = models.ForeignKey('panoramas', on_delete=models.CASCADE, related_name='+', help_text=_("Panorama id reached by the link"))
+    type = models.CharField(max_length=4, choices=link_type_choice, help_text=_("link type (prev, next: sequence order, near: spatial neighbour in other sequences)"))
+    distance = models.FloatField(blank=True, null=True, help_text=_("distance in meters between the linked panoramas"))
+    bearing = models.FloatField(blank=True, null=True, help_text=_("direction of the linked panorama expressed in clockwise decimal degrees from north"))
+
+    class Meta:
+        verbose_name_plural = "Panorama_links"
+        verbose_name = "Panorama_link"
+        app_label = 'wide_sight'
 
 class image_object_types(models.Model):
     type = models.CharField(max_length=20,blank=True)
@@ -202,13 +377,134 @@ class image_objects(DirtyFieldsMixin, models.Model):
         verbose_name = "Image_object"
         app_label = 'wide_sight'
 
-    def save(self, *args, **kwargs):
-        if self.type == 2:
+    def set_geom(self):
+        """
+        sets geom from lon/lat. Returns True for map spots without client coordinates,
+        to be projected on the ground from img_lon/img_lat once stored
+        """
+        project = self.type == 2 and (self.lon is None or self.lat is None) and self.img_lon is not None and self.img_lat is not None
+        if (self.type == 2 and not project) or (self.type in (3, 4) and self.lon is not None and self.lat is not None):
             self.geom = Point(self.lon,self.lat)
         else:
             self.geom = GEOSGeometry('POINT EMPTY', srid=4326)
+        return project
+
+    def save(self, *args, **kwargs):
+        project = self.set_geom()
         super(image_objects,self).save(*args, **kwargs)
+        if project:
+            from .monoplot import monoplot_image_objects
+            projected = monoplot_image_objects(image_objects.objects.filter(pk=self.pk))
+            if self.pk in projected:
+                self.refresh_from_db(fields=['lon', 'lat', 'utm_x', 'utm_y', 'utm_code', 'utm_srid', 'elevation', 'geom'])
+
 
+class stored_files(models.Model):
+    name = models.CharField(max_length=255, primary_key=True, help_text=_("storage name of the content addressed file"))
+    size = models.BigIntegerField(blank=True, null=True, help_text=_("file size in bytes"))
+    references = models.IntegerField(default=0, help_text=_("number of panoramas using the file"))
+
+    class Meta:
+        verbose_name_plural = "Stored_files"
+        verbose_name = "Stored_file"
+        app_label = 'wide_sight'
+
+    def __str__(self):
+        return '%s_%d' % (self.name,self.references)
+
+
+job_status_choice = (
+    ('queued','queued'),
+    ('running','running'),
+    ('done','done'),
+    ('failed','failed'),
+)
+
+class jobs(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, help_text=_("unique alphanumeric identifier"))
+    task = models.CharField(max_length=50, help_text=_("name of the registered background task"))
+    params = models.TextField(blank=True, help_text=_("json encoded task keyword arguments"))
+    status = models.CharField(max_length=10, choices=job_status_choice, default='queued', help_text=_("job processing status"))
+    result = models.TextField(blank=True, help_text=_("json encoded task result"))
+    error = models.TextField(blank=True, help_text=_("traceback of a failed job"))
+    created = models.DateTimeField(auto_now_add=True, help_text=_("Datetime instant of job submission"))
+    started = models.DateTimeField(blank=True, null=True, help_text=_("Datetime instant of job processing start"))
+    finished = models.DateTimeField(blank=True, null=True, help_text=_("Datetime instant of job processing end"))
+    creator = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, help_text=_("User id that submitted the job"))
+
+    class Meta:
+        verbose_name_plural = "Jobs"
+        verbose_name = "Job"
+        app_label = 'wide_sight'
+        ordering = ['created']
+
+    def __str__(self):
+        return '%s_%s' % (self.task,self.status)
+
+class change_counters(models.Model):
+    model = models.CharField(max_length=50, primary_key=True, help_text=_("model name"))
+    counter = models.BigIntegerField(default=1, help_text=_("number of counted changes of the model"))
+    changed = models.FloatField(help_text=_("timestamp of the last counted change"))
+
+    class Meta:
+        verbose_name_plural = "Change_counters"
+        verbose_name = "Change_counter"
+        app_label = 'wide_sight'
+
+    def __str__(self):
+        return '%s_%d' % (self.model,self.counter)
+
+# change counters are database rows: every worker process sees the same versions of
+# the response, tile, grid and cluster caches
+
+def get_changes(*model_names):
+    """
+    {model name: (counter, timestamp of the last change)} read with a single query
+    """
+    changes = {model: (counter, changed) for model, counter, changed in change_counters.objects.filter(model__in=model_names).values_list('model', 'counter', 'changed')}
+    for model_name in model_names:
+        if model_name not in changes:
+            try:
+                with transaction.atomic():
+                    change_counters.objects.create(model=model_name, counter=1, changed=time.time())
+            except IntegrityError:
+                pass
+            changes[model_name] = change_counters.objects.filter(model=model_name).values_list('counter', 'changed').get()
+    return changes
+
+def get_change_counter(model_name):
+    """
+    per-model counter bumped on every change, usable as cache version
+    """
+    return get_changes(model_name)[model_name][0]
+
+def get_change_time(model_name):
+    """
+    timestamp of the last change counted for the model
+    """
+    return get_changes(model_name)[model_name][1]
+
+def bump_change_counter(*model_names):
+    for model_name in model_names:
+        now = time.time()
+        if change_counters.objects.filter(model=model_name).update(counter=F('counter') + 1, changed=now):
+            continue
+        try:
+            with transaction.atomic():
+                change_counters.objects.create(model=model_name, counter=2, changed=now)
+        except IntegrityError:
+            change_counters.objects.filter(model=model_name).update(counter=F('counter') + 1, changed=now)
+
+@receiver(post_save)
+@receiver(post_delete)
+def count_changes(sender, **kwargs):
+    if sender in (sequences, panoramas, image_objects):
+        bump_change_counter(sender._meta.model_name)
+
+@receiver(m2m_changed, sender=image_objects.match.through)
+def count_match_changes(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_change_counter('image_objects')
 
 class appkeys(models.Model):
     app_name = models.CharField(max_length=50, help_text=_("Name of the sallowed application"))
@@ -0,0 +1,191 @@
+import os
+import glob
+
+import numpy as np
+import utm
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import transaction
+
+from .models import image_objects, bump_change_counter
+from .photogrammetry import OBSERVATION_FIELDS, observation_directions
+from .utils import utm_from_lonlat_arrays
+
+# Monoplotting: the observation ray of an image object is intersected with the ground,
+# either a horizontal plane at the camera foot or a DEM made of ESRI float grid tiles
+# (.flt + .hdr, projected in WS_DEM_SRID UTM coordinates) read through memory maps.
+
+DEM_PATH = getattr(settings, 'WS_DEM_PATH', None)
+DEM_SRID = getattr(settings, 'WS_DEM_SRID', None)
+MAX_DISTANCE = getattr(settings, 'WS_MONOPLOT_MAX_DISTANCE', 200)
+DEM_STEP = getattr(settings, 'WS_MONOPLOT_DEM_STEP', 0.5)
+
+
+class demTile(object):
+
+    def __init__(self, hdr_path):
+        header = {}
+        with open(hdr_path) as hdr:
+            for line in hdr:
+                if line.strip():
+                    key, value = line.split()[:2]
+                    header[key.lower()] = value
+        self.path = os.path.splitext(hdr_path)[0] + '.flt'
+        self.cols = int(header['ncols'])
+        self.rows = int(header['nrows'])
+        self.cellsize = float(header['cellsize'])
+        self.xmin = float(header.get('xllcorner', header.get('xllcenter', 0)))
+        self.ymin = float(header.get('yllcorner', header.get('yllcenter', 0)))
+        self.xmax = self.xmin + self.cols * self.cellsize
+        self.ymax = self.ymin + self.rows * self.cellsize
+        self.nodata = float(header.get('nodata_value', -9999))
+        self.dtype = '>f4' if header.get('byteorder', 'lsbfirst').lower() == 'msbfirst' else '<f4'
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(self.rows, self.cols))
+        return self._data
+
+    def contains(self, x, y):
+        return (x >= self.xmin) & (x < self.xmax) & (y > self.ymin) & (y <= self.ymax)
+
+    def sample(self, x, y):
+        """
+        bilinear interpolation between cell centers, nan on nodata
+        """
+        col = np.clip((x - self.xmin) / self.cellsize - 0.5, 0, self.cols - 1)
+        row = np.clip((self.ymax - y) / self.cellsize - 0.5, 0, self.rows - 1)
+        col0 = np.minimum(np.floor(col).astype(int), self.cols - 2) if self.cols > 1 else np.zeros(len(col), dtype=int)
+        row0 = np.minimum(np.floor(row).astype(int), self.rows - 2) if self.rows > 1 else np.zeros(len(row), dtype=int)
+        col1, row1 = np.minimum(col0 + 1, self.cols - 1), np.minimum(row0 + 1, self.rows - 1)
+        dx, dy = col - col0, row - row0
+        corners = [self.data[row0, col0], self.data[row0, col1], self.data[row1, col0], self.data[row1, col1]]
+        corners = [np.where(corner == self.nodata, np.nan, corner).astype(float) for corner in corners]
+        top = corners[0] * (1 - dx) + corners[1] * dx
+        bottom = corners[2] * (1 - dx) + corners[3] * dx
+        return top * (1 - dy) + bottom * dy
+
+
+class demTiles(object):
+
+    def __init__(self, path, srid):
+        self.srid = srid
+        self.tiles = [demTile(hdr_path) for hdr_path in sorted(glob.glob(os.path.join(path, '*.hdr')))]
+
+    def sample(self, x, y):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        z = np.full(x.shape, np.nan)
+        for tile in self.tiles:
+            inside = tile.contains(x, y) & np.isnan(z)
+            if inside.any():
+                z[inside] = tile.sample(x[inside], y[inside])
+        return z
+
+_dem = {}
+
+def get_dem():
+    if not DEM_PATH or not DEM_SRID:
+        return None
+    if 'tiles' not in _dem:
+        _dem['tiles'] = demTiles(DEM_PATH, DEM_SRID)
+    return _dem['tiles']
+
+def ground_plane_intersections(origins, directions, max_distance=MAX_DISTANCE):
+    """
+    intersections of rays starting at height origins[:,2] above a horizontal ground at z = 0
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -origins[:, 2] / directions[:, 2]
+    valid = (directions[:, 2] < 0) & (t > 0) & (t * np.hypot(directions[:, 0], directions[:, 1]) <= max_distance)
+    points = origins + np.where(valid, t, np.nan)[:, None] * directions
+    return points, valid
+
+def dem_intersections(origins, directions, dem, max_distance=MAX_DISTANCE, step=DEM_STEP):
+    """
+    first crossing of every ray with the DEM surface: all rays are sampled together
+    every `step` meters, the crossing is interpolated linearly between samples
+    """
+    t = np.arange(step, max_distance + step, step)
+    samples = origins[:, None, :] + t[None, :, None] * directions[:, None, :]
+    ground = dem.sample(samples[:, :, 0].ravel(), samples[:, :, 1].ravel()).reshape(samples.shape[:2])
+    above = samples[:, :, 2] - ground
+    below = above <= 0
+    crossing = np.argmax(below, axis=1)
+    valid = below[np.arange(len(origins)), crossing]
+    previous = np.maximum(crossing - 1, 0)
+    rows = np.arange(len(origins))
+    above_before = np.where(crossing > 0, above[rows, previous], origins[:, 2] - dem.sample(origins[:, 0], origins[:, 1]))
+    above_after = above[rows, crossing]
+    t_before = np.where(crossing > 0, t[previous], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.clip(above_before / (above_before - above_after), 0, 1)
+    t_cross = t_before + fraction * (t[crossing] - t_before)
+    valid &= ~np.isnan(t_cross)
+    points = origins + np.where(valid, t_cross, np.nan)[:, None] * directions
+    return points, valid
+
+def monoplot_image_objects(queryset=None, use_dem=True, types=(2,)):
+    """
+    Projects img_lon/img_lat of map spot image objects on the ground in one vectorized
+    pass and stores lon, lat, UTM fields and (with a DEM) elevation.
+    Returns {image object pk: (lon, lat, elevation)} of the projected objects
+    """
+    queryset = image_objects.objects.all() if queryset is None else queryset
+    rows = list(queryset.filter(
+        type__in=types, img_lon__isnull=False, img_lat__isnull=False,
+        panorama__lon__isnull=False, panorama__lat__isnull=False,
+    ).values_list(*OBSERVATION_FIELDS))
+    if not rows:
+        return {}
+
+    columns = list(zip(*rows))
+    def floats(index, default=np.nan):
+        return np.array([default if value is None else value for value in columns[index]], dtype=float)
+    pks = columns[0]
+    img_lon, img_lat = floats(1), floats(2)
+    lon, lat, utm_x, utm_y = floats(3), floats(4), floats(5), floats(6)
+    srid = np.array([value or 0 for value in columns[7]], dtype=int)
+    heading, pitch, roll = floats(8, 0), floats(9, 0), floats(10, 0)
+    height = np.where(np.isnan(floats(11)), floats(12, 0), floats(11))
+    directions = observation_directions(img_lon, img_lat, heading, pitch, roll)
+
+    dem = get_dem() if use_dem else None
+    if dem is not None:
+        # every camera in the DEM zone, standing at DEM ground elevation
+        zone_srid = np.full(len(rows), dem.srid)
+        x, y = utm_from_lonlat_arrays(lon, lat, zone=dem.srid % 100)[:2]
+        origins = np.stack([x, y, dem.sample(x, y) + height], axis=1)
+        points, valid = dem_intersections(origins, directions, dem)
+    else:
+        zone_srid = np.where(lat < 0, 32700, 32600) + utm_from_lonlat_arrays(lon, lat)[2]
+        stored = (srid == zone_srid) & ~np.isnan(utm_x) & ~np.isnan(utm_y)
+        reprojected_x, reprojected_y = utm_from_lonlat_arrays(lon, lat)[:2]
+        origins = np.stack([np.where(stored, utm_x, reprojected_x), np.where(stored, utm_y, reprojected_y), height], axis=1)
+        points, valid = ground_plane_intersections(origins, directions)
+
+    updated = []
+    for zone in np.unique(zone_srid[valid]):
+        selected = np.nonzero(valid & (zone_srid == zone))[0]
+        solved_lat, solved_lon = utm.to_latlon(points[selected, 0], points[selected, 1], int(zone) % 100, northern=zone < 32700, strict=False)
+        letters = utm_from_lonlat_arrays(solved_lon, solved_lat, zone=int(zone) % 100)[3]
+        for index, row in enumerate(selected):
+            updated.append(image_objects(
+                pk=pks[row],
+                lon=float(solved_lon[index]),
+                lat=float(solved_lat[index]),
+                utm_x=float(points[row, 0]),
+                utm_y=float(points[row, 1]),
+                utm_code='%d%s' % (int(zone) % 100, letters[index]),
+                utm_srid=int(zone),
+                elevation=float(points[row, 2]) if dem is not None else None,
+                geom=Point(float(solved_lon[index]), float(solved_lat[index]), srid=4326),
+            ))
+    update_fields = ['lon', 'lat', 'utm_x', 'utm_y', 'utm_code', 'utm_srid', 'geom']
+    if dem is not None:
+        update_fields.append('elevation')
+    with transaction.atomic():
+        image_objects.objects.bulk_update(updated, update_fields, batch_size=1000)
+    bump_change_counter('image_objects')
+    return {obj.pk: (obj.lon, obj.lat, obj.elevation) for obj in updated}
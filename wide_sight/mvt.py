@@ -0,0 +1,159 @@
+import math
+import struct
+import datetime
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+
+from .models import sequences, panoramas, image_objects
+
+# Mapbox Vector Tile (protobuf) encoding limited to point geometries
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+
+EXTENT = 4096
+BUFFER = 64
+CLUSTER_MAXZOOM = getattr(settings, 'WS_MVT_CLUSTER_MAXZOOM', 16)
+CLUSTER_GRID = getattr(settings, 'WS_MVT_CLUSTER_GRID', 64)
+
+LAYERS = {
+    'panoramas': (panoramas, ('id', 'sequence', 'heading', 'shooting_time')),
+    'image_objects': (image_objects, ('id', 'type', 'panorama', 'sample_type')),
+    'sequences': (sequences, ('id', 'title', 'shooting_data')),
+}
+
+def _varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _field(number, data):
+    return _varint((number << 3) | 2) + _varint(len(data)) + data
+
+def _varint_field(number, value):
+    return _varint(number << 3) + _varint(value)
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _varint((3 << 3) | 1) + struct.pack('<d', value)
+    return _field(1, str(value).encode('utf-8'))
+
+def _point_geometry(points):
+    # MoveTo command with zigzag encoded deltas
+    geometry = [(1 & 0x7) | (len(points) << 3)]
+    cursor_x = cursor_y = 0
+    for x, y in points:
+        geometry.extend((_zigzag(x - cursor_x), _zigzag(y - cursor_y)))
+        cursor_x, cursor_y = x, y
+    return geometry
+
+def encode_layer(name, features):
+    """
+    features: list of (points in tile coordinates, properties dict)
+    """
+    keys, values = [], []
+    key_index, value_index = {}, {}
+    encoded_features = b''
+    for points, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                value = value.isoformat()
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            value_key = (type(value).__name__, value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(value)
+            tags.extend((key_index[key], value_index[value_key]))
+        feature = _field(2, b''.join(_varint(tag) for tag in tags))
+        feature += _varint_field(3, 1)
+        feature += _field(4, b''.join(_varint(cmd) for cmd in _point_geometry(points)))
+        encoded_features += _field(2, feature)
+
+    layer = _varint_field(15, 2) + _field(1, name.encode('utf-8')) + encoded_features
+    layer += b''.join(_field(3, key.encode('utf-8')) for key in keys)
+    layer += b''.join(_field(4, _encode_value(value)) for value in values)
+    layer += _varint_field(5, EXTENT)
+    return _field(3, layer)
+
+def tile_bounds(z, x, y):
+    """
+    lon/lat bounds (xmin, ymin, xmax, ymax) of a web mercator tile
+    """
+    n = 2.0 ** z
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return (x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y))
+
+def tile_projector(z, x, y):
+    n = 2.0 ** z
+    def project(lon, lat):
+        lat = max(min(lat, 85.0511), -85.0511)
+        tile_x = (lon + 180.0) / 360.0 * n
+        tile_y = (1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2 * n
+        return int(round((tile_x - x) * EXTENT)), int(round((tile_y - y) * EXTENT))
+    return project
+
+def _clustered(points):
+    """
+    grid clustering in tile coordinates: one feature per cell placed at the centroid of its points
+    """
+    cell = EXTENT // CLUSTER_GRID
+    cells = {}
+    for px, py in points:
+        key = (px // cell, py // cell)
+        sum_x, sum_y, count = cells.get(key, (0, 0, 0))
+        cells[key] = (sum_x + px, sum_y + py, count + 1)
+    return [([(sum_x // count, sum_y // count)], {'count': count}) for sum_x, sum_y, count in cells.values()]
+
+def _simplified(points):
+    # drop points falling on the same tile pixel
+    return list(dict.fromkeys(points))
+
+def render_tile(layer, z, x, y):
+    """
+    encoded MVT of a single layer. Below CLUSTER_MAXZOOM point layers are clustered
+    and sequences are reduced to one point per tile pixel
+    """
+    model, fields = LAYERS[layer]
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    pad_x = (xmax - xmin) * BUFFER / EXTENT
+    pad_y = (ymax - ymin) * BUFFER / EXTENT
+    bbox = Polygon.from_bbox((xmin - pad_x, ymin - pad_y, xmax + pad_x, ymax + pad_y))
+    bbox.srid = 4326
+    project = tile_projector(z, x, y)
+    rows = model.objects.filter(geom__intersects=bbox).values_list('geom', *fields)
+
+    if layer == 'sequences':
+        features = []
+        for row in rows:
+            # only the points in the buffered tile: a long sequence crossing it is not shipped whole
+            points = [project(lon, lat) for lon, lat in row[0].coords
+                      if xmin - pad_x <= lon <= xmax + pad_x and ymin - pad_y <= lat <= ymax + pad_y]
+            if not points:
+                continue
+            if z < CLUSTER_MAXZOOM:
+                points = _simplified(points)
+            features.append((points, dict(zip(fields, row[1:]))))
+    elif z < CLUSTER_MAXZOOM:
+        features = _clustered([project(*row[0].coords) for row in rows if not row[0].empty])
+    else:
+        features = [([project(*row[0].coords)], dict(zip(fields, row[1:]))) for row in rows if not row[0].empty]
+
+    return encode_layer(layer, features)
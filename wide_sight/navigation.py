@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.db.models import Q
+
+from .models import panoramas, panorama_links, _defer_sequence, bump_change_counter
+from .nearest import haversine, bearing, panoramas_within, padded_bbox, gridIndex
+
+# persisted navigation graph: prev/next links follow the shooting_time order inside a
+# sequence, near links join panoramas of other sequences closer than NAVIGATION_RADIUS.
+# Links are part of the panorama detail: every change bumps the panoramas counter
+
+NAVIGATION_RADIUS = getattr(settings, 'WS_NAVIGATION_RADIUS', 25)
+NAVIGATION_NEIGHBOURS = getattr(settings, 'WS_NAVIGATION_NEIGHBOURS', 6)
+
+OPPOSITE = {'prev': 'next', 'next': 'prev', 'near': 'near'}
+
+def _link(from_pano, to_pano, link_type):
+    link = panorama_links(from_panorama_id=from_pano.pk, to_panorama_id=to_pano.pk, type=link_type)
+    if None not in (from_pano.lon, from_pano.lat, to_pano.lon, to_pano.lat):
+        link.distance = haversine(from_pano.lon, from_pano.lat, to_pano.lon, to_pano.lat)
+        link.bearing = bearing(from_pano.lon, from_pano.lat, to_pano.lon, to_pano.lat)
+    return link
+
+def _both_ways(from_pano, to_pano, link_type):
+    return [_link(from_pano, to_pano, link_type), _link(to_pano, from_pano, OPPOSITE[link_type])]
+
+def _unlink(pano, link_types):
+    panorama_links.objects.filter(Q(from_panorama=pano) | Q(to_panorama=pano), type__in=link_types).delete()
+
+def _sequence_neighbours(pano):
+    others = panoramas.objects.filter(sequence_id=pano.sequence_id, shooting_time__isnull=False).exclude(pk=pano.pk)
+    before = others.filter(Q(shooting_time__lt=pano.shooting_time) | Q(shooting_time=pano.shooting_time, pk__lt=pano.pk))
+    after = others.filter(Q(shooting_time__gt=pano.shooting_time) | Q(shooting_time=pano.shooting_time, pk__gt=pano.pk))
+    return before.order_by('-shooting_time', '-pk').first(), after.order_by('shooting_time', 'pk').first()
+
+def _remove_from_sequence(pano):
+    """
+    detaches pano from its prev/next chain, joining its former neighbours
+    """
+    links = dict(panorama_links.objects.filter(from_panorama=pano, type__in=('prev', 'next')).values_list('type', 'to_panorama'))
+    _unlink(pano, ('prev', 'next'))
+    if 'prev' in links and 'next' in links:
+        prev_pano, next_pano = panoramas.objects.get(pk=links['prev']), panoramas.objects.get(pk=links['next'])
+        panorama_links.objects.bulk_create(_both_ways(prev_pano, next_pano, 'next'))
+
+def _insert_in_sequence(pano):
+    if pano.shooting_time is None:
+        return
+    prev_pano, next_pano = _sequence_neighbours(pano)
+    new_links = []
+    if prev_pano and next_pano:
+        panorama_links.objects.filter(
+            Q(from_panorama=prev_pano, to_panorama=next_pano, type='next') |
+            Q(from_panorama=next_pano, to_panorama=prev_pano, type='prev')
+        ).delete()
+    if prev_pano:
+        new_links += _both_ways(pano, prev_pano, 'prev')
+    if next_pano:
+        new_links += _both_ways(pano, next_pano, 'next')
+    panorama_links.objects.bulk_create(new_links)
+
+def _near_links(pano):
+    if pano.lon is None or pano.lat is None:
+        return []
+    candidates = panoramas.objects.exclude(sequence_id=pano.sequence_id)
+    new_links = []
+    for pk, lon, lat, sequence_id, distance in panoramas_within(pano.lon, pano.lat, NAVIGATION_RADIUS, candidates)[:NAVIGATION_NEIGHBOURS]:
+        new_links += _both_ways(pano, panoramas(pk=pk, lon=lon, lat=lat, sequence_id=sequence_id), 'near')
+    return new_links
+
+def _sequence_near_links(seq):
+    """
+    near links of every panorama of a sequence: the candidates of the whole sequence
+    are read with a single bounding box query and paired in memory
+    """
+    located = list(panoramas.objects.filter(sequence=seq, lon__isnull=False, lat__isnull=False).only('pk', 'lon', 'lat', 'sequence_id'))
+    if not located:
+        return []
+    bbox = padded_bbox(min(pano.lon for pano in located), min(pano.lat for pano in located),
+                       max(pano.lon for pano in located), max(pano.lat for pano in located), NAVIGATION_RADIUS)
+    rows = panoramas.objects.exclude(sequence=seq).filter(geom__intersects=bbox, lon__isnull=False, lat__isnull=False).values_list('pk', 'lon', 'lat', 'sequence_id')
+    grid = gridIndex(rows)
+    candidates = {row[0]: row for row in grid.rows}
+    new_links = []
+    for pano in located:
+        for pk, distance in grid.nearest(pano.lon, pano.lat, NAVIGATION_NEIGHBOURS, max_distance=NAVIGATION_RADIUS):
+            pk, lon, lat, sequence_id = candidates[pk]
+            new_links += _both_ways(pano, panoramas(pk=pk, lon=lon, lat=lat, sequence_id=sequence_id), 'near')
+    return new_links
+
+def update_navigation(pano, adding=False, dirty_fields=None):
+    """
+    incremental maintenance of the links of a saved panorama
+    """
+    if _defer_sequence(pano.sequence_id):
+        return
+    dirty_fields = dirty_fields or {}
+    if adding or set(dirty_fields) & {'shooting_time', 'sequence'}:
+        if not adding:
+            _remove_from_sequence(pano)
+        _insert_in_sequence(pano)
+    elif 'geom' in dirty_fields:
+        # same neighbours, only distances and bearings change
+        _remove_from_sequence(pano)
+        _insert_in_sequence(pano)
+    if adding or set(dirty_fields) & {'geom', 'sequence'}:
+        _unlink(pano, ('near',))
+        panorama_links.objects.bulk_create(_near_links(pano))
+    bump_change_counter('panoramas')
+
+def remove_navigation(pano):
+    """
+    called before a panorama is deleted, its own links go away by cascade
+    """
+    if _defer_sequence(pano.sequence_id):
+        return
+    _remove_from_sequence(pano)
+    bump_change_counter('panoramas')
+
+def rebuild_sequence_navigation(seq, batch_size=1000):
+    """
+    recomputes every link of the panoramas of a sequence (bulk ingestion)
+    """
+    sequence_panos = list(panoramas.objects.filter(sequence=seq, shooting_time__isnull=False).order_by('shooting_time', 'pk').only('pk', 'lon', 'lat', 'sequence_id'))
+    panorama_links.objects.filter(Q(from_panorama__sequence=seq) | Q(to_panorama__sequence=seq)).delete()
+    new_links = []
+    for prev_pano, next_pano in zip(sequence_panos, sequence_panos[1:]):
+        new_links += _both_ways(prev_pano, next_pano, 'next')
+    new_links += _sequence_near_links(seq)
+    panorama_links.objects.bulk_create(new_links, batch_size=batch_size)
+    bump_change_counter('panoramas')
@@ -0,0 +1,199 @@
+import math
+import time
+import threading
+
+from django.conf import settings
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .models import panoramas, get_change_counter
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+GRID_CELL = getattr(settings, 'WS_NEAREST_GRID_CELL', 0.001)
+GRID_MAX_AGE = getattr(settings, 'WS_NEAREST_GRID_MAX_AGE', 60)
+
+def haversine(lon1, lat1, lon2, lat2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(d_lambda/2)**2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+def bearing(lon1, lat1, lon2, lat2):
+    """
+    initial bearing from point 1 to point 2 in clockwise degrees from north
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_lambda = math.radians(lon2 - lon1)
+    x = math.sin(d_lambda) * math.cos(phi2)
+    y = math.cos(phi1)*math.sin(phi2) - math.sin(phi1)*math.cos(phi2)*math.cos(d_lambda)
+    return math.degrees(math.atan2(x, y)) % 360
+
+def in_cone(lon, lat, heading, cone):
+    def accept(candidate_lon, candidate_lat):
+        angle = bearing(lon, lat, candidate_lon, candidate_lat)
+        return abs((angle - heading + 180) % 360 - 180) <= cone
+    return accept
+
+
+class gridIndex(object):
+    """
+    in-memory uniform grid of panorama positions used where the database
+    has no KNN ordering (SpatiaLite)
+    """
+
+    def __init__(self, rows, cell=GRID_CELL):
+        self.cell = cell
+        self.cells = {}
+        self.rows = []
+        for row in rows:
+            pk, lon, lat, sequence_id = row
+            self.cells.setdefault(self.cell_of(lon, lat), []).append(len(self.rows))
+            self.rows.append(row)
+        if self.cells:
+            self.bounds = (min(ix for ix, iy in self.cells), min(iy for ix, iy in self.cells),
+                           max(ix for ix, iy in self.cells), max(iy for ix, iy in self.cells))
+
+    def cell_of(self, lon, lat):
+        return int(math.floor(lon / self.cell)), int(math.floor(lat / self.cell))
+
+    def ring(self, cx, cy, r):
+        if r == 0:
+            yield cx, cy
+            return
+        for dx in range(-r, r + 1):
+            yield cx + dx, cy - r
+            yield cx + dx, cy + r
+        for dy in range(-r + 1, r):
+            yield cx - r, cy + dy
+            yield cx + r, cy + dy
+
+    def candidate(self, index, lon, lat, accept, max_distance):
+        pk, candidate_lon, candidate_lat, sequence_id = self.rows[index]
+        distance = haversine(lon, lat, candidate_lon, candidate_lat)
+        if max_distance is not None and distance > max_distance:
+            return None
+        if accept and not accept(self.rows[index]):
+            return None
+        return distance, pk
+
+    def nearest(self, lon, lat, k, accept=None, max_distance=None):
+        """
+        returns up to k (pk, distance in meters) sorted by distance
+        """
+        if not self.rows:
+            return []
+        cx, cy = self.cell_of(lon, lat)
+        min_x, min_y, max_x, max_y = self.bounds
+        max_ring = max(abs(cx - min_x), abs(cx - max_x), abs(cy - min_y), abs(cy - max_y))
+        # conservative width of a cell in meters at this latitude
+        cell_meters = self.cell * METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + self.cell, 90))), 1e-6)
+        found = []
+        r = 0
+        while r <= max_ring:
+            if (2*r + 1)**2 > len(self.rows):
+                # sparse data around the point: a linear scan is cheaper than more empty rings
+                found = [self.candidate(index, lon, lat, accept, max_distance) for index in range(len(self.rows))]
+                found = sorted(item for item in found if item)
+                break
+            for key in self.ring(cx, cy, r):
+                for index in self.cells.get(key, ()):
+                    item = self.candidate(index, lon, lat, accept, max_distance)
+                    if item:
+                        found.append(item)
+            found.sort()
+            # points in the next rings are at least r cells away
+            min_next = r * cell_meters
+            if len(found) >= k and found[k-1][0] <= min_next:
+                break
+            if max_distance is not None and min_next > max_distance:
+                break
+            r += 1
+        return [(pk, distance) for distance, pk in found[:k]]
+
+
+def padded_bbox(xmin, ymin, xmax, ymax, radius):
+    """
+    lon/lat polygon covering every point closer than radius meters to the bounding box
+    """
+    d_lat = radius / METERS_PER_DEGREE
+    d_lon = d_lat / max(math.cos(math.radians(min(max(abs(ymin), abs(ymax)) + d_lat, 90))), 1e-6)
+    bbox = Polygon.from_bbox((xmin - d_lon, ymin - d_lat, xmax + d_lon, ymax + d_lat))
+    bbox.srid = 4326
+    return bbox
+
+def panoramas_within(lon, lat, radius, queryset=None):
+    """
+    (pk, lon, lat, sequence_id, distance in meters) of the panoramas closer than radius,
+    sorted by distance. Candidates come from a bounding box query on the spatial index
+    """
+    queryset = panoramas.objects.all() if queryset is None else queryset
+    bbox = padded_bbox(lon, lat, lon, lat, radius)
+    found = []
+    for pk, candidate_lon, candidate_lat, sequence_id in queryset.filter(geom__intersects=bbox).values_list('pk', 'lon', 'lat', 'sequence_id'):
+        distance = haversine(lon, lat, candidate_lon, candidate_lat)
+        if distance <= radius:
+            found.append((pk, candidate_lon, candidate_lat, sequence_id, distance))
+    return sorted(found, key=lambda row: row[4])
+
+
+_grid = {'version': None, 'index': None, 'checked': 0}
+_grid_lock = threading.Lock()
+
+def panoramas_grid():
+    """
+    grid of the panorama positions of this process. The panoramas counter moves on every
+    save, so the grid is rebuilt at most once every GRID_MAX_AGE seconds: results may
+    lag behind the last writes by that long
+    """
+    with _grid_lock:
+        now = time.time()
+        if _grid['index'] is None or now - _grid['checked'] > GRID_MAX_AGE:
+            version = get_change_counter('panoramas')
+            if _grid['version'] != version:
+                rows = panoramas.objects.filter(lon__isnull=False, lat__isnull=False).values_list('pk', 'lon', 'lat', 'sequence_id')
+                _grid['index'] = gridIndex(rows.iterator())
+                _grid['version'] = version
+            _grid['checked'] = now
+        return _grid['index']
+
+def _postgis_nearest(lon, lat, k, sequence=None, exclude=None, accept=None, max_distance=None):
+    queryset = panoramas.objects.filter(geom__isnull=False)
+    if sequence:
+        queryset = queryset.filter(sequence=sequence)
+    if exclude:
+        queryset = queryset.exclude(pk=exclude)
+    if max_distance is not None:
+        queryset = queryset.filter(geom__dwithin=(Point(lon, lat, srid=4326), D(m=max_distance)))
+    # <-> orders by the GiST index (KNN) instead of computing every distance
+    knn = RawSQL('"%s"."geom" <-> ST_SetSRID(ST_MakePoint(%%s, %%s), 4326)::geography' % panoramas._meta.db_table, (lon, lat))
+    queryset = queryset.annotate(knn_distance=knn).order_by('knn_distance').values_list('pk', 'lon', 'lat', 'sequence_id', 'knn_distance')
+
+    limit = k if accept is None else k * 4
+    while True:
+        rows = list(queryset[:limit])
+        found = [(row[0], row[4]) for row in rows if accept is None or accept(row[:4])]
+        if len(found) >= k or len(rows) < limit:
+            return found[:k]
+        limit *= 4
+
+def nearest_panoramas(lon, lat, k=10, sequence=None, exclude=None, heading=None, cone=45, max_distance=None):
+    """
+    k nearest panoramas to lon/lat as (pk, distance in meters), optionally limited to a
+    sequence, to a max distance and to the cone of half-angle `cone` around `heading`
+    """
+    direction = in_cone(lon, lat, heading, cone) if heading is not None else None
+    if getattr(connection.ops, 'postgis', False):
+        accept = (lambda row: direction(row[1], row[2])) if direction else None
+        return _postgis_nearest(lon, lat, k, sequence, exclude, accept, max_distance)
+
+    def accept(row):
+        if sequence and str(row[3]) != str(sequence):
+            return False
+        if exclude and str(row[0]) == str(exclude):
+            return False
+        return direction is None or direction(row[1], row[2])
+    return panoramas_grid().nearest(lon, lat, k, accept, max_distance)
@@ -1,20 +1,76 @@
-import sys
+import time
+import threading
+from uuid import UUID
+from collections import OrderedDict
 
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from rest_framework import permissions
 from .models import appkeys
 
 
+class appkeysCache(object):
+    """
+    In-process LRU cache of apikey validity with expiration. Entries are dropped on
+    appkeys save/delete in this process, the ttl bounds staleness in other workers.
+    stats counts cache hits, misses and the database queries issued.
+    """
+
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'queries': 0}
+
+    def is_valid(self, api_key):
+        try:
+            key = UUID(str(api_key))
+        except ValueError:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+            self.stats['queries'] += 1
+        valid = appkeys.objects.filter(key=key).exists()
+        with self.lock:
+            self.entries[key] = (valid, now + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return valid
+
+    def invalidate(self, api_key=None):
+        with self.lock:
+            if api_key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(api_key, None)
+
+appkeys_cache = appkeysCache(
+    size=getattr(settings, 'WS_APPKEY_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'WS_APPKEY_CACHE_TTL', 300),
+)
+
+@receiver(post_save, sender=appkeys)
+@receiver(post_delete, sender=appkeys)
+def invalidate_appkey(sender, instance, **kwargs):
+    appkeys_cache.invalidate(instance.key)
+
+
 class baseAPIPermission(permissions.BasePermission):
 
     message = 'Bad apikey.'
 
     def has_permission(self, request, view):
-        try:
-            api_key = request.query_params.get('apikey', False)
-            print ("api_key",api_key, file=sys.stderr)
-            #api_key_post = request.query_params.post('apikey', False)
-            appkeys.objects.get(key=api_key)# or api_key_post)
+        api_key = request.query_params.get('apikey', False)
+        #api_key_post = request.query_params.post('apikey', False)
+        if api_key and appkeys_cache.is_valid(api_key):
             return True
-        except Exception as e:
-            print ("baseAPIPermission failed",e, file=sys.stderr)
-            return False
+        return False
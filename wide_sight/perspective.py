@@ -0,0 +1,138 @@
+import io
+import math
+import base64
+import hashlib
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import image_objects
+from .photogrammetry import camera_rotations
+
+# Rectilinear views of the equirectangular images. yaw and pitch are the img_lon and
+# img_lat of the view center in the image frame (see photogrammetry): a view centered on
+# an image object uses its own coordinates. The source is decoded with draft() at the
+# smallest JPEG scale that keeps the resolution of the view, every output pixel is
+# bilinearly sampled along its ray. Encoded views are cached by image and parameters.
+
+PERSPECTIVE_MAX_SIZE = getattr(settings, 'WS_PERSPECTIVE_MAX_SIZE', 2048)
+PERSPECTIVE_QUALITY = getattr(settings, 'WS_PERSPECTIVE_QUALITY', 85)
+PERSPECTIVE_CACHE_TIMEOUT = getattr(settings, 'WS_PERSPECTIVE_CACHE_TIMEOUT', 24 * 3600)
+
+def perspective_params(params, fov=90, width=640, height=480):
+    """
+    yaw, pitch, fov (horizontal, degrees), width, height from the url parameters.
+    Raises ValueError on bad values
+    """
+    yaw = (float(params.get('yaw', 0)) + 180) % 360 - 180
+    pitch = float(params.get('pitch', 0))
+    fov = float(params.get('fov', fov))
+    width = int(params.get('width', width))
+    height = int(params.get('height', height))
+    if not -90 <= pitch <= 90 or not 1 <= fov <= 150:
+        raise ValueError('pitch must be in [-90, 90] and fov in [1, 150]')
+    if not (1 <= width <= PERSPECTIVE_MAX_SIZE and 1 <= height <= PERSPECTIVE_MAX_SIZE):
+        raise ValueError('width and height must be in [1, %d]' % PERSPECTIVE_MAX_SIZE)
+    return round(yaw, 2), round(pitch, 2), round(fov, 2), width, height
+
+def focal_length(fov, width):
+    return width / 2.0 / math.tan(math.radians(fov) / 2)
+
+def load_equirectangular(pano, fov, width):
+    """
+    (H,W,3) uint8 pixels of the panorama image, at least as detailed as a view of
+    width pixels over fov degrees at its center
+    """
+    source_width = int(math.ceil(2 * math.pi * focal_length(fov, width)))
+    with pano.eqimage.open('rb') as img_file:
+        img = Image.open(img_file)
+        img.draft('RGB', (source_width, source_width // 2))
+        img = img.convert('RGB')
+    return np.asarray(img)
+
+def view_coordinates(image_shape, yaw, pitch, fov, width, height):
+    """
+    source pixel coordinates (u, v) of every pixel of the view, (height, width) arrays
+    """
+    f = focal_length(fov, width)
+    x = np.arange(width, dtype=np.float64) + 0.5 - width / 2.0
+    z = height / 2.0 - np.arange(height, dtype=np.float64) - 0.5
+    rays = np.empty((height, width, 3))
+    rays[:, :, 0] = x[None, :]
+    rays[:, :, 1] = f
+    rays[:, :, 2] = z[:, None]
+    rotation = camera_rotations(np.array([yaw]), np.array([pitch]), np.zeros(1))[0]
+    rays = np.matmul(rays, rotation.T)
+    lon = np.arctan2(rays[:, :, 0], rays[:, :, 1])
+    lat = np.arctan2(rays[:, :, 2], np.hypot(rays[:, :, 0], rays[:, :, 1]))
+    source_height, source_width = image_shape[:2]
+    u = (lon / (2 * np.pi) + 0.5) * source_width - 0.5
+    v = (0.5 - lat / np.pi) * source_height - 0.5
+    return u, v
+
+def sample_bilinear(image, u, v):
+    """
+    bilinear sampling of image at (u, v), wrapping around horizontally
+    """
+    source_height, source_width = image.shape[:2]
+    v = np.clip(v, 0, source_height - 1)
+    u0, v0 = np.floor(u), np.floor(v)
+    du, dv = (u - u0)[:, :, None], (v - v0)[:, :, None]
+    x0 = u0.astype(np.intp) % source_width
+    x1 = (x0 + 1) % source_width
+    y0 = v0.astype(np.intp)
+    y1 = np.minimum(y0 + 1, source_height - 1)
+    top = image[y0, x0] * (1 - du) + image[y0, x1] * du
+    bottom = image[y1, x0] * (1 - du) + image[y1, x1] * du
+    return np.clip(top * (1 - dv) + bottom * dv + 0.5, 0, 255).astype(np.uint8)
+
+def render_view(image, yaw, pitch, fov, width, height, quality=PERSPECTIVE_QUALITY):
+    """
+    jpeg bytes of the view
+    """
+    u, v = view_coordinates(image.shape, yaw, pitch, fov, width, height)
+    output = io.BytesIO()
+    Image.fromarray(sample_bilinear(image, u, v)).save(output, 'JPEG', quality=quality)
+    return output.getvalue()
+
+def view_key(pano, params):
+    # the stored name changes with the image content: replaced images are never served from cache
+    key = '%s|%s|%s' % (pano.pk, pano.eqimage.name, ','.join(str(value) for value in params))
+    return 'ws_perspective_%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def perspective_view(pano, params):
+    """
+    (cache key, jpeg bytes) of the view of pano with params (yaw, pitch, fov, width, height)
+    """
+    key = view_key(pano, params)
+    content = cache.get(key)
+    if content is None:
+        content = render_view(load_equirectangular(pano, params[2], params[3]), *params)
+        cache.set(key, content, PERSPECTIVE_CACHE_TIMEOUT)
+    return key, content
+
+def image_object_views(pano, fov=30, width=256, height=256):
+    """
+    views centered on every image object of pano, rendered from a single decode of
+    the image. Returns dicts of image object id, view params and jpeg bytes
+    """
+    objects = image_objects.objects.filter(panorama=pano, img_lon__isnull=False, img_lat__isnull=False).values_list('pk', 'img_lon', 'img_lat')
+    views = []
+    for pk, img_lon, img_lat in objects:
+        params = perspective_params({'yaw': img_lon, 'pitch': max(-90, min(90, img_lat)), 'fov': fov, 'width': width, 'height': height})
+        views.append({'image_object': pk, 'params': params, 'key': view_key(pano, params)})
+    cached = cache.get_many([view['key'] for view in views])
+    missing = [view for view in views if view['key'] not in cached]
+    if missing:
+        image = load_equirectangular(pano, fov, width)
+        rendered = {view['key']: render_view(image, *view['params']) for view in missing}
+        cache.set_many(rendered, PERSPECTIVE_CACHE_TIMEOUT)
+        cached.update(rendered)
+    for view in views:
+        view['content'] = cached[view.pop('key')]
+    return views
+
+def data_uri(content, content_type='image/jpeg'):
+    return 'data:%s;base64,%s' % (content_type, base64.b64encode(content).decode('ascii'))
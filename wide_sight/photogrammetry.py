@@ -0,0 +1,161 @@
+import numpy as np
+import utm
+from django.contrib.gis.geos import Point
+from django.db import transaction
+
+from .models import image_objects, bump_change_counter
+from .utils import utm_from_lonlat_arrays
+
+# Camera frame: x right, y forward (image center, img_lon = 0), z up (img_lat = 90).
+# World frame: UTM easting, northing, height from the ground below the camera.
+# heading rotates clockwise from north, positive pitch raises the forward axis,
+# positive roll lowers the right side.
+
+OBSERVATION_FIELDS = (
+    'pk', 'img_lon', 'img_lat',
+    'panorama__lon', 'panorama__lat', 'panorama__utm_x', 'panorama__utm_y', 'panorama__utm_srid',
+    'panorama__heading', 'panorama__pitch', 'panorama__roll',
+    'panorama__height_correction', 'panorama__sequence__height_from_ground',
+)
+
+def camera_rotations(heading, pitch, roll):
+    """
+    (N,3,3) camera to world rotation matrices from angles in degrees
+    """
+    h, p, r = np.radians(heading), np.radians(pitch), np.radians(roll)
+    n = len(h)
+    yaw = np.zeros((n, 3, 3))
+    yaw[:, 0, 0], yaw[:, 0, 1] = np.cos(h), np.sin(h)
+    yaw[:, 1, 0], yaw[:, 1, 1] = -np.sin(h), np.cos(h)
+    yaw[:, 2, 2] = 1
+    tilt = np.zeros((n, 3, 3))
+    tilt[:, 0, 0] = 1
+    tilt[:, 1, 1], tilt[:, 1, 2] = np.cos(p), -np.sin(p)
+    tilt[:, 2, 1], tilt[:, 2, 2] = np.sin(p), np.cos(p)
+    bank = np.zeros((n, 3, 3))
+    bank[:, 0, 0], bank[:, 0, 2] = np.cos(r), np.sin(r)
+    bank[:, 1, 1] = 1
+    bank[:, 2, 0], bank[:, 2, 2] = -np.sin(r), np.cos(r)
+    return np.matmul(np.matmul(yaw, tilt), bank)
+
+def observation_directions(img_lon, img_lat, heading, pitch, roll):
+    """
+    (N,3) unit world directions of points seen at img_lon/img_lat on equirectangular images
+    """
+    lon, lat = np.radians(img_lon), np.radians(img_lat)
+    camera = np.stack([np.cos(lat) * np.sin(lon), np.cos(lat) * np.cos(lon), np.sin(lat)], axis=1)
+    return np.matmul(camera_rotations(heading, pitch, roll), camera[:, :, None])[:, :, 0]
+
+def intersect_rays(origins, directions, groups, group_count):
+    """
+    Least squares intersection of the rays of every group: minimizes the sum of squared
+    distances from the rays. Returns points (G,3), rms distance of the rays from the point (G)
+    and a validity mask (at least two non parallel rays, point in front of every camera)
+    """
+    projectors = np.eye(3)[None, :, :] - directions[:, :, None] * directions[:, None, :]
+    a = np.zeros((group_count, 3, 3))
+    b = np.zeros((group_count, 3))
+    np.add.at(a, groups, projectors)
+    np.add.at(b, groups, np.matmul(projectors, origins[:, :, None])[:, :, 0])
+
+    valid = np.abs(np.linalg.det(a)) > 1e-9
+    points = np.full((group_count, 3), np.nan)
+    points[valid] = np.linalg.solve(a[valid], b[valid][:, :, None])[:, :, 0]
+
+    offsets = points[groups] - origins
+    residuals = np.matmul(projectors, offsets[:, :, None])[:, :, 0]
+    squared = np.zeros(group_count)
+    np.add.at(squared, groups, np.sum(residuals**2, axis=1))
+    counts = np.bincount(groups, minlength=group_count)
+    rms = np.sqrt(squared / np.maximum(counts, 1))
+
+    behind = np.zeros(group_count, dtype=bool)
+    np.logical_or.at(behind, groups, np.sum(offsets * directions, axis=1) <= 0)
+    valid &= ~behind & (counts >= 2)
+    return points, rms, valid
+
+def match_groups(pks, links):
+    """
+    connected components of the match relation. Returns the group index of every pk
+    """
+    parent = {pk: pk for pk in pks}
+    def find(pk):
+        while parent[pk] != pk:
+            parent[pk] = parent[parent[pk]]
+            pk = parent[pk]
+        return pk
+    for source, target in links:
+        if source in parent and target in parent:
+            parent[find(source)] = find(target)
+    roots = {}
+    return np.array([roots.setdefault(find(pk), len(roots)) for pk in pks]), len(roots)
+
+def solve_image_objects(queryset=None, types=(3, 4)):
+    """
+    Geolocates every matched group of image objects (stereo interpretation, visual
+    intersection) in one vectorized pass and stores lon, lat, UTM fields, height and
+    accurancy (rms distance in meters of the observation rays from the solution).
+    Returns {image object pk: (lon, lat, height, accurancy)} of the solved objects
+    """
+    queryset = image_objects.objects.all() if queryset is None else queryset
+    rows = list(queryset.filter(
+        type__in=types, img_lon__isnull=False, img_lat__isnull=False,
+        panorama__lon__isnull=False, panorama__lat__isnull=False,
+    ).values_list(*OBSERVATION_FIELDS))
+    if not rows:
+        return {}
+    pks = [row[0] for row in rows]
+    through = image_objects.match.through
+    links = through.objects.filter(from_image_objects__in=pks).values_list('from_image_objects', 'to_image_objects')
+    groups, group_count = match_groups(pks, links)
+
+    columns = list(zip(*rows))
+    def floats(index, default=np.nan):
+        return np.array([default if value is None else value for value in columns[index]], dtype=float)
+    img_lon, img_lat = floats(1), floats(2)
+    lon, lat, utm_x, utm_y = floats(3), floats(4), floats(5), floats(6)
+    srid = np.array([value or 0 for value in columns[7]], dtype=int)
+    heading, pitch, roll = floats(8, 0), floats(9, 0), floats(10, 0)
+    height = np.where(np.isnan(floats(11)), floats(12, 0), floats(11))
+
+    # every group is solved in the UTM zone of its first observation
+    first = np.unique(groups, return_index=True)[1]
+    group_lon, group_lat = lon[first], lat[first]
+    group_zone = utm_from_lonlat_arrays(group_lon, group_lat)[2]
+    group_srid = np.where(group_lat < 0, 32700, 32600) + group_zone
+    reprojected_x, reprojected_y = utm_from_lonlat_arrays(lon, lat, zone=group_zone[groups])[:2]
+    stored = (srid == group_srid[groups]) & ~np.isnan(utm_x) & ~np.isnan(utm_y)
+    origins = np.stack([np.where(stored, utm_x, reprojected_x), np.where(stored, utm_y, reprojected_y), height], axis=1)
+
+    directions = observation_directions(img_lon, img_lat, heading, pitch, roll)
+    points, rms, valid = intersect_rays(origins, directions, groups, group_count)
+
+    solutions = {}
+    for zone_srid in np.unique(group_srid[valid]):
+        selected = np.nonzero(valid & (group_srid == zone_srid))[0]
+        solved_lat, solved_lon = utm.to_latlon(points[selected, 0], points[selected, 1], int(zone_srid) % 100, northern=zone_srid < 32700, strict=False)
+        letters = utm_from_lonlat_arrays(solved_lon, solved_lat, zone=int(zone_srid) % 100)[3]
+        for index, group in enumerate(selected):
+            solutions[group] = (float(solved_lon[index]), float(solved_lat[index]), int(zone_srid), letters[index])
+
+    updated = []
+    for pk, group in zip(pks, groups):
+        if group not in solutions:
+            continue
+        solved_lon, solved_lat, zone_srid, letter = solutions[group]
+        updated.append(image_objects(
+            pk=pk,
+            lon=solved_lon,
+            lat=solved_lat,
+            utm_x=float(points[group, 0]),
+            utm_y=float(points[group, 1]),
+            utm_code='%d%s' % (zone_srid % 100, letter),
+            utm_srid=zone_srid,
+            height=int(round(points[group, 2])),
+            accurancy=float(rms[group]),
+            geom=Point(solved_lon, solved_lat, srid=4326),
+        ))
+    with transaction.atomic():
+        image_objects.objects.bulk_update(updated, ['lon', 'lat', 'utm_x', 'utm_y', 'utm_code', 'utm_srid', 'height', 'accurancy', 'geom'], batch_size=1000)
+    bump_change_counter('image_objects')
+    return {obj.pk: (obj.lon, obj.lat, obj.height, obj.accurancy) for obj in updated}
@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+
+from PIL import Image, ImageFilter
+from django.conf import settings
+from rest_framework.reverse import reverse
+
+from .media import with_apikey
+
+try:
+    import pillow_avif  # registers the AVIF plugin on Pillow builds without it
+except ImportError:
+    pillow_avif = None
+
+# Derived images of the equirectangular panoramas, declared by name: target width,
+# formats and quality, optional blur (the placeholder). Files are written on first
+# request or by `manage.py build_renditions` under MEDIA_ROOT/renditions/{panorama id}/
+# and removed with the panorama or when its image is replaced.
+
+RENDITIONS = getattr(settings, 'WS_RENDITIONS', {
+    'placeholder': {'width': 32, 'formats': ('jpeg',), 'quality': 50, 'blur': 1},
+    'thumbnail': {'width': 480, 'formats': ('jpeg', 'webp'), 'quality': 60},
+    'small': {'width': 1024, 'formats': ('jpeg', 'webp', 'avif'), 'quality': 75},
+    'medium': {'width': 2048, 'formats': ('jpeg', 'webp', 'avif'), 'quality': 80},
+})
+
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+    'avif': ('AVIF', 'avif'),
+}
+
+def format_available(fmt):
+    Image.init()
+    return fmt in FORMATS and FORMATS[fmt][0] in Image.SAVE
+
+def rendition_formats(name):
+    return [fmt for fmt in RENDITIONS[name]['formats'] if format_available(fmt)]
+
+def renditions_dir(pano_id):
+    return os.path.join(settings.MEDIA_ROOT, 'renditions', str(pano_id))
+
+def rendition_name(name, fmt):
+    return '%s.%s' % (name, FORMATS[fmt][1])
+
+def rendition_path(pano_id, name, fmt):
+    return os.path.join(renditions_dir(pano_id), rendition_name(name, fmt))
+
+def rendition_media_path(pano_id, name, fmt):
+    """
+    path relative to MEDIA_ROOT, as served by media_response
+    """
+    return '/'.join(('renditions', str(pano_id), rendition_name(name, fmt)))
+
+def rendition_urls(pano_id, request=None):
+    """
+    {rendition name: {format: url}} of a panorama
+    """
+    return {
+        name: {fmt: with_apikey(reverse('panoramas-rendition', args=[pano_id, name, fmt], request=request), request) for fmt in rendition_formats(name)}
+        for name in RENDITIONS
+    }
+
+def render_renditions(source, target_dir, names, force=False):
+    """
+    writes the named renditions of the image file source in target_dir and returns
+    the written file names. The JPEG is decoded once with draft() at the smallest DCT
+    scale still larger than the widest rendition, every smaller one is downscaled from
+    the previous. Plain arguments only so it can run in a process pool
+    """
+    todo = [(name, fmt) for name in names for fmt in rendition_formats(name)
+            if force or not os.path.exists(os.path.join(target_dir, rendition_name(name, fmt)))]
+    if not todo:
+        return []
+    names = sorted(set(name for name, fmt in todo), key=lambda name: -RENDITIONS[name]['width'])
+
+    img = Image.open(source)
+    width = RENDITIONS[names[0]]['width']
+    img.draft('RGB', (width, max(1, width * img.height // img.width)))
+    img.load()
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir, exist_ok=True)
+    written = []
+    level_img = img
+    for name in names:
+        spec = RENDITIONS[name]
+        width = min(spec['width'], img.width)
+        size = (width, max(1, int(round(float(width) * img.height / img.width))))
+        if level_img.size != size:
+            level_img = level_img.resize(size, Image.LANCZOS)
+        out_img = level_img.filter(ImageFilter.GaussianBlur(spec['blur'])) if spec.get('blur') else level_img
+        for fmt in rendition_formats(name):
+            if (name, fmt) not in todo:
+                continue
+            target = os.path.join(target_dir, rendition_name(name, fmt))
+            # written aside and renamed: concurrent requests never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=target_dir, suffix='.' + FORMATS[fmt][1])
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    out_img.save(tmp_file, FORMATS[fmt][0], quality=spec.get('quality', 75))
+                os.replace(tmp_path, target)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            written.append(rendition_name(name, fmt))
+    return written
+
+def build_renditions(pano, names=None, force=False):
+    """
+    renditions of a panorama (all of them by default), read through its storage
+    """
+    names = list(names or RENDITIONS)
+    with pano.eqimage.open('rb') as img_file:
+        return render_renditions(img_file, renditions_dir(pano.pk), names, force)
+
+def get_rendition(pano, name, fmt):
+    """
+    path of a rendition, generated if missing. None for unknown names or formats
+    """
+    if name not in RENDITIONS or fmt not in rendition_formats(name):
+        return None
+    path = rendition_path(pano.pk, name, fmt)
+    if not os.path.exists(path):
+        build_renditions(pano, [name])
+    return path
+
+def remove_renditions(pano):
+    shutil.rmtree(renditions_dir(pano.pk), ignore_errors=True)
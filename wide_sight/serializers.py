@@ -3,9 +3,28 @@ import sys
 import utm
 from rest_framework import serializers
 from django.contrib.gis.geos import GEOSGeometry, Point
+from django.core.exceptions import ValidationError
 from rest_framework.reverse import reverse
 from rest_framework_gis.serializers import GeoFeatureModelSerializer
-from .models import sequences, panoramas, image_object_types, image_objects, userkeys, appkeys
+from .renditions import rendition_urls
+from .media import with_apikey
+from .models import sequences, panoramas, image_object_types, image_objects, userkeys, appkeys, jobs
+
+class apikeyImageField(serializers.ImageField):
+    '''
+    image url carrying the apikey of the request (see media.with_apikey)
+    '''
+    def to_representation(self, value):
+        return with_apikey(super(apikeyImageField, self).to_representation(value), self.context.get('request'))
+
+
+class apikeyMediaMixin(object):
+    def build_standard_field(self, field_name, model_field):
+        field_class, field_kwargs = super(apikeyMediaMixin, self).build_standard_field(field_name, model_field)
+        if field_class is serializers.ImageField:
+            field_class = apikeyImageField
+        return field_class, field_kwargs
+
 
 class sequences_serializer(serializers.ModelSerializer):#HyperlinkedModelSerializer ModelSerializer
 
@@ -23,7 +42,7 @@ class sequences_serializer(serializers.ModelSerializer):#HyperlinkedModelSeriali
         }
 
 
-class panoramas_serializer(serializers.ModelSerializer):
+class panoramas_serializer(apikeyMediaMixin, serializers.ModelSerializer):
     #utm_geom = serializers.SerializerMethodField()
     def get_utm_geom(self,obj):
         if obj.lon and obj.lat:
@@ -38,6 +57,10 @@ class panoramas_serializer(serializers.ModelSerializer):
     def get_creator_name(self,obj):
         return obj.sequence.creator_key.user.username
 
+    renditions = serializers.SerializerMethodField()
+    def get_renditions(self,obj):
+        return rendition_urls(obj.pk, self.context.get('request'))
+
     height_from_ground = serializers.SerializerMethodField()
     def get_height_from_ground(self,obj):
         return obj.height_correction or obj.sequence.height_from_ground
@@ -48,7 +71,7 @@ class panoramas_serializer(serializers.ModelSerializer):
         fields = (
             'id',
             'eqimage',
-            #'eqimage_thumbnail',
+            'renditions',
             'geom',
             #'utm_geom',
             'sequence',
@@ -74,12 +97,16 @@ class panoramas_serializer(serializers.ModelSerializer):
             'note'
         )
 
-class panoramas_geo_serializer(GeoFeatureModelSerializer):
+class panoramas_geo_serializer(apikeyMediaMixin, GeoFeatureModelSerializer):
 
     creator_name = serializers.SerializerMethodField()
     def get_creator_name(self,obj):
         return obj.sequence.creator_key.user.username
 
+    renditions = serializers.SerializerMethodField()
+    def get_renditions(self,obj):
+        return rendition_urls(obj.pk, self.context.get('request'))
+
     class Meta:
         model = panoramas
         read_only_fields = ('id', 'utm_x', 'utm_y', 'utm_srid', 'utm_code', 'camera_prod', 'camera_model')
@@ -87,7 +114,7 @@ class panoramas_geo_serializer(GeoFeatureModelSerializer):
         fields = (
             'id',
             'eqimage',
-            #'eqimage_thumbnail',
+            'renditions',
             'geom',
             'sequence',
             'creator_name',
@@ -152,6 +179,26 @@ class image_objects_serializer(serializers.ModelSerializer):
             'creator_key': {'write_only': True}
         }
 
+class preloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    resolves pks from context['related_objects'][model], filled with one query per model
+    for a whole batch, instead of one query per value
+    """
+
+    def to_internal_value(self, data):
+        preloaded = self.context.get('related_objects', {}).get(self.get_queryset().model)
+        if preloaded is not None:
+            try:
+                key = self.get_queryset().model._meta.pk.to_python(data)
+            except ValidationError:
+                self.fail('incorrect_type', data_type=type(data).__name__)
+            if key in preloaded:
+                return preloaded[key]
+        return super(preloadedPrimaryKeyRelatedField, self).to_internal_value(data)
+
+class image_objects_bulk_serializer(image_objects_serializer):
+    serializer_related_field = preloadedPrimaryKeyRelatedField
+
 class image_objects_geo_serializer(GeoFeatureModelSerializer):
 
     creator_name = serializers.SerializerMethodField()
@@ -197,3 +244,8 @@ class appkeys_serializer(serializers.ModelSerializer):
     class Meta:
         model = appkeys
         fields = ('app_name', 'key', 'api_key')
+
+class jobs_serializer(serializers.ModelSerializer):
+    class Meta:
+        model = jobs
+        fields = ('id', 'task', 'status', 'result', 'error', 'created', 'started', 'finished')
@@ -0,0 +1,144 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils.functional import LazyObject
+from django.utils.module_loading import import_string
+
+try:
+    from storages.backends.s3boto3 import S3Boto3Storage
+except ImportError:
+    S3Boto3Storage = None
+
+# Panorama images are stored by content: the name is the sha256 of the file, so
+# identical uploads share one file. stored_files counts the references to every file
+# and delete() releases one of them, the file is removed with the last one.
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class contentAddressedMixin(object):
+    prefix = 'blobs'
+
+    def content_name(self, digest, extension):
+        return '/'.join((self.prefix, digest[:2], digest[2:4], digest + extension.lower()))
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        try:
+            content.seek(0)
+            spool = None
+        except (AttributeError, OSError, ValueError):
+            # not seekable: keep a copy while hashing
+            spool = tempfile.SpooledTemporaryFile(max_size=16 * CHUNK_SIZE)
+        for chunk in content.chunks(CHUNK_SIZE):
+            digest.update(chunk)
+            if spool is not None:
+                spool.write(chunk)
+        if spool is not None:
+            spool.seek(0)
+            content = File(spool, name=name)
+        else:
+            content.seek(0)
+
+        hashed = self.content_name(digest.hexdigest(), os.path.splitext(name)[1])
+        if not self.exists(hashed):
+            hashed = super(contentAddressedMixin, self)._save(hashed, content)
+        self.reference(hashed, content.size)
+        return hashed
+
+    def reference(self, name, size=None):
+        from .models import stored_files
+        if stored_files.objects.filter(name=name).update(references=F('references') + 1):
+            return
+        try:
+            with transaction.atomic():
+                stored_files.objects.create(name=name, size=size, references=1)
+        except IntegrityError:
+            # created concurrently: count on the existing row
+            stored_files.objects.filter(name=name).update(references=F('references') + 1)
+
+    def delete(self, name):
+        """
+        releases a reference: the file goes away with the last one (files stored before
+        reference counting have none and are removed at once)
+        """
+        from .models import stored_files
+        with transaction.atomic():
+            stored = stored_files.objects.select_for_update().filter(name=name).first()
+            if stored is not None and stored.references > 1:
+                stored_files.objects.filter(name=name).update(references=F('references') - 1)
+                return
+            stored_files.objects.filter(name=name).delete()
+
+        def remove():
+            if not stored_files.objects.filter(name=name).exists():
+                super(contentAddressedMixin, self).delete(name)
+        transaction.on_commit(remove)
+
+
+class contentAddressedFileSystemStorage(contentAddressedMixin, FileSystemStorage):
+    pass
+
+
+if S3Boto3Storage is not None:
+
+    class contentAddressedS3Storage(contentAddressedMixin, S3Boto3Storage):
+        """
+        S3 bucket (AWS_STORAGE_BUCKET_NAME) with multipart uploads; AWS_S3_ENDPOINT_URL
+        points it to any S3 compatible server, e.g. a local MinIO for tests
+        """
+        pass
+
+
+class panoramaStorage(LazyObject):
+    def _setup(self):
+        self._wrapped = import_string(getattr(settings, 'WS_PANORAMA_STORAGE', 'wide_sight.storage.contentAddressedFileSystemStorage'))()
+
+panorama_storage = panoramaStorage()
+
+
+def rewrite_file(field_file, modify):
+    """
+    applies modify(local path) to a stored file and returns its name. Content addressed
+    files are shared and immutable: the modified copy is stored as a new file, the
+    caller releases the old name once nothing refers to it
+    """
+    storage = field_file.storage
+    if not isinstance(storage, contentAddressedMixin):
+        modify(field_file.path)
+        return field_file.name
+    extension = os.path.splitext(field_file.name)[1]
+    with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as local:
+        with storage.open(field_file.name, 'rb') as stored:
+            shutil.copyfileobj(stored, local, CHUNK_SIZE)
+    try:
+        modify(local.name)
+        with open(local.name, 'rb') as modified:
+            return storage.save(field_file.name, File(modified, name=os.path.basename(field_file.name)))
+    finally:
+        os.remove(local.name)
+
+def local_path(field_file):
+    """
+    filesystem path of a stored file, None for remote storages
+    """
+    try:
+        return field_file.storage.path(field_file.name)
+    except NotImplementedError:
+        return None
+
+def remove_sequence_dir(seq):
+    """
+    removes the (empty) upload directory of a sequence on filesystem storages
+    """
+    try:
+        os.rmdir(panorama_storage.path(os.path.join('panos', str(seq.pk))))
+    except (NotImplementedError, OSError):
+        pass
@@ -0,0 +1,155 @@
+import json
+import logging
+import threading
+import traceback
+from uuid import UUID
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import jobs, panoramas, sequences
+from .ingest import load_panoramas
+from .tiles import build_tiles
+from .renditions import build_renditions
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+def task(func):
+    """
+    registers func as a background task callable by name. Keyword arguments and
+    return value must be json serializable
+    """
+    registry[func.__name__] = func
+    return func
+
+def enqueue(task_name, creator=None, **params):
+    """
+    stores a queued job and hands it to the configured backend once the current transaction commits
+    """
+    if task_name not in registry:
+        raise KeyError('unknown task %s' % task_name)
+    job = jobs.objects.create(task=task_name, params=json.dumps(params), creator=creator)
+    backend = get_backend()
+    transaction.on_commit(lambda: backend.submit(job))
+    return job
+
+def claim_next_job():
+    for job in jobs.objects.filter(status='queued').order_by('created')[:10]:
+        if jobs.objects.filter(pk=job.pk, status='queued').update(status='running', started=timezone.now()):
+            job.status = 'running'
+            return job
+    return None
+
+def run_job(job):
+    try:
+        result = registry[job.task](**json.loads(job.params or '{}'))
+        job.result = json.dumps(result)
+        job.status = 'done'
+    except Exception:
+        job.error = traceback.format_exc()
+        job.status = 'failed'
+        logger.exception('job %s (%s) failed', job.pk, job.task)
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished'])
+    return job
+
+def run_pending():
+    """
+    processes queued jobs until the queue is empty, returns the number of processed jobs
+    """
+    count = 0
+    job = claim_next_job()
+    while job:
+        run_job(job)
+        count += 1
+        job = claim_next_job()
+    return count
+
+
+class syncBackend(object):
+    """
+    runs the job immediately in the calling thread (tests)
+    """
+    def submit(self, job):
+        if jobs.objects.filter(pk=job.pk, status='queued').update(status='running', started=timezone.now()):
+            run_job(job)
+
+
+class threadBackend(object):
+    """
+    in-process worker thread draining the database queue (development)
+    """
+    lock = threading.Lock()
+    worker = None
+
+    def submit(self, job):
+        with self.lock:
+            if threadBackend.worker is None:
+                threadBackend.worker = threading.Thread(target=self.work, daemon=True)
+                threadBackend.worker.start()
+
+    def work(self):
+        try:
+            while True:
+                job = claim_next_job()
+                if job is None:
+                    with self.lock:
+                        job = claim_next_job()
+                        if job is None:
+                            threadBackend.worker = None
+                            return
+                run_job(job)
+        finally:
+            connection.close()
+
+
+class queueBackend(object):
+    """
+    jobs stay queued in the database until a `manage.py run_jobs` worker picks them up (production)
+    """
+    def submit(self, job):
+        pass
+
+
+def get_backend():
+    return import_string(getattr(settings, 'WS_TASK_BACKEND', 'wide_sight.tasks.threadBackend'))()
+
+
+@task
+def process_panorama(panorama):
+    """
+    EXIF reading, renditions and tiles generation of a panorama saved with deferred upload processing
+    """
+    pano = panoramas.objects.get(pk=UUID(panorama))
+    pano.read_exif()
+    pano.save()
+    build_renditions(pano)
+    build_tiles(pano)
+    return {'panorama': str(pano.pk)}
+
+@task
+def ingest_stored(sequence, stored):
+    """
+    loads [panorama id, stored image name] pairs already written by the bulk upload endpoint
+    """
+    seq = sequences.objects.get(pk=UUID(sequence))
+    new_panos = [panoramas(id=UUID(pk), sequence=seq, eqimage=name) for pk, name in stored]
+    load_panoramas(seq, new_panos)
+    for pano in new_panos:
+        build_renditions(pano)
+        build_tiles(pano)
+    return {'panoramas': [str(pano.pk) for pano in new_panos]}
+
+@task
+def build_panorama_tiles(panoramas_ids):
+    """
+    tile pyramid and renditions generation of panoramas loaded synchronously
+    """
+    for pano in panoramas.objects.filter(pk__in=[UUID(pk) for pk in panoramas_ids]):
+        build_renditions(pano)
+        build_tiles(pano)
+    return {'panoramas': panoramas_ids}
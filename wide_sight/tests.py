@@ -1,3 +1,789 @@
-from django.test import TestCase
+import io
+import os
+import math
+import uuid
+import shutil
+import datetime
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import utm
+import piexif
+import numpy as np
+from PIL import Image
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.http import Http404
+from django.test import TestCase, TransactionTestCase, SimpleTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from .models import sequences, panoramas, panorama_links, image_objects, userkeys, appkeys, stored_files, bump_change_counter, update_sequence, deferred_upload_processing
+from .exif_gps import read_exif_header, get_exif_values
+from .storage import panorama_storage
+from .permissions import appkeys_cache
+from .media import media_response
+from .tiles import build_tiles, read_manifest
+from .bulk import bulk_image_objects
+from .utils import utm_from_lonlat_arrays
+from .photogrammetry import observation_directions, intersect_rays, solve_image_objects
+from .monoplot import demTiles, dem_intersections, monoplot_image_objects
+from . import nearest
+
+
+class apiTestCase(TestCase):
+
+    def setUp(self):
+        # cached responses are versioned by counters rolled back with every test
+        cache.clear()
+        self.user = User.objects.create(username='query_count')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def create_rows(self, count):
+        creator = userkeys.objects.create(user=User.objects.create(username='creator_%d' % userkeys.objects.count()))
+        seq = sequences.objects.create(title='query_count', creator_key=creator)
+        start_time = datetime.datetime(2018, 1, 1)
+        new_panos = [
+            panoramas(sequence=seq, eqimage='panos/%d.jpg' % i, lon=11.87, lat=45.40, shooting_time=start_time + datetime.timedelta(seconds=i))
+            for i in range(count)
+        ]
+        panoramas.objects.bulk_create(new_panos)
+        new_objects = [image_objects(type=1, panorama=pano, creator_key=creator) for pano in new_panos]
+        image_objects.objects.bulk_create(new_objects)
+        for obj in new_objects[1:]:
+            obj.match.add(new_objects[0])
+        # bulk_create sends no signal: count the changes like the bulk endpoints do
+        bump_change_counter('sequences', 'panoramas', 'image_objects')
+
+
+class constantQueriesTestCase(apiTestCase):
+    """
+    list endpoints must issue the same number of queries whatever the page size
+    """
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, {'page_size': 1000})
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url):
+        self.create_rows(2)
+        few = self.count_queries(url)
+        self.create_rows(20)
+        many = self.count_queries(url)
+        self.assertEqual(few, many, '%s: %d queries for 2 rows per sequence, %d for 20' % (url, few, many))
+
+    def test_sequences_list(self):
+        self.assertConstantQueries('/sequences/')
+
+    def test_panoramas_list(self):
+        self.assertConstantQueries('/panoramas/')
+
+    def test_panoramas_geojson_list(self):
+        self.assertConstantQueries('/panoramas/?as_geojson=1')
+
+    def test_image_objects_list(self):
+        self.assertConstantQueries('/image_objects/')
+
+    def test_image_objects_geojson_list(self):
+        self.assertConstantQueries('/image_objects/?as_geojson=1')
+
+
+class conditionalCacheTestCase(apiTestCase):
+    """
+    read endpoints answer 304 until a change of their models
+    """
+
+    def get(self, url, **headers):
+        response = self.client.get(url, **headers)
+        self.assertIn(response.status_code, (200, 304))
+        return response
+
+    def test_not_modified(self):
+        self.create_rows(2)
+        response = self.get('/panoramas/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get('/panoramas/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_invalidated_by_save(self):
+        self.create_rows(2)
+        etag = self.get('/sequences/')['ETag']
+        seq = sequences.objects.first()
+        seq.title = 'renamed'
+        seq.save()
+        response = self.get('/sequences/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('renamed', [row['title'] for row in response.data['results']])
+
+    def test_invalidated_by_match_change(self):
+        self.create_rows(3)
+        etag = self.get('/image_objects/')['ETag']
+        first, second, third = image_objects.objects.all()[:3]
+        second.match.add(third)
+        self.assertEqual(self.get('/image_objects/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_browsable_api_not_cached(self):
+        self.create_rows(2)
+        response = self.get('/panoramas/', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+
+def jpeg_bytes(width=64, height=32):
+    image = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 40)).save(image, 'JPEG')
+    return image.getvalue()
+
+
+class keysetPaginationTestCase(apiTestCase):
+    """
+    keyset pages follow shooting_time then pk, panoramas without shooting time first
+    """
+
+    def walk(self, url, **params):
+        ids = []
+        response = self.client.get(url, dict(params, pagination='keyset', page_size=2))
+        while True:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            ids += [row['id'] for row in response.data['results']]
+            if not response.data['next']:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_ordering_and_nulls(self):
+        creator = userkeys.objects.create(user=User.objects.create(username='keyset'))
+        seq = sequences.objects.create(title='keyset', creator_key=creator)
+        start_time = datetime.datetime(2018, 1, 1)
+        times = [None, start_time, None, start_time + datetime.timedelta(seconds=1), start_time, None, start_time]
+        new_panos = [panoramas(sequence=seq, eqimage='panos/%d.jpg' % i, shooting_time=shooting_time) for i, shooting_time in enumerate(times)]
+        panoramas.objects.bulk_create(new_panos)
+        bump_change_counter('panoramas')
+
+        expected = sorted(new_panos, key=lambda pano: (pano.shooting_time is not None, pano.shooting_time or start_time, pano.pk))
+        self.assertEqual(self.walk('/panoramas/'), [str(pano.pk) for pano in expected])
+
+    def test_pk_ordering(self):
+        self.create_rows(5)
+        expected = sorted(image_objects.objects.values_list('pk', flat=True))
+        self.assertEqual(self.walk('/image_objects/'), [str(pk) for pk in expected])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/panoramas/', {'cursor': 'not a cursor'}).status_code, 404)
+
+
+class bulkImageObjectsTestCase(apiTestCase):
+    """
+    bulk operations are applied all together or not at all
+    """
+
+    def setUp(self):
+        super(bulkImageObjectsTestCase, self).setUp()
+        self.create_rows(3)
+        self.pano = panoramas.objects.first()
+        self.creator_key = str(self.pano.sequence.creator_key_id)
+        self.existing = list(image_objects.objects.values_list('pk', flat=True))
+
+    def new_object(self, **fields):
+        return dict({'type': 1, 'panorama': str(self.pano.pk), 'creator_key': self.creator_key}, **fields)
+
+    def post(self, data):
+        return self.client.post('/image_objects/bulk/', data, format='json')
+
+    def test_applied(self):
+        response = self.post({
+            'create': [self.new_object(note='created')],
+            'update': [{'id': str(self.existing[0]), 'note': 'updated'}],
+            'delete': [str(self.existing[1])],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['created']), 1)
+        self.assertEqual(image_objects.objects.get(pk=response.data['created'][0]).note, 'created')
+        self.assertEqual(image_objects.objects.get(pk=self.existing[0]).note, 'updated')
+        self.assertFalse(image_objects.objects.filter(pk=self.existing[1]).exists())
+
+    def test_invalid_operation_rolls_back(self):
+        response = self.post({
+            'create': [self.new_object(note='created')],
+            'update': [{'id': str(uuid.uuid4()), 'note': 'missing'}, {'id': str(self.existing[0]), 'type': 'not a type'}],
+            'delete': [str(self.existing[1])],
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.assertEqual(sorted(image_objects.objects.values_list('pk', flat=True)), sorted(self.existing))
+        self.assertFalse(image_objects.objects.filter(note='created').exists())
+
+    def test_failure_while_writing_rolls_back(self):
+        operations = {
+            'create': [self.new_object(type=2, img_lon=10, img_lat=-20)],
+            'delete': [str(self.existing[1])],
+        }
+        with mock.patch('wide_sight.bulk.monoplot_image_objects', side_effect=RuntimeError('projection failed')):
+            with self.assertRaises(RuntimeError):
+                bulk_image_objects(operations)
+        self.assertEqual(sorted(image_objects.objects.values_list('pk', flat=True)), sorted(self.existing))
+
+
+class nearestTestCase(apiTestCase):
+    """
+    nearest panoramas by distance, bad parameters answer 400
+    """
+
+    def setUp(self):
+        super(nearestTestCase, self).setUp()
+        # the SpatiaLite grid outlives the rolled back rows of other tests
+        nearest._grid['index'] = None
+        self.addCleanup(nearest._grid.update, index=None)
+        creator = userkeys.objects.create(user=User.objects.create(username='nearest'))
+        seq = sequences.objects.create(title='nearest', creator_key=creator)
+        self.panos = [
+            panoramas(sequence=seq, eqimage='panos/%d.jpg' % i, lon=11.87 + i * 0.0001, lat=45.40, geom=Point(11.87 + i * 0.0001, 45.40, srid=4326))
+            for i in range(5)
+        ]
+        panoramas.objects.bulk_create(self.panos)
+        bump_change_counter('panoramas')
+
+    def test_nearest(self):
+        response = self.client.get('/panoramas/nearest/', {'lon': 11.8702, 'lat': 45.40, 'k': 3})
+        self.assertEqual(response.status_code, 200)
+        ids = [row['id'] for row in response.data]
+        self.assertEqual(ids[0], str(self.panos[2].pk))
+        self.assertEqual(set(ids[1:]), {str(self.panos[1].pk), str(self.panos[3].pk)})
+        distances = [row['distance'] for row in response.data]
+        self.assertEqual(distances, sorted(distances))
+
+        response = self.client.get('/panoramas/nearest/', {'panorama': str(self.panos[0].pk), 'max_distance': 10})
+        self.assertEqual([row['id'] for row in response.data], [str(self.panos[1].pk)])
+
+    def test_bad_parameters(self):
+        for params in ({'lat': 45.40}, {'lon': 11.87, 'lat': 45.40, 'k': -1}, {'lon': 11.87, 'lat': 45.40, 'k': 'many'},
+                       {'lon': 11.87, 'lat': 45.40, 'max_distance': -5}, {'panorama': 'not an id'}):
+            self.assertEqual(self.client.get('/panoramas/nearest/', params).status_code, 400, params)
+
+
+class appkeysCacheTestCase(TestCase):
+    """
+    apikey validity is cached and dropped on appkeys save and delete
+    """
+
+    def setUp(self):
+        appkeys_cache.invalidate()
+        self.addCleanup(appkeys_cache.invalidate)
+
+    def test_cached(self):
+        api_key = appkeys.objects.create(app_name='cached').key
+        self.assertTrue(appkeys_cache.is_valid(api_key))
+        with self.assertNumQueries(0):
+            self.assertTrue(appkeys_cache.is_valid(str(api_key)))
+
+    def test_invalidated_by_save(self):
+        api_key = uuid.uuid4()
+        self.assertFalse(appkeys_cache.is_valid(api_key))
+        appkeys.objects.create(app_name='created', key=api_key)
+        self.assertTrue(appkeys_cache.is_valid(api_key))
+
+    def test_invalidated_by_delete(self):
+        appkey = appkeys.objects.create(app_name='deleted')
+        api_key = appkey.key
+        client = APIClient()
+        self.assertEqual(client.get('/sequences/', {'apikey': str(api_key)}).status_code, 200)
+        appkey.delete()
+        self.assertFalse(appkeys_cache.is_valid(api_key))
+        self.assertIn(client.get('/sequences/', {'apikey': str(api_key)}).status_code, (401, 403))
+
+    def test_malformed_key(self):
+        with self.assertNumQueries(0):
+            self.assertFalse(appkeys_cache.is_valid('not a key'))
+
+
+class mediaRootMixin(object):
+    """
+    temporary MEDIA_ROOT and a sequence to store panoramas in
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.creator = userkeys.objects.create(user=User.objects.create(username='media'))
+        self.seq = sequences.objects.create(title='media', creator_key=self.creator)
+
+    def stored_panorama(self, content=None, **fields):
+        name = panorama_storage.save('pano.jpg', ContentFile(content or jpeg_bytes()))
+        pano = panoramas(sequence=self.seq, eqimage=name, shooting_time=datetime.datetime(2018, 1, 1), **fields)
+        panoramas.objects.bulk_create([pano])
+        bump_change_counter('panoramas')
+        return pano
+
+
+class mediaTestCase(mediaRootMixin, TestCase):
+    pass
+
+
+class sequenceGeometryTestCase(mediaTestCase):
+    """
+    incremental sequence geometry updates match a full rebuild
+    """
+
+    def save_panorama(self, pano):
+        with deferred_upload_processing():
+            pano.save()
+
+    def assertRebuilt(self):
+        incremental = sequences.objects.get(pk=self.seq.pk).geom
+        update_sequence(self.seq)
+        rebuilt = sequences.objects.get(pk=self.seq.pk).geom
+        self.assertEqual(incremental.coords if incremental else None, rebuilt.coords if rebuilt else None)
+        return rebuilt
+
+    def test_add_move_remove(self):
+        start_time = datetime.datetime(2018, 1, 1)
+        new_panos = []
+        for i in (3, 0, 4, 1, 2):
+            pano = panoramas(sequence=self.seq, eqimage='panos/%d.jpg' % i, lon=11.87 + i * 0.0001, lat=45.40, shooting_time=start_time + datetime.timedelta(seconds=i))
+            self.save_panorama(pano)
+            new_panos.append(pano)
+            self.assertRebuilt()
+        self.assertEqual([lon for lon, lat in self.assertRebuilt().coords], [11.87 + i * 0.0001 for i in range(5)])
+
+        moved = new_panos[0]
+        moved.lon = 11.88
+        self.save_panorama(moved)
+        self.assertRebuilt()
+
+        moved.shooting_time = start_time - datetime.timedelta(seconds=1)
+        self.save_panorama(moved)
+        self.assertEqual(self.assertRebuilt().coords[0], (11.88, 45.40))
+
+        new_panos[2].delete()
+        self.assertEqual(len(self.assertRebuilt().coords), 4)
+        for pano in new_panos[3:]:
+            pano.delete()
+        self.assertRebuilt()
+
+
+class storedFilesTestCase(mediaRootMixin, TransactionTestCase):
+    """
+    identical images are stored once and removed with their last reference
+    """
+
+    def references(self, name):
+        return stored_files.objects.filter(name=name).values_list('references', flat=True).first()
+
+    def test_release_on_delete(self):
+        first, second = self.stored_panorama(), self.stored_panorama()
+        name = first.eqimage.name
+        self.assertEqual(second.eqimage.name, name)
+        self.assertTrue(name.startswith('blobs/'))
+        self.assertEqual(self.references(name), 2)
+
+        first.delete()
+        self.assertEqual(self.references(name), 1)
+        self.assertTrue(panorama_storage.exists(name))
+
+        second.delete()
+        self.assertIsNone(self.references(name))
+        self.assertFalse(panorama_storage.exists(name))
+
+    def test_release_on_replace(self):
+        pano = self.stored_panorama()
+        old_name = pano.eqimage.name
+        pano.eqimage.save('replaced.jpg', ContentFile(jpeg_bytes(32, 16)), save=False)
+        with deferred_upload_processing():
+            pano.save()
+        self.assertNotEqual(pano.eqimage.name, old_name)
+        self.assertEqual(self.references(pano.eqimage.name), 1)
+        self.assertIsNone(self.references(old_name))
+        self.assertFalse(panorama_storage.exists(old_name))
+
+
+class tilesTestCase(mediaTestCase):
+    """
+    tiles are served from a built pyramid, a missing one is left to a background job
+    """
+
+    def setUp(self):
+        super(tilesTestCase, self).setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.creator.user)
+        self.pano = self.stored_panorama()
+        self.url = '/panoramas/%s/tiles/0/0/0/' % self.pano.pk
+
+    def test_missing_pyramid_enqueued(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.client.get(self.url).data['job'], response.data['job'])
+        self.assertIsNone(read_manifest(self.pano))
+
+    def test_served(self):
+        build_tiles(self.pano)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get('/panoramas/%s/tiles/0/9/9/' % self.pano.pk).status_code, 404)
+
+    def test_removed_on_replace(self):
+        build_tiles(self.pano)
+        self.pano.eqimage.save('replaced.jpg', ContentFile(jpeg_bytes(32, 16)), save=False)
+        with deferred_upload_processing():
+            self.pano.save()
+        self.assertIsNone(read_manifest(self.pano))
+        self.assertEqual(self.client.get(self.url).status_code, 202)
+
+
+class apikeyMediaTestCase(mediaTestCase):
+    """
+    media links of serialized panoramas carry the apikey the client authenticated with
+    """
+
+    def test_image_from_serialized_panorama(self):
+        content = jpeg_bytes()
+        pano = self.stored_panorama(content)
+        api_key = str(appkeys.objects.create(app_name='viewer').key)
+        client = APIClient()
+        response = client.get('/panoramas/%s/' % pano.pk, {'apikey': api_key})
+        self.assertEqual(response.status_code, 200)
+        image_url = response.data['eqimage']
+        self.assertIn('apikey=%s' % api_key, image_url)
+        self.assertIn('apikey=%s' % api_key, response.data['renditions']['placeholder']['jpeg'])
+
+        image = client.get(image_url)
+        self.assertEqual(image.status_code, 200)
+        self.assertEqual(b''.join(image.streaming_content), content)
+        self.assertIn(client.get(image_url.split('?')[0]).status_code, (401, 403))
+
+
+class copyDatabaseTestCase(TransactionTestCase):
+    """
+    copy_database between two SpatiaLite aliases
+    """
+    databases = {'default', 'copy_target'}
+
+    def create_rows(self):
+        creator = userkeys.objects.create(user=User.objects.create(username='copy'))
+        creator.app_keys.add(appkeys.objects.create(app_name='copy'))
+        seq = sequences.objects.create(title='copy', creator_key=creator)
+        start_time = datetime.datetime(2018, 1, 1)
+        new_panos = [
+            panoramas(sequence=seq, eqimage='panos/%d.jpg' % i, lon=11.87 + i * 0.0001, lat=45.40, shooting_time=start_time + datetime.timedelta(seconds=i))
+            for i in range(5)
+        ]
+        panoramas.objects.bulk_create(new_panos)
+        panorama_links.objects.bulk_create([
+            panorama_links(from_panorama=prev_pano, to_panorama=next_pano, type='next') for prev_pano, next_pano in zip(new_panos, new_panos[1:])
+        ])
+        new_objects = [image_objects(type=1, panorama=pano, creator_key=creator) for pano in new_panos]
+        image_objects.objects.bulk_create(new_objects)
+        for obj in new_objects[1:]:
+            obj.match.add(new_objects[0])
+
+    def copy(self):
+        output = io.StringIO()
+        call_command('copy_database', 'default', 'copy_target', batch_size=2, stdout=output)
+        return output.getvalue()
+
+    def test_copy(self):
+        self.create_rows()
+        output = self.copy()
+
+        # parents are copied before the rows referencing them
+        copied = [line.split(':')[0] for line in output.splitlines()]
+        for parent, child in (('auth.User', 'wide_sight.userkeys'), ('wide_sight.sequences', 'wide_sight.panoramas'), ('wide_sight.panoramas', 'wide_sight.image_objects')):
+            self.assertLess(copied.index(parent), copied.index(child))
+
+        for model in (User, userkeys, sequences, panoramas, panorama_links, image_objects, image_objects.match.through, userkeys.app_keys.through):
+            self.assertEqual(
+                sorted(model.objects.using('copy_target').values_list('pk', flat=True)),
+                sorted(model.objects.values_list('pk', flat=True)),
+                model._meta.label
+            )
+        self.assertEqual(
+            sorted(panoramas.objects.using('copy_target').values_list('pk', 'geom', 'shooting_time')),
+            sorted(panoramas.objects.values_list('pk', 'geom', 'shooting_time'))
+        )
+
+        # auto increment keys continue after the copied ones
+        last = max(panorama_links.objects.using('copy_target').values_list('pk', flat=True))
+        link = panorama_links.objects.using('copy_target').first()
+        link.pk = None
+        link.save(using='copy_target')
+        self.assertGreater(link.pk, last)
+
+    def test_non_empty_target_refused(self):
+        self.create_rows()
+        self.copy()
+        with self.assertRaisesMessage(CommandError, 'target database is not empty'):
+            self.copy()
+
+
+class mediaResponseTestCase(SimpleTestCase):
+    """
+    byte ranges and validators of media_response
+    """
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        with open(os.path.join(self.media_root, 'file.jpg'), 'wb') as media_file:
+            media_file.write(self.content)
+
+    def get(self, **headers):
+        return media_response(RequestFactory().get('/media/file.jpg', **headers), 'file.jpg')
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_full(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.body(response), self.content)
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/%d' % len(self.content))
+        self.assertEqual(self.body(response), self.content[2:6])
+
+        response = self.get(HTTP_RANGE='bytes=-3')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.content[-3:])
+
+        response = self.get(HTTP_RANGE='bytes=1000-')
+        self.assertEqual(self.body(response), self.content[1000:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE='bytes=%d-' % len(self.content))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % len(self.content))
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag).status_code, 206)
+        # changed file: the whole content is sent
+        response = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+    def test_outside_media_root(self):
+        with self.assertRaises(Http404):
+            media_response(RequestFactory().get('/media/'), '../file.jpg')
+
+
+class utmArraysTestCase(SimpleTestCase):
+    """
+    vectorized UTM projection against utm.from_latlon
+    """
+    points = [
+        (11.87, 45.40), (-74.0, 40.7), (151.2, -33.87), (0.0, 0.0), (-179.9, -79.5), (179.9, 83.9),
+        # Norway: zone 32 extended west between 56 and 64 degrees north
+        (5.3, 60.4), (3.0, 63.9), (2.0, 56.5),
+        # Svalbard: zones 31, 33, 35 and 37 only
+        (8.0, 78.0), (15.0, 78.0), (25.0, 78.0), (40.0, 80.0),
+    ]
+
+    def assertProjected(self, projected, expected):
+        for (x, y, zone, letter), (easting, northing, zone_number, zone_letter) in zip(zip(*projected[:4]), expected):
+            self.assertAlmostEqual(x, easting, places=3)
+            self.assertAlmostEqual(y, northing, places=3)
+            self.assertEqual((zone, letter), (zone_number, zone_letter))
+
+    def test_own_zones(self):
+        lon = np.array([point[0] for point in self.points])
+        lat = np.array([point[1] for point in self.points])
+        projected = utm_from_lonlat_arrays(lon, lat)
+        self.assertProjected(projected, [utm.from_latlon(point[1], point[0]) for point in self.points])
+        for zone, point_lat, srid in zip(projected[2], lat, projected[4]):
+            self.assertEqual(srid, (32700 if point_lat < 0 else 32600) + zone)
+
+    def test_forced_zone(self):
+        lon = np.array([point[0] for point in self.points[:4]])
+        lat = np.array([point[1] for point in self.points[:4]])
+        projected = utm_from_lonlat_arrays(lon, lat, zone=32)
+        self.assertProjected(projected, [utm.from_latlon(point[1], point[0], force_zone_number=32) for point in self.points[:4]])
+
+
+def observation(camera, target, heading):
+    """
+    img_lon, img_lat of target (x, y, z) seen from camera (x, y, z) with a level camera facing heading
+    """
+    dx, dy, dz = np.subtract(target, camera)
+    img_lon = (math.degrees(math.atan2(dx, dy)) - heading + 180) % 360 - 180
+    return img_lon, math.degrees(math.atan2(dz, math.hypot(dx, dy)))
+
+
+class cameraSetupMixin(object):
+    """
+    level cameras 2 meters above a flat ground, positioned in meters from an UTM origin
+    """
+    camera_height = 2
+    origin_lon, origin_lat = 11.87, 45.40
+
+    def setUp(self):
+        creator = userkeys.objects.create(user=User.objects.create(username='cameras'))
+        self.creator = creator
+        self.seq = sequences.objects.create(title='cameras', creator_key=creator, height_from_ground=self.camera_height)
+        self.origin_x, self.origin_y, self.zone, self.letter = utm.from_latlon(self.origin_lat, self.origin_lon)
+
+    def lonlat(self, x, y):
+        lat, lon = utm.to_latlon(self.origin_x + x, self.origin_y + y, self.zone, self.letter)
+        return lon, lat
+
+    def camera(self, x, y, heading):
+        lon, lat = self.lonlat(x, y)
+        pano = panoramas(
+            sequence=self.seq, eqimage='panos/camera.jpg', lon=lon, lat=lat,
+            utm_x=self.origin_x + x, utm_y=self.origin_y + y, utm_srid=32600 + self.zone, utm_code='%d%s' % (self.zone, self.letter),
+            heading=heading, pitch=0, roll=0,
+        )
+        panoramas.objects.bulk_create([pano])
+        return pano
+
+    def image_object(self, pano, target, object_type):
+        camera = (pano.utm_x - self.origin_x, pano.utm_y - self.origin_y, self.camera_height)
+        img_lon, img_lat = observation(camera, target, pano.heading)
+        obj = image_objects(type=object_type, panorama=pano, creator_key=self.creator, img_lon=img_lon, img_lat=img_lat)
+        image_objects.objects.bulk_create([obj])
+        return obj
+
+    def assertLocated(self, located, x, y):
+        lon, lat = self.lonlat(x, y)
+        # 1e-6 degrees: about 10 cm
+        self.assertAlmostEqual(located[0], lon, places=6)
+        self.assertAlmostEqual(located[1], lat, places=6)
+
+
+class photogrammetryTestCase(cameraSetupMixin, TestCase):
+    """
+    matched observations of two cameras are intersected at the observed point
+    """
+
+    def test_intersect_rays(self):
+        cameras = np.array([(0, 0, 2), (25, 0, 2), (0, 30, 2)], dtype=float)
+        target = (10, 20, 5)
+        directions = observation_directions(*zip(*[observation(camera, target, heading) + (heading, 0, 0) for camera, heading in zip(cameras, (30, 300, 150))]))
+        points, rms, valid = intersect_rays(cameras, directions, np.array([0, 0, 1]), 2)
+        np.testing.assert_allclose(points[0], target, atol=1e-6)
+        self.assertLess(rms[0], 1e-6)
+        # a single ray locates nothing
+        self.assertEqual(list(valid), [True, False])
+
+    def test_solve(self):
+        target = (10, 20, 5)
+        first = self.image_object(self.camera(0, 0, 30), target, 3)
+        second = self.image_object(self.camera(25, 0, 300), target, 3)
+        first.match.add(second)
+        single = self.image_object(self.camera(0, 30, 150), target, 4)
+
+        solved = solve_image_objects(image_objects.objects.all())
+        self.assertEqual(set(solved), {first.pk, second.pk})
+        for pk in (first.pk, second.pk):
+            lon, lat, height, accurancy = solved[pk]
+            self.assertLocated((lon, lat), target[0], target[1])
+            self.assertEqual(height, target[2])
+            self.assertLess(accurancy, 1e-3)
+        stored = image_objects.objects.get(pk=first.pk)
+        self.assertEqual(stored.utm_srid, 32600 + self.zone)
+        self.assertAlmostEqual(stored.utm_x, self.origin_x + target[0], places=3)
+        self.assertIsNone(image_objects.objects.get(pk=single.pk).lon)
+
+
+class monoplotTestCase(cameraSetupMixin, TestCase):
+    """
+    map spots are projected where their observation ray meets the ground
+    """
+
+    def test_ground_plane(self):
+        pano = self.camera(0, 0, 45)
+        spot = self.image_object(pano, (10, 5, 0), 2)
+        sky = self.image_object(pano, (10, 5, 4), 2)
+        far = self.image_object(pano, (300, 0, 0), 2)
+
+        projected = monoplot_image_objects(image_objects.objects.all(), use_dem=False)
+        self.assertEqual(set(projected), {spot.pk})
+        self.assertLocated(projected[spot.pk], 10, 5)
+        stored = image_objects.objects.get(pk=spot.pk)
+        self.assertAlmostEqual(stored.utm_y, self.origin_y + 5, places=3)
+        self.assertEqual(stored.utm_code, '%d%s' % (self.zone, self.letter))
+        self.assertIsNone(image_objects.objects.get(pk=sky.pk).lon)
+        self.assertIsNone(image_objects.objects.get(pk=far.pk).lon)
+
+    def test_dem(self):
+        dem_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dem_path, ignore_errors=True)
+        with open(os.path.join(dem_path, 'flat.hdr'), 'w') as hdr:
+            hdr.write('ncols 100\nnrows 100\nxllcorner -50\nyllcorner -50\ncellsize 1\nnodata_value -9999\nbyteorder lsbfirst\n')
+        np.full((100, 100), 100, dtype='<f4').tofile(os.path.join(dem_path, 'flat.flt'))
+        dem = demTiles(dem_path, 32600 + self.zone)
+
+        img_lon, img_lat = observation((0, 0, 2), (10, 5, 0), 45)
+        directions = observation_directions(np.array([img_lon]), np.array([img_lat]), np.array([45.0]), np.zeros(1), np.zeros(1))
+        points, valid = dem_intersections(np.array([[0, 0, 102.0]]), directions, dem)
+        self.assertTrue(valid[0])
+        np.testing.assert_allclose(points[0], (10, 5, 100), atol=1e-6)
+
+        # outside the DEM coverage nothing is found
+        points, valid = dem_intersections(np.array([[80, 80, 102.0]]), directions, dem)
+        self.assertFalse(valid[0])
+
+
+class exifHeaderTestCase(SimpleTestCase):
+    """
+    tags read by the JPEG header parser convert like the exifread ones
+    """
+
+    def jpeg_with_exif(self, exif_dict):
+        image = io.BytesIO()
+        Image.new('RGB', (64, 32)).save(image, 'JPEG')
+        output = io.BytesIO()
+        piexif.insert(piexif.dump(exif_dict), image.getvalue(), output)
+        output.seek(0)
+        return output
+
+    def test_camera_and_gps_tags(self):
+        img_file = self.jpeg_with_exif({
+            '0th': {piexif.ImageIFD.Make: b'Ricoh', piexif.ImageIFD.Model: b'Theta'},
+            'Exif': {
+                piexif.ExifIFD.PixelXDimension: 5376,
+                piexif.ExifIFD.FocalPlaneXResolution: (1000, 1),
+                piexif.ExifIFD.FocalLength: (4, 1),
+                piexif.ExifIFD.DateTimeOriginal: b'2018:01:01 10:00:00',
+            },
+            'GPS': {
+                piexif.GPSIFD.GPSLatitudeRef: b'N',
+                piexif.GPSIFD.GPSLatitude: ((45, 1), (24, 1), (0, 1)),
+                piexif.GPSIFD.GPSLongitudeRef: b'E',
+                piexif.GPSIFD.GPSLongitude: ((11, 1), (52, 1), (12, 1)),
+                piexif.GPSIFD.GPSImgDirection: (905, 10),
+            },
+            '1st': {},
+            'thumbnail': None,
+        })
+        lat, lon, elevation, heading, pitch, roll, fov, camera_prod, camera_model, shooting_time = get_exif_values(read_exif_header(img_file))
+        self.assertAlmostEqual(lat, 45.4)
+        self.assertAlmostEqual(lon, 11.87)
+        self.assertAlmostEqual(heading, 90.5)
+        # PixelXDimension is a plain integer SHORT/LONG, FocalLength a RATIONAL
+        self.assertAlmostEqual(fov, 2 * math.atan(5376 / 1000.0 / 2 / 4))
+        self.assertEqual((camera_prod, camera_model), ('Ricoh', 'Theta'))
+        self.assertEqual(shooting_time, datetime.datetime(2018, 1, 1, 10, 0))
@@ -0,0 +1,84 @@
+import os
+import json
+import math
+import shutil
+
+from PIL import Image
+from django.conf import settings
+
+TILE_SIZE = getattr(settings, 'WS_TILE_SIZE', 512)
+TILE_QUALITY = getattr(settings, 'WS_TILE_QUALITY', 80)
+
+def tile_levels(width, height, tile_size=TILE_SIZE):
+    """
+    equirectangular pyramid levels: level 0 fits a single tile, every following level
+    doubles the resolution up to the full image size. Returns dicts with z, width, height, cols, rows
+    """
+    max_z = max(0, int(math.ceil(math.log(float(width) / tile_size, 2))))
+    levels = []
+    for z in range(max_z + 1):
+        scale = 2 ** (max_z - z)
+        level_width = int(math.ceil(float(width) / scale))
+        level_height = int(math.ceil(float(height) / scale))
+        levels.append({
+            'z': z,
+            'width': level_width,
+            'height': level_height,
+            'cols': int(math.ceil(float(level_width) / tile_size)),
+            'rows': int(math.ceil(float(level_height) / tile_size)),
+        })
+    return levels
+
+def tiles_dir(pano):
+    return os.path.join(settings.MEDIA_ROOT, 'tiles', str(pano.sequence_id), str(pano.pk))
+
+def tile_path(pano, z, x, y):
+    return os.path.join(tiles_dir(pano), str(z), '%d_%d.jpg' % (x, y))
+
+def tile_media_path(pano, z, x, y):
+    """
+    path relative to MEDIA_ROOT, as served by media_response
+    """
+    return '/'.join(('tiles', str(pano.sequence_id), str(pano.pk), str(z), '%d_%d.jpg' % (x, y)))
+
+def manifest_path(pano):
+    return os.path.join(tiles_dir(pano), 'tiles.json')
+
+def read_manifest(pano):
+    try:
+        with open(manifest_path(pano)) as manifest:
+            return json.load(manifest)
+    except (IOError, ValueError):
+        return None
+
+def build_tiles(pano, tile_size=TILE_SIZE):
+    """
+    writes the tile pyramid of a panorama: the full image is decoded once and
+    every level is downscaled from the previous one. The manifest is written last
+    so its presence marks a complete pyramid
+    """
+    with pano.eqimage.open('rb') as img_file:
+        img = Image.open(img_file)
+        img.load()
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    levels = tile_levels(img.width, img.height, tile_size)
+    level_img = img
+    for level in reversed(levels):
+        if level_img.size != (level['width'], level['height']):
+            level_img = level_img.resize((level['width'], level['height']), Image.LANCZOS)
+        level_dir = os.path.join(tiles_dir(pano), str(level['z']))
+        if not os.path.exists(level_dir):
+            os.makedirs(level_dir)
+        for x in range(level['cols']):
+            for y in range(level['rows']):
+                box = (x*tile_size, y*tile_size, min((x+1)*tile_size, level['width']), min((y+1)*tile_size, level['height']))
+                level_img.crop(box).save(tile_path(pano, level['z'], x, y), 'JPEG', quality=TILE_QUALITY)
+
+    manifest = {'tile_size': tile_size, 'width': img.width, 'height': img.height, 'levels': levels}
+    with open(manifest_path(pano), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+def remove_tiles(pano):
+    shutil.rmtree(tiles_dir(pano), ignore_errors=True)
@@ -1,5 +1,67 @@
 import sys
 
+import numpy as np
+
 def get_utm_srid_from_lonlat(lon,lat):
     EPSG_srid = int(32700-round((45+lat)/90,0)*100 + round((183+lon)/6,0))
     return EPSG_srid
+
+UTM_K0 = 0.9996
+UTM_E = 0.00669438
+UTM_E2 = UTM_E * UTM_E
+UTM_E3 = UTM_E2 * UTM_E
+UTM_E_P2 = UTM_E / (1 - UTM_E)
+UTM_M1 = (1 - UTM_E / 4 - 3 * UTM_E2 / 64 - 5 * UTM_E3 / 256)
+UTM_M2 = (3 * UTM_E / 8 + 3 * UTM_E2 / 32 + 45 * UTM_E3 / 1024)
+UTM_M3 = (15 * UTM_E2 / 256 + 45 * UTM_E3 / 1024)
+UTM_M4 = (35 * UTM_E3 / 3072)
+UTM_R = 6378137
+UTM_ZONE_LETTERS = np.array(list("CDEFGHJKLMNPQRSTUVWXX"))
+
+def utm_zone_numbers(lon, lat):
+    zone = ((lon + 180) // 6).astype(int) % 60 + 1
+    # Norway and Svalbard exceptions
+    zone = np.where((lat >= 56) & (lat < 64) & (lon >= 3) & (lon < 12), 32, zone)
+    svalbard = (lat >= 72) & (lat <= 84) & (lon >= 0)
+    zone = np.where(svalbard & (lon < 9), 31, zone)
+    zone = np.where(svalbard & (lon >= 9) & (lon < 21), 33, zone)
+    zone = np.where(svalbard & (lon >= 21) & (lon < 33), 35, zone)
+    zone = np.where(svalbard & (lon >= 33) & (lon < 42), 37, zone)
+    return zone
+
+def utm_from_lonlat_arrays(lon, lat, zone=None):
+    """
+    Vectorized counterpart of utm.from_latlon (same series expansion).
+    Projects arrays of decimal lon/lat (-80 <= lat <= 84) to UTM. Returns the arrays
+    easting, northing, zone number, zone letter and EPSG srid, every point in its own
+    zone unless a zone number (scalar or array) is forced
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    if zone is None:
+        zone = utm_zone_numbers(lon, lat)
+    else:
+        zone = np.broadcast_to(np.asarray(zone, dtype=int), lon.shape)
+    letter = UTM_ZONE_LETTERS[np.clip(((lat + 80) // 8).astype(int), 0, len(UTM_ZONE_LETTERS) - 1)]
+
+    lat_rad = np.radians(lat)
+    lat_sin = np.sin(lat_rad)
+    lat_cos = np.cos(lat_rad)
+    lat_tan = lat_sin / lat_cos
+    lat_tan2 = lat_tan * lat_tan
+    lat_tan4 = lat_tan2 * lat_tan2
+
+    central_lon_rad = np.radians((zone - 1) * 6 - 180 + 3)
+    d_lon = (np.radians(lon) - central_lon_rad + np.pi) % (2 * np.pi) - np.pi
+
+    n = UTM_R / np.sqrt(1 - UTM_E * lat_sin**2)
+    c = UTM_E_P2 * lat_cos**2
+    a = lat_cos * d_lon
+    m = UTM_R * (UTM_M1 * lat_rad - UTM_M2 * np.sin(2 * lat_rad) + UTM_M3 * np.sin(4 * lat_rad) - UTM_M4 * np.sin(6 * lat_rad))
+
+    easting = UTM_K0 * n * (a + a**3 / 6 * (1 - lat_tan2 + c) + a**5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * UTM_E_P2)) + 500000
+    northing = UTM_K0 * (m + n * lat_tan * (a**2 / 2 + a**4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c**2) + a**6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * UTM_E_P2)))
+    northing = np.where(lat < 0, northing + 10000000, northing)
+
+    srid = np.where(lat < 0, 32700, 32600) + zone
+    return easting, northing, zone, letter, srid
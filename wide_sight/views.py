@@ -1,24 +1,40 @@
+import os
 import sys
+import json
+import base64
+import datetime
+import tempfile
 from uuid import UUID
+from collections import OrderedDict
 
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, Http404
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.db.models import F, Q
+from django.db import transaction
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import PageNumberPagination, BasePagination
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.exceptions import NotFound
+from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser, JSONParser
 from rest_framework_api_key.permissions import HasAPIAccess
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework_gis.filters import DistanceToPointFilter, InBBoxFilter
 from rest_framework_gis.pagination import GeoJsonPagination
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.views import APIView
 from rest_framework.reverse import reverse
 from rest_condition import Or
 from drf_autodocs.decorators import format_docstring
 
-from .models import sequences, panoramas, image_object_types, image_objects, userkeys, appkeys
+from django.conf import settings
+from .models import sequences, panoramas, image_object_types, image_objects, userkeys, appkeys, jobs, panorama_links, deferred_upload_processing, get_change_counter
 from .serializers import (  panoramas_geo_serializer,
                             sequences_serializer,
                             panoramas_serializer,
@@ -26,9 +42,26 @@ from .serializers import (  panoramas_geo_serializer,
                             image_objects_serializer,
                             image_objects_geo_serializer,
                             userkeys_serializer,
-                            appkeys_serializer)
+                            appkeys_serializer,
+                            jobs_serializer)
 
 from .permissions import baseAPIPermission
+from .ingest import ingest_panoramas, iter_archive, store_uploads
+from .tasks import enqueue
+from .tiles import tile_levels, tile_media_path, read_manifest, TILE_SIZE
+from .mvt import LAYERS, render_tile
+from .clusters import LAYERS as CLUSTER_LAYERS, cluster_cells, cell_bounds, CLUSTER_CELLS
+from .geojson import iter_feature_collection, iter_export, EXPORT_FORMATS
+from .columnar import COLUMNAR_FORMATS
+from .caching import conditional_cache, response_validators, set_validators
+from .media import media_response, with_apikey
+from .renditions import get_rendition, rendition_media_path
+from .perspective import perspective_params, perspective_view, view_key, image_object_views, data_uri
+from .nearest import nearest_panoramas
+from .photogrammetry import solve_image_objects
+from .monoplot import monoplot_image_objects
+from .bulk import bulk_image_objects, bulkError
+from .parsers import NDJSONParser
 
 #@login_required(login_url='/login/?next=/viewer/')
 def viewer(request, pano_id = ''):
@@ -36,11 +69,142 @@ def viewer(request, pano_id = ''):
         pano_id = "0329a9dd-6c57-4af0-a347-ba1133a6094c"
     return render(request, 'index.html', {'pano_id': pano_id})
 
+def async_requested(request):
+    return bool(request.query_params.get('async', getattr(settings, 'WS_ASYNC_UPLOADS', False)))
+
+def job_response(request, job, data=None):
+    response = {
+        'job': str(job.pk),
+        'status': job.status,
+        'status_url': reverse('jobs-detail', args=[job.pk], request=request),
+    }
+    if data is not None:
+        response['data'] = data
+    return Response(response, status=status.HTTP_202_ACCEPTED)
+
+def requested_ids(data, key='id'):
+    """
+    UUIDs of a repeated form field or of a JSON list. Raises ValidationError on anything else
+    """
+    ids = data.getlist(key) if hasattr(data, 'getlist') else data[key]
+    if not isinstance(ids, list):
+        raise ValidationError({key: 'a list of ids is expected'})
+    return [UUID(str(pk)) for pk in ids]
+
+def geojson_stream_requested(request):
+    return request.query_params.get('as_geojson', None) == 'stream'
+
+def geojson_stream_response(view):
+    queryset = view.filter_queryset(view.get_queryset())
+    content = iter_feature_collection(view.serializer_class, queryset, request=view.request)
+    return StreamingHttpResponse(content, content_type='application/json')
+
+def export_response(view, serializer_class):
+    export_format = view.request.query_params.get('export_format', 'geojsonseq')
+    if export_format not in EXPORT_FORMATS and export_format not in COLUMNAR_FORMATS:
+        raise APIException('export_format must be one of %s' % ', '.join(sorted(list(EXPORT_FORMATS) + list(COLUMNAR_FORMATS))))
+    queryset = view.filter_queryset(view.get_queryset())
+    if export_format in COLUMNAR_FORMATS:
+        # parquet footer and flatgeobuf index need the whole file: build it, then send it
+        content_type, extension, writer = COLUMNAR_FORMATS[export_format]
+        output = tempfile.TemporaryFile()
+        writer(output, serializer_class, queryset, request=view.request)
+        output.seek(0)
+        response = FileResponse(output, content_type=content_type)
+    else:
+        content_type, extension, writer = EXPORT_FORMATS[export_format]
+        content = iter_export(export_format, serializer_class, queryset, request=view.request, chunk_size=getattr(settings, 'WS_EXPORT_CHUNK_SIZE', 2000))
+        response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (serializer_class.Meta.model._meta.model_name, extension)
+    return response
+
 class basePagination(PageNumberPagination):
     page_size = 100
     page_size_query_param = 'page_size'
     max_page_size = 10000
 
+def keyset_requested(request):
+    return 'cursor' in request.query_params or request.query_params.get('pagination', None) == 'keyset'
+
+class keysetPagination(BasePagination):
+    """
+    Forward only keyset pagination ordered by the view keyset_ordering field plus pk:
+    every page is a range scan starting after the last row of the previous one,
+    no OFFSET and no COUNT(*) are issued.
+    """
+    page_size = basePagination.page_size
+    page_size_query_param = basePagination.page_size_query_param
+    max_page_size = basePagination.max_page_size
+    cursor_query_param = 'cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def encode_cursor(self, obj):
+        values = [getattr(obj, self.ordering) if self.ordering else None, obj.pk]
+        values = [value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value for value in values]
+        encoded = json.dumps([str(value) if isinstance(value, UUID) else value for value in values])
+        return base64.urlsafe_b64encode(encoded.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param, None)
+        if not encoded:
+            return None
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise NotFound('Invalid cursor')
+        return value, pk
+
+    def after(self, value, pk):
+        if not self.ordering:
+            return Q(pk__gt=pk)
+        if value is None:
+            # nulls come first
+            return Q(**{self.ordering + '__isnull': True, 'pk__gt': pk}) | Q(**{self.ordering + '__isnull': False})
+        return Q(**{self.ordering + '__gt': value}) | Q(**{self.ordering: value, 'pk__gt': pk})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = getattr(view, 'keyset_ordering', None)
+        page_size = self.get_page_size(request)
+        if self.ordering:
+            queryset = queryset.order_by(F(self.ordering).asc(nulls_first=True), 'pk')
+        else:
+            queryset = queryset.order_by('pk')
+        cursor = self.decode_cursor(request)
+        if cursor:
+            queryset = queryset.filter(self.after(*cursor))
+        results = list(queryset[:page_size + 1])
+        self.next_cursor = self.encode_cursor(results[page_size - 1]) if len(results) > page_size else None
+        return results[:page_size]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+class geoKeysetPagination(keysetPagination):
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('type', 'FeatureCollection'),
+            ('next', self.get_next_link()),
+            ('features', data['features']),
+        ]))
+
 class sequencesViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows to be view or edit sequences of panorama images.
@@ -56,14 +220,38 @@ class sequencesViewSet(viewsets.ModelViewSet):
 
     delete:
     permanently delete an existing sequence.
+
+    A `cursor` (or `pagination=keyset`) url parameter switches the listing to
+    keyset pagination: pages carry only a `next` link and cost the same at any depth.
+
+    export:
+    Whole filtered listing as a file download, `export_format` as for panoramas export.
     """
-    queryset = sequences.objects.all()
+    queryset = sequences.objects.select_related('creator_key__user')
     serializer_class = sequences_serializer
     permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess),)
     pagination_class = basePagination
+    keyset_ordering = 'shooting_data'
     filter_backends = (DjangoFilterBackend,)
     filterset_fields = ('creator_key', )
 
+    def get_queryset(self):
+        if keyset_requested(self.request):
+            self.pagination_class = keysetPagination
+        return self.queryset.all()
+
+    @conditional_cache('sequences')
+    def list(self, request, *args, **kwargs):
+        return super(sequencesViewSet, self).list(request, *args, **kwargs)
+
+    @conditional_cache('sequences')
+    def retrieve(self, request, *args, **kwargs):
+        return super(sequencesViewSet, self).retrieve(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        return export_response(self, sequences_serializer)
+
     def initial(self, request, *args, **kwargs):
         if request.method == 'GET':
             self.permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess), ) #Or(baseAPIPermission, HasAPIAccess),
@@ -87,17 +275,94 @@ class panoramasViewSet(viewsets.ModelViewSet):
 
     delete:
     permanently delete an existing panorama.
+
+    bulk:
+    Load many images in a sequence at once: multipart POST with a `sequence` id and
+    either several `eqimage` files or a zip/tar `archive` of jpeg images.
+
+    With the `async` url parameter post and bulk return 202 with a job id as soon
+    as the images are stored: EXIF reading and thumbnail generation happen in a
+    background job whose status is exposed at /jobs/{id}/.
+
+    With `as_geojson=stream` the whole filtered listing is streamed as a single
+    unpaginated GeoJSON FeatureCollection built without per-row serializers.
+    A `cursor` (or `pagination=keyset`) url parameter switches the listing to
+    keyset pagination: pages carry only a `next` link and cost the same at any depth.
+
+    retrieve:
+    Panorama detail, with the precomputed navigation `links` (prev/next in sequence,
+    near panoramas of other sequences) each with target panorama, distance and bearing.
+
+    nearest:
+    k nearest panoramas (`k`, default 10, max 100) to `lon`/`lat` or to the position of
+    `panorama`, optionally limited to a `sequence`, a `max_distance` in meters and to the
+    cone of half-angle `cone` (default 45) around `heading`. Each result has a `distance` in meters.
+
+    tiles:
+    Multi-resolution tile pyramid description of the equirectangular image;
+    single 512 px jpeg tiles at panoramas/{id}/tiles/{z}/{x}/{y}/.
+
+    renditions:
+    Downscaled copies of the equirectangular image listed in the `renditions` field
+    (thumbnail, small and medium widths in jpeg, webp and avif, blurred placeholder),
+    at panoramas/{id}/renditions/{name}.{format}/, generated on first request.
+
+    perspective:
+    Rectilinear jpeg view of the panorama centered on `yaw`/`pitch` (degrees in the
+    image frame, as image objects img_lon/img_lat) with horizontal field of view `fov`
+    (default 90) and `width`/`height` pixels (default 640x480). Views are cached.
+
+    object_views:
+    Views centered on every image object of the panorama (`fov` default 30,
+    `width`/`height` default 256) rendered in one pass, as data URIs with the
+    parameters of the matching perspective url.
+
+    export:
+    Streams the whole filtered listing as a file download, with constant memory on the
+    server: `export_format` is `geojsonseq` (default, RFC 8142), `ndjson` or `csv`
+    (geometry as WKT in the last column). Columnar files are built before sending:
+    `parquet` (GeoParquet) and `fgb` (FlatGeobuf with spatial index).
     """
-    queryset = panoramas.objects.all()
+    queryset = panoramas.objects.select_related('sequence__creator_key__user')
     serializer_class = panoramas_serializer
     response_serializer_class = panoramas_serializer
     permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess),)
     pagination_class = basePagination
+    keyset_ordering = 'shooting_time'
     distance_filter_field = 'geom'
     bbox_filter_field = 'geom'
     filter_backends = (DjangoFilterBackend, DistanceToPointFilter, InBBoxFilter)
     filterset_fields = ('sequence', )
 
+    def create(self, request, *args, **kwargs):
+        if not async_requested(request):
+            return super(panoramasViewSet, self).create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            with deferred_upload_processing():
+                self.perform_create(serializer)
+            job = enqueue('process_panorama', creator=request.user, panorama=str(serializer.instance.pk))
+        return job_response(request, job, serializer.data)
+
+    @conditional_cache('panoramas', 'sequences')
+    def list(self, request, *args, **kwargs):
+        if geojson_stream_requested(request):
+            return geojson_stream_response(self)
+        return super(panoramasViewSet, self).list(request, *args, **kwargs)
+
+    @conditional_cache('panoramas', 'sequences')
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        data = self.get_serializer(instance).data
+        data['links'] = list(panorama_links.objects.filter(from_panorama=instance).values('to_panorama', 'type', 'distance', 'bearing'))
+        return Response(data)
+
+    def perform_create(self, serializer):
+        super(panoramasViewSet, self).perform_create(serializer)
+        if not async_requested(self.request):
+            enqueue('build_panorama_tiles', creator=self.request.user, panoramas_ids=[str(serializer.instance.pk)])
+
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         print ("instance",instance, file=sys.stderr)
@@ -106,6 +371,134 @@ class panoramasViewSet(viewsets.ModelViewSet):
         self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=['post'], parser_classes=(MultiPartParser,))
+    def bulk(self, request, *args, **kwargs):
+        try:
+            seq = sequences.objects.get(pk=UUID(request.data.get('sequence', '')))
+        except (ValueError, sequences.DoesNotExist):
+            return Response({'sequence': 'sequence not found'}, status=status.HTTP_400_BAD_REQUEST)
+
+        archive = request.FILES.get('archive')
+        if archive:
+            uploads = iter_archive(archive)
+        else:
+            uploads = [(f.name, f) for f in request.FILES.getlist('eqimage')]
+            if not uploads:
+                return Response({'eqimage': 'no images uploaded'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if async_requested(request):
+            stored = [[str(pano.pk), pano.eqimage.name] for pano in store_uploads(seq, uploads)]
+            with transaction.atomic():
+                job = enqueue('ingest_stored', creator=request.user, sequence=str(seq.pk), stored=stored)
+            return job_response(request, job, {'panoramas': [pk for pk, name in stored]})
+
+        new_panos = ingest_panoramas(seq, uploads)
+        enqueue('build_panorama_tiles', creator=request.user, panoramas_ids=[str(pano.pk) for pano in new_panos])
+        serializer = panoramas_serializer(new_panos, many=True, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        return export_response(self, panoramas_geo_serializer)
+
+    @action(detail=False, methods=['get'])
+    def nearest(self, request, *args, **kwargs):
+        params = request.query_params
+        exclude = None
+        try:
+            if params.get('panorama'):
+                origin = panoramas.objects.get(pk=UUID(params['panorama']))
+                lon, lat, exclude = origin.lon, origin.lat, origin.pk
+            else:
+                lon, lat = float(params['lon']), float(params['lat'])
+            k = min(int(params.get('k', 10)), 100)
+            heading = float(params['heading']) if params.get('heading') else None
+            cone = float(params.get('cone', 45))
+            max_distance = float(params['max_distance']) if params.get('max_distance') else None
+            sequence = UUID(params['sequence']) if params.get('sequence') else None
+        except (KeyError, ValueError, panoramas.DoesNotExist):
+            raise ValidationError('bad nearest parameters: lon and lat or an existing panorama are required')
+        if k < 1 or (max_distance is not None and not max_distance >= 0):
+            raise ValidationError('bad nearest parameters: k must be a positive integer and max_distance not negative')
+        if lon is None or lat is None:
+            raise APIException('panorama has no location')
+
+        found = nearest_panoramas(lon, lat, k, sequence=sequence, exclude=exclude, heading=heading, cone=cone, max_distance=max_distance)
+        objects = self.get_queryset().in_bulk([pk for pk, distance in found])
+        results = []
+        for pk, distance in found:
+            if pk in objects:
+                data = panoramas_serializer(objects[pk], context=self.get_serializer_context()).data
+                data['distance'] = distance
+                results.append(data)
+        return Response(results)
+
+    @action(detail=True, methods=['get'])
+    def tiles(self, request, *args, **kwargs):
+        pano = self.get_object()
+        manifest = read_manifest(pano)
+        if manifest is None:
+            manifest = {
+                'tile_size': TILE_SIZE,
+                'width': pano.eqimage.width,
+                'height': pano.eqimage.height,
+                'levels': tile_levels(pano.eqimage.width, pano.eqimage.height),
+            }
+        manifest['url'] = with_apikey(reverse('panoramas-tiles', args=[pano.pk], request=request) + '{z}/{x}/{y}/', request)
+        return Response(manifest)
+
+    @action(detail=True, methods=['get'], url_path=r'tiles/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)')
+    def tile(self, request, z, x, y, *args, **kwargs):
+        pano = self.get_object()
+        if read_manifest(pano) is None:
+            # the pyramid is built by a background job, never inside the request
+            job = jobs.objects.filter(task='build_panorama_tiles', status__in=('queued', 'running'), params__contains=str(pano.pk)).first()
+            if job is None:
+                creator = request.user if request.user.is_authenticated else None
+                job = enqueue('build_panorama_tiles', creator=creator, panoramas_ids=[str(pano.pk)])
+            return job_response(request, job)
+        return media_response(request._request, tile_media_path(pano, int(z), int(x), int(y)))
+
+    @action(detail=True, methods=['get'], url_path=r'renditions/(?P<name>[a-z0-9_]+)\.(?P<fmt>[a-z0-9]+)')
+    def rendition(self, request, name, fmt, *args, **kwargs):
+        pano = self.get_object()
+        if get_rendition(pano, name, fmt) is None:
+            raise Http404
+        return media_response(request._request, rendition_media_path(pano.pk, name, fmt))
+
+    @action(detail=True, methods=['get'])
+    def perspective(self, request, *args, **kwargs):
+        pano = self.get_object()
+        try:
+            params = perspective_params(request.query_params)
+        except ValueError as e:
+            raise APIException('bad perspective parameters: %s' % e)
+        # the etag only depends on the image and the parameters: revalidations skip the rendering
+        etag = '"%s"' % view_key(pano, params)
+        response = get_conditional_response(request._request, etag=etag)
+        if response is None:
+            key, content = perspective_view(pano, params)
+            response = HttpResponse(content, content_type='image/jpeg')
+        response['ETag'] = etag
+        return response
+
+    @action(detail=True, methods=['get'])
+    def object_views(self, request, *args, **kwargs):
+        pano = self.get_object()
+        try:
+            fov, width, height = perspective_params(request.query_params, fov=30, width=256, height=256)[2:]
+        except ValueError as e:
+            raise APIException('bad perspective parameters: %s' % e)
+        url = reverse('panoramas-perspective', args=[pano.pk], request=request)
+        results = []
+        for view in image_object_views(pano, fov, width, height):
+            params = OrderedDict(zip(('yaw', 'pitch', 'fov', 'width', 'height'), view['params']))
+            results.append({
+                'image_object': view['image_object'],
+                'url': with_apikey(url + '?' + '&'.join('%s=%s' % item for item in params.items()), request),
+                'image': data_uri(view['content']),
+            })
+        return Response(results)
 
     def get_queryset(self):
         #print ("get_filterset",self, dir(self), file=sys.stderr)
@@ -119,7 +512,7 @@ class panoramasViewSet(viewsets.ModelViewSet):
             except:
                 raise APIException('bad userkey')
             if userkeys.objects.filter(pk=uuidkey).exists():
-                self.queryset = self.queryset.filter(sequence__creator=uuidkey)
+                self.queryset = self.queryset.filter(sequence__creator_key=uuidkey)
             else:
                 raise APIException('userkey not found')
 
@@ -127,6 +520,9 @@ class panoramasViewSet(viewsets.ModelViewSet):
             self.serializer_class = panoramas_geo_serializer
             self.pagination_class = GeoJsonPagination
 
+        if keyset_requested(self.request):
+            self.pagination_class = geoKeysetPagination if as_geojson else keysetPagination
+
         '''
         print ("COUNT",self.queryset.count(), file=sys.stderr)
         if self.queryset.count() > 10:
@@ -192,8 +588,36 @@ class image_objectsViewSet(viewsets.ModelViewSet):
 
     delete:
     permanently delete an existing image object.
+
+    With `as_geojson=stream` the whole filtered listing is streamed as a single
+    unpaginated GeoJSON FeatureCollection built without per-row serializers.
+    A `cursor` (or `pagination=keyset`) url parameter switches the listing to
+    keyset pagination (ordered by id): pages carry only a `next` link.
+
+    solve:
+    Geolocates the matched groups of stereo interpretation and visual intersection
+    image objects by least squares intersection of their observation rays. Optional
+    `id` (list), `panorama` or `sequence` parameters restrict the solved objects.
+
+    export:
+    Streams the whole filtered listing as a file download, with constant memory on the
+    server: `export_format` is `geojsonseq` (default, RFC 8142), `ndjson` or `csv`
+    (geometry as WKT in the last column). Columnar files are built before sending:
+    `parquet` (GeoParquet) and `fgb` (FlatGeobuf with spatial index).
+
+    monoplot:
+    Projects map spot image objects on the ground from img_lon/img_lat, on the DEM when
+    one is configured (`dem=false` forces the ground plane). Optional `id` (list),
+    `panorama` or `sequence` parameters restrict the projected objects.
+
+    bulk:
+    Applies many create, update (partial) and delete operations in a single transaction.
+    The body is either `{"create": [...], "update": [...], "delete": [ids]}` or a JSON
+    array (or `application/x-ndjson` lines) of objects with an `op` key; updates and
+    deletes need the `id`. When any operation is invalid nothing is written and the
+    errors are returned by operation index.
     """
-    queryset = image_objects.objects.all()
+    queryset = image_objects.objects.select_related('creator_key__user').prefetch_related('match')
     serializer_class = image_objects_serializer
     permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess),)
     pagination_class = basePagination
@@ -207,8 +631,72 @@ class image_objectsViewSet(viewsets.ModelViewSet):
         if as_geojson:
             self.serializer_class = image_objects_geo_serializer
             self.pagination_class = GeoJsonPagination
+        if keyset_requested(self.request):
+            self.pagination_class = geoKeysetPagination if as_geojson else keysetPagination
         return self.queryset
 
+    @conditional_cache('image_objects')
+    def list(self, request, *args, **kwargs):
+        if geojson_stream_requested(request):
+            return geojson_stream_response(self)
+        return super(image_objectsViewSet, self).list(request, *args, **kwargs)
+
+    @conditional_cache('image_objects')
+    def retrieve(self, request, *args, **kwargs):
+        return super(image_objectsViewSet, self).retrieve(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        return export_response(self, image_objects_geo_serializer)
+
+    @action(detail=False, methods=['post'])
+    def solve(self, request, *args, **kwargs):
+        queryset = image_objects.objects.all()
+        try:
+            if 'id' in request.data:
+                seeds = requested_ids(request.data)
+                # whole groups are solved: add the objects matched with the requested ones
+                matched = image_objects.match.through.objects.filter(from_image_objects__in=seeds).values_list('to_image_objects', flat=True)
+                queryset = queryset.filter(Q(pk__in=seeds) | Q(pk__in=list(matched)))
+            if request.data.get('panorama'):
+                queryset = queryset.filter(panorama=UUID(request.data['panorama']))
+            if request.data.get('sequence'):
+                queryset = queryset.filter(panorama__sequence=UUID(request.data['sequence']))
+        except (TypeError, ValueError):
+            raise ValidationError('bad image object, panorama or sequence id')
+        solved = solve_image_objects(queryset)
+        return Response([
+            {'id': pk, 'lon': lon, 'lat': lat, 'height': height, 'accurancy': accurancy}
+            for pk, (lon, lat, height, accurancy) in solved.items()
+        ])
+
+    @action(detail=False, methods=['post'])
+    def monoplot(self, request, *args, **kwargs):
+        queryset = image_objects.objects.all()
+        try:
+            if 'id' in request.data:
+                queryset = queryset.filter(pk__in=requested_ids(request.data))
+            if request.data.get('panorama'):
+                queryset = queryset.filter(panorama=UUID(request.data['panorama']))
+            if request.data.get('sequence'):
+                queryset = queryset.filter(panorama__sequence=UUID(request.data['sequence']))
+        except (TypeError, ValueError):
+            raise ValidationError('bad image object, panorama or sequence id')
+        use_dem = str(request.data.get('dem', 'true')).lower() not in ('0', 'false', 'no')
+        projected = monoplot_image_objects(queryset, use_dem=use_dem)
+        return Response([
+            {'id': pk, 'lon': lon, 'lat': lat, 'elevation': elevation}
+            for pk, (lon, lat, elevation) in projected.items()
+        ])
+
+    @action(detail=False, methods=['post'], parser_classes=(JSONParser, NDJSONParser))
+    def bulk(self, request, *args, **kwargs):
+        try:
+            result = bulk_image_objects(request.data, self.get_serializer_context())
+        except bulkError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
     def initial(self, request, *args, **kwargs):
         if request.method == 'GET':
             self.permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess), ) #Or(baseAPIPermission, HasAPIAccess),
@@ -246,6 +734,98 @@ class apikeysViewSet(viewsets.ReadOnlyModelViewSet):
     pagination_class = basePagination
 
 
+class jobsViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint that exposes the status of background jobs (upload post-processing).
+    """
+    queryset = jobs.objects.all()
+    serializer_class = jobs_serializer
+    permission_classes = ( IsAuthenticated,)
+    pagination_class = basePagination
+    filter_backends = (DjangoFilterBackend, )
+    filterset_fields = ('status', 'task')
+
+    def get_queryset(self):
+        return self.queryset.filter(creator=self.request.user)
+
+
+class vectorTileView(APIView):
+    """
+    Mapbox Vector Tile of panoramas, sequences or image_objects geometries.
+    Points are grid clustered (with a count property) below WS_MVT_CLUSTER_MAXZOOM.
+    """
+    permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess),)
+
+    def get(self, request, layer, z, x, y, format=None):
+        if layer not in LAYERS:
+            raise Http404
+        z, x, y = int(z), int(x), int(y)
+        if x >= 2**z or y >= 2**z:
+            raise Http404
+        model_name = LAYERS[layer][0]._meta.model_name
+        etag, last_modified = response_validators(request._request, [model_name])
+        not_modified = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return set_validators(not_modified, etag, last_modified)
+        key = 'mvt_%s_%d_%d_%d' % (layer, z, x, y)
+        version = get_change_counter(model_name)
+        tile = cache.get(key, version=version)
+        if tile is None:
+            tile = render_tile(layer, z, x, y)
+            cache.set(key, tile, getattr(settings, 'WS_MVT_CACHE_TIMEOUT', 3600), version=version)
+        return set_validators(HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile'), etag, last_modified)
+
+
+class clusterView(APIView):
+    """
+    Coverage overview of panoramas or image_objects: counts and centroids of the points
+    in the web mercator grid cells (WS_CLUSTER_CELLS per side of a map tile) of `zoom`
+    intersecting `bbox` (min_lon,min_lat,max_lon,max_lat), as a GeoJSON FeatureCollection
+    of centroid points with `count` and cell `bbox` properties.
+    """
+    permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess),)
+
+    def get(self, request, layer, format=None):
+        if layer not in CLUSTER_LAYERS:
+            raise Http404
+        model_name = CLUSTER_LAYERS[layer]._meta.model_name
+        etag, last_modified = response_validators(request._request, [model_name])
+        not_modified = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return set_validators(not_modified, etag, last_modified)
+        try:
+            zoom = int(request.query_params['zoom'])
+            bbox = [float(value) for value in request.query_params['bbox'].split(',')]
+            if len(bbox) != 4:
+                raise ValueError('bbox must have 4 values')
+            cells = cluster_cells(layer, bbox, zoom)
+        except (KeyError, ValueError) as e:
+            raise APIException('bad cluster parameters: %s' % e)
+        n = 2 ** zoom * CLUSTER_CELLS
+        features = [{
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': {'count': count, 'bbox': cell_bounds(cx, cy, n)},
+        } for cx, cy, count, lon, lat in cells]
+        response = Response({'type': 'FeatureCollection', 'zoom': zoom, 'features': features})
+        return set_validators(response, etag, last_modified)
+
+
+class mediaView(APIView):
+    """
+    Media files (panorama images, thumbnails) with the same permissions of the API reads,
+    HTTP Range requests and ETag/Last-Modified validators.
+    """
+    permission_classes = ( Or(baseAPIPermission, IsAuthenticated, HasAPIAccess),)
+
+    def perform_content_negotiation(self, request, force=False):
+        # files are not rendered: accept whatever the client asks for
+        return super(mediaView, self).perform_content_negotiation(request, force=True)
+
+    def get(self, request, path, format=None):
+        return media_response(request._request, path)
+
+
 class APIRoot(APIView):
     """
     API Root ...
@@ -39,7 +39,6 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'django.contrib.gis',
     'corsheaders',
-    'imagekit',
     'rest_framework',
     'rest_framework_gis',
     'rest_framework.authtoken',
@@ -95,17 +94,46 @@ REST_FRAMEWORK = {
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
-SPATIALITE_LIBRARY_PATH = '/usr/lib/i386-linux-gnu/mod_spatialite.so' #blob
-SPATIALITE_LIBRARY_PATH = 'mod_spatialite.so' #ubuntu-asus
-SPATIALITE_LIBRARY_PATH = '/usr/lib/i386-linux-gnu/libspatialite.so' #urb
+# SpatiaLite file (development, default) or PostGIS selected by the environment:
+# WS_DB_ENGINE=postgis with WS_DB_NAME, WS_DB_USER, WS_DB_PASSWORD, WS_DB_HOST, WS_DB_PORT.
+# The other backend stays reachable as the 'spatialite' (or, with WS_DB_NAME set,
+# 'postgis') database for `python manage.py copy_database spatialite default`.
+# SPATIALITE_LIBRARY_PATH from the environment when mod_spatialite is not found
+# (e.g. /usr/lib/i386-linux-gnu/mod_spatialite.so)
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.contrib.gis.db.backends.spatialite',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+SPATIALITE_DATABASE = {
+    'ENGINE': 'django.contrib.gis.db.backends.spatialite',
+    'NAME': os.environ.get('WS_SPATIALITE_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+}
+
+POSTGIS_DATABASE = {
+    'ENGINE': 'django.contrib.gis.db.backends.postgis',
+    'NAME': os.environ.get('WS_DB_NAME', 'widesight'),
+    'USER': os.environ.get('WS_DB_USER', ''),
+    'PASSWORD': os.environ.get('WS_DB_PASSWORD', ''),
+    'HOST': os.environ.get('WS_DB_HOST', ''),
+    'PORT': os.environ.get('WS_DB_PORT', ''),
+    'CONN_MAX_AGE': int(os.environ.get('WS_DB_CONN_MAX_AGE', 60)),
 }
 
+if os.environ.get('WS_DB_ENGINE') == 'postgis':
+    DATABASES = {
+        'default': POSTGIS_DATABASE,
+        'spatialite': SPATIALITE_DATABASE,
+    }
+else:
+    DATABASES = {
+        'default': SPATIALITE_DATABASE,
+    }
+    if os.environ.get('WS_DB_NAME'):
+        DATABASES['postgis'] = POSTGIS_DATABASE
+
+# empty SpatiaLite target of the copy_database tests: only its test database is ever created
+DATABASES['copy_target'] = dict(SPATIALITE_DATABASE, NAME=os.path.join(BASE_DIR, 'copy_target.sqlite3'))
+
+if os.environ.get('SPATIALITE_LIBRARY_PATH'):
+    SPATIALITE_LIBRARY_PATH = os.environ['SPATIALITE_LIBRARY_PATH']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -138,5 +166,21 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
+# Background jobs: wide_sight.tasks.threadBackend (in-process worker, development),
+# wide_sight.tasks.syncBackend (inline, tests) or wide_sight.tasks.queueBackend
+# (jobs processed by `python manage.py run_jobs`)
+WS_TASK_BACKEND = 'wide_sight.tasks.threadBackend'
+WS_ASYNC_UPLOADS = False
+# EXIF parsing processes of the bulk ingestion jobs (bulk uploads in the request are parsed serially)
+WS_INGEST_WORKERS = 4
+# media offload to the front server: None (served by django), 'x-accel-redirect'
+# (nginx internal location WS_MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile'
+WS_MEDIA_ACCEL = None
+WS_MEDIA_ACCEL_PREFIX = '/protected-media/'
+# panorama images storage, content addressed (identical uploads stored once):
+# wide_sight.storage.contentAddressedFileSystemStorage (MEDIA_ROOT) or
+# wide_sight.storage.contentAddressedS3Storage (django-storages, AWS_* settings)
+WS_PANORAMA_STORAGE = 'wide_sight.storage.contentAddressedFileSystemStorage'
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
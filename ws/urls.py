@@ -42,7 +42,7 @@ schema_view = get_schema_view(
    permission_classes=(permissions.AllowAny,),
 )
 
-from wide_sight.views import APIRoot, viewer, sequencesViewSet, panoramasViewSet, image_object_typesViewSet, image_objectsViewSet, userkeysViewSet, apikeysViewSet
+from wide_sight.views import APIRoot, viewer, sequencesViewSet, panoramasViewSet, image_object_typesViewSet, image_objectsViewSet, userkeysViewSet, apikeysViewSet, jobsViewSet, vectorTileView, clusterView, mediaView
 
 router = routers.DefaultRouter()
 router.register(r'sequences', sequencesViewSet)
@@ -51,12 +51,16 @@ router.register(r'image_object_types', image_object_typesViewSet)
 router.register(r'image_objects', image_objectsViewSet)
 router.register(r'userkeys', userkeysViewSet)
 router.register(r'apikeys', apikeysViewSet)
+router.register(r'jobs', jobsViewSet)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     url(r'^viewer/$', viewer, name='viewer'),
     url(r'^viewer/([-\w]+)/$', viewer, name='viewer'),
     url(r'^$', APIRoot.as_view()),
+    url(r'^tiles/(?P<layer>\w+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$', vectorTileView.as_view(), name='vector-tiles'),
+    url(r'^clusters/(?P<layer>\w+)/$', clusterView.as_view(), name='clusters'),
+    url(r'^%s(?P<path>.+)$' % settings.MEDIA_URL.lstrip('/'), mediaView.as_view(), name='media'),
     url(r'^', include(router.urls)),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 
@@ -73,4 +77,4 @@ urlpatterns = [
     #url(r'^change-password/$', password_change,{'template_name': 'registration/password_change_form.html', 'post_change_redirect': 'cdu_password_change_done'},name='cdu_change-password'),
     #url(r'^password-changed/$', password_change_done,{'template_name': 'registration/password_change_done.html'},name='cdu_password_change_done'),
 
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)